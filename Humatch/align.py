@@ -7,11 +7,13 @@ import logging
 # suppress warnings about tf retracing
 tf.get_logger().setLevel('ERROR')
 logging.getLogger('tensorflow').setLevel(logging.ERROR)
-import pandas as pd
 import numpy as np
 import anarci
 import argparse
-from Humatch.utils import CANONICAL_NUMBERING, get_ordered_AA_one_letter_codes
+import multiprocessing as mp
+from Humatch.utils import CANONICAL_NUMBERING, get_ordered_AA_one_letter_codes, configure_cpus
+from Humatch.shard import select_shard, save_shard_manifest, get_shard_path, ROW_COL
+from Humatch.readers import iter_input_chunks, read_input, get_input_format, get_default_output_path, format_read_stats
 
 
 def strip_padding_from_seq(seq, pad_token="-"):
@@ -54,6 +56,101 @@ def get_padded_seq(seq, allowed_imgt_nums=CANONICAL_NUMBERING, pad_token="-"):
     return aligned_seq
 
 
+def align_seqs(seqs, num_cpus=1):
+    '''
+    Strip padding from and align many sequences, numbering them with ANARCI across num_cpus workers
+
+    :param seqs: list of str, sequences of amino acids (may already be padded)
+    :param num_cpus: int, number of alignment workers
+    :return: list of str, aligned sequences (full padding where ANARCI failed)
+    '''
+    seqs = [strip_padding_from_seq(seq) for seq in seqs]
+    num_cpus = 1 if num_cpus is None else min(num_cpus, len(seqs))
+    if num_cpus <= 1:
+        return [get_padded_seq(seq) for seq in seqs]
+    with mp.Pool(num_cpus) as pool:
+        return pool.map(get_padded_seq, seqs, chunksize=max(1, len(seqs) // (4 * num_cpus)))
+
+
+def seqs_to_char_array(seqs, seq_len=len(CANONICAL_NUMBERING)):
+    '''
+    Store aligned sequences as a fixed-width array of ASCII codes (one byte per residue, no python string per residue)
+
+    :param seqs: list of str, aligned sequences
+    :param seq_len: int, aligned sequence length
+    :return: ndarray of uint8 (# seqs, seq_len)
+    '''
+    if len(seqs) == 0:
+        return np.zeros((0, seq_len), dtype=np.uint8)
+    return np.frombuffer("".join(seqs).encode("ascii"), dtype=np.uint8).reshape(len(seqs), seq_len)
+
+
+def get_failed_idxs(char_array, pad_token="-"):
+    '''
+    Indices of sequences ANARCI could not number (returned as full padding)
+    '''
+    return np.flatnonzero((char_array == ord(pad_token)).all(axis=1))
+
+
+def get_csv_header(chains, imgt_cols=False, row_col=None, id_col=None):
+    '''
+    Csv header of aligned output for the chains present e.g. ["H", "L"]
+    '''
+    cols = [col for col in [row_col, id_col] if col is not None]
+    for chain in chains:
+        cols.extend([f"{chain}_{imgt}" for imgt in CANONICAL_NUMBERING] if imgt_cols else [f"V{chain}"])
+    return ",".join(cols) + "\n"
+
+
+def char_arrays_to_csv_bytes(char_arrays, imgt_cols=False, row_idxs=None, ids=None):
+    '''
+    Format a chunk of aligned chains as csv lines directly from their char arrays
+
+    :param char_arrays: list of ndarray of uint8 (# seqs, seq len), one per chain
+    :param imgt_cols: bool, one column per IMGT position (otherwise one column per chain)
+    :param row_idxs: list of int, optional input row indices written as the first column
+    :param ids: list of str, optional Fv ids (e.g. FASTA ids) written before the chains
+    :return: bytes, csv lines
+    '''
+    num_seqs = len(char_arrays[0])
+    blocks = []
+    for char_array in char_arrays:
+        # each residue (or whole chain) is followed by a separator, the last of each line becomes a newline
+        if imgt_cols:
+            cells = np.full(char_array.shape + (2,), ord(","), dtype=np.uint8)
+            cells[:, :, 0] = char_array
+            blocks.append(cells.reshape(num_seqs, -1))
+        else:
+            blocks.append(np.concatenate([char_array, np.full((num_seqs, 1), ord(","), dtype=np.uint8)], axis=1))
+    lines = np.concatenate(blocks, axis=1)
+    lines[:, -1] = ord("\n")
+    if row_idxs is None and ids is None:
+        return lines.tobytes()
+    prefixes = [""] * num_seqs
+    for col in [row_idxs, ids]:
+        if col is not None:
+            prefixes = [prefix + get_csv_field(val) + "," for prefix, val in zip(prefixes, col)]
+    return b"".join(prefix.encode() + line.tobytes() for prefix, line in zip(prefixes, lines))
+
+
+def get_csv_field(val):
+    '''
+    Format a value as a csv field, quoting it if needed
+    '''
+    val = str(val)
+    return f'"{val.replace(chr(34), 2 * chr(34))}"' if any(char in val for char in ',"\n') else val
+
+
+def write_npy_header(f, num_seqs, seq_len=len(CANONICAL_NUMBERING)):
+    '''
+    (Re)write the header of a .npy file of aligned chains (# seqs, seq_len) of single characters. The header
+    is padded for the first axis to grow, so it is written with 0 rows first and rewritten once all rows are appended
+    '''
+    f.seek(0)
+    np.lib.format.write_array_header_1_0(f, {"descr": "|S1", "fortran_order": False, "shape": (num_seqs, seq_len)})
+    return f.tell()
+
+
 def command_line_interface():
     description="""
     Humatch - Align
@@ -65,11 +162,15 @@ def command_line_interface():
     parser = argparse.ArgumentParser(prog="Humatch-align", description=description, formatter_class=argparse.RawDescriptionHelpFormatter)
     parser.add_argument("-H", "--VH", help="Heavy chain amino acid sequence", default=None)
     parser.add_argument("-L", "--VL", help="Light chain amino acid sequence", default=None)
-    parser.add_argument("-i", "--input", help="Path to csv with antibody sequences", default=None)
-    parser.add_argument("--vh_col", help="Column name for VH sequences in input file", default="VH")
-    parser.add_argument("--vl_col", help="Column name for VL sequences in input file", default="VL")
+    parser.add_argument("-i", "--input", help="Path to csv, tsv or FASTA with antibody sequences (optionally .gz or .zst compressed)", default=None)
+    parser.add_argument("--input_L", help="FASTA of light chains paired with the -i FASTA of heavy chains by id", default=None)
+    parser.add_argument("--vh_col", help="Column name for VH sequences in input file (id suffix of VH records in FASTA e.g. ab1_VH)", default="VH")
+    parser.add_argument("--vl_col", help="Column name for VL sequences in input file (id suffix of VL records in FASTA e.g. ab1_VL)", default="VL")
     parser.add_argument("--imgt_cols", help="Flag to use IMGT numbering columns (aa-level) instead of heavy/light cols", default=False, action="store_true")
-    parser.add_argument("-o", "--output", help="Output save path - defaults to the same dir as input", default=None)
+    parser.add_argument("--chunk_size", help="Number of Fvs aligned and written at a time (bounds memory for large inputs)", default=10000, type=int)
+    parser.add_argument("--num_cpus", help="Number of CPUs to use (defaults to all available)", default=None, type=int)
+    parser.add_argument("--shard", help="Only process shard i of N of the input e.g. 0/8 (merge outputs with Humatch-merge)", default=None)
+    parser.add_argument("-o", "--output", help="Output save path - defaults to the same dir as input. A .npy path saves (# seqs, 200) arrays of IMGT columns per chain (*_H.npy, *_L.npy)", default=None)
     parser.add_argument("-v", "--verbose", help="Verbose output flag", default=False, action="store_true")
     args = parser.parse_args()
 
@@ -84,46 +185,96 @@ def command_line_interface():
     if args.VH is not None or args.VL is not None:
         if args.input is not None:
             raise ValueError("Cannot provide input file if VH or VL is given")
+    if args.shard is not None and args.input is None:
+        raise ValueError("--shard requires an input file")
+    if args.input_L is not None and args.input is None:
+        raise ValueError("--input_L requires a FASTA input file of heavy chains")
 
-    # get sequences
+    # get sequences - input files are read in chunks unless sharding, which balances shards over the whole input
     if args.verbose: print("Reading sequences")
     H_seqs, L_seqs = [args.VH] if args.VH else [], [args.VL] if args.VL else []
     vh_col, vl_col = args.vh_col, args.vl_col
-    if args.input: df = pd.read_csv(args.input); H_seqs.extend(df[vh_col].tolist() if vh_col in df.columns else []); L_seqs.extend(df[vl_col].tolist() if vl_col in df.columns else [])
-
-    # align
-    if args.verbose:
-        num_seq_info = "" if args.input is None else f" ({len(H_seqs)} VH, {len(L_seqs)} VL)"
-        print(f"Aligning sequences{num_seq_info}")
-    H_seqs = [get_padded_seq(strip_padding_from_seq(seq)) for seq in H_seqs]
-    L_seqs = [get_padded_seq(strip_padding_from_seq(seq)) for seq in L_seqs]
-
-    # identify if anarci failed on any sequences
-    num_failed_H = len([seq for seq in H_seqs if seq == "-"*len(CANONICAL_NUMBERING)])
-    num_failed_L = len([seq for seq in L_seqs if seq == "-"*len(CANONICAL_NUMBERING)])
-    if num_failed_H > 0 or num_failed_L > 0:
-        print(f"Warning: {num_failed_H} VH and {num_failed_L} VL sequences could not be numbered by ANARCI")
-
-    # save if output or input provided
-    out_path = args.output if args.output is not None else args.input.replace(".csv", "_Humatch_aligned.csv") if args.input is not None else None
+    # FASTA ids are saved with the output (csv/tsv rows are identified by order)
+    read_stats, ids = {}, None
+    if args.input is None or args.shard is not None:
+        if args.input: ids, H_seqs, L_seqs = read_input(args.input, vh_col, vl_col, paired_path=args.input_L, stats=read_stats)
+        input_rows, num_input_rows = list(range(max(len(H_seqs), len(L_seqs)))), max(len(H_seqs), len(L_seqs))
+        # keep only this shard's Fvs (balanced by predicted work)
+        if args.shard is not None:
+            H_seqs, L_seqs, input_rows, shard_idx, num_shards = select_shard(H_seqs, L_seqs, args.shard, aligned=False, humanise=False)
+            if args.verbose: print(f"Shard {shard_idx}/{num_shards}: {len(input_rows)}/{num_input_rows} Fvs")
+        chunks = (([ids[row] for row in input_rows[low_idx:low_idx+args.chunk_size]] if ids is not None else None,
+                   H_seqs[low_idx:low_idx+args.chunk_size], L_seqs[low_idx:low_idx+args.chunk_size])
+                  for low_idx in range(0, len(input_rows), args.chunk_size))
+    else:
+        chunks = iter_input_chunks(args.input, vh_col, vl_col, chunk_size=args.chunk_size, paired_path=args.input_L, stats=read_stats)
+    save_ids = args.input is not None and get_input_format(args.input) == "fasta"
+
+    # save if output or input provided - aligned chunks are appended to csv, or to .npy files of IMGT columns per chain
+    out_path = args.output if args.output is not None else get_default_output_path(args.input, "_Humatch_aligned.csv") if args.input is not None else None
+    columnar = out_path is not None and out_path.endswith(".npy")
+    if columnar and args.shard is not None:
+        raise ValueError("Sharded output must be csv")
     if out_path is not None:
         if args.verbose: print(f"Saving to {out_path}")
-        df_H, df_L = None, None
-        if len(H_seqs) > 0:
-            if args.imgt_cols:
-                df_H = pd.DataFrame([[AA for AA in seq] for seq in H_seqs], columns=[f"H_{imgt}" for imgt in CANONICAL_NUMBERING])
-            else:
-                df_H = pd.DataFrame({"VH": H_seqs})
-        if len(L_seqs) > 0:
-            if args.imgt_cols:
-                df_L = pd.DataFrame([[AA for AA in seq] for seq in L_seqs], columns=[f"L_{imgt}" for imgt in CANONICAL_NUMBERING])
+        out_paths = {chain: out_path.replace(".npy", f"_{chain}.npy") for chain in ["H", "L"]} if columnar else \
+                    {"csv": get_shard_path(out_path, shard_idx, num_shards) if args.shard is not None else out_path}
+        out_files = {key: open(path, "wb") for key, path in out_paths.items()}
+
+    # align chunk by chunk - memory is bounded by the chunk size
+    cpu_budget = configure_cpus(args.num_cpus, verbose=args.verbose)
+    num_seqs, num_failed = {"H": 0, "L": 0}, {"H": 0, "L": 0}
+    header_size = {}
+    for chunk_idx, (id_chunk, H_chunk, L_chunk) in enumerate(chunks):
+        chunk_rows = max(len(H_chunk), len(L_chunk))
+        row_offset = max(num_seqs.values())
+        chunk_input_rows = input_rows[row_offset:row_offset+chunk_rows] if args.shard is not None else list(range(row_offset, row_offset + chunk_rows))
+        if args.verbose: print(f"Aligning chunk {chunk_idx} ({len(H_chunk)} VH, {len(L_chunk)} VL)")
+        aligned_seqs = align_seqs(H_chunk + L_chunk, num_cpus=cpu_budget["align_workers"])
+        char_arrays = {chain: seqs_to_char_array(seqs) for chain, seqs in [("H", aligned_seqs[:len(H_chunk)]), ("L", aligned_seqs[len(H_chunk):])]
+                       if len(seqs) > 0}
+
+        # report sequences anarci failed on in this chunk (by input row)
+        failed_rows = {chain: [chunk_input_rows[idx] for idx in get_failed_idxs(char_array)] for chain, char_array in char_arrays.items()}
+        if sum(len(rows) for rows in failed_rows.values()) > 0:
+            print(f"Warning: chunk {chunk_idx} (rows {chunk_input_rows[0]}-{chunk_input_rows[-1]}) - " +
+                  ", ".join(f"V{chain} rows {rows}" for chain, rows in failed_rows.items() if len(rows) > 0) +
+                  " could not be numbered by ANARCI")
+        for chain, char_array in char_arrays.items():
+            num_seqs[chain] += len(char_array)
+            num_failed[chain] += len(failed_rows[chain])
+
+        if out_path is None:
+            # print output for single Fv if out path not provided
+            H = aligned_seqs[0] if len(H_chunk) > 0 else " "*len(CANONICAL_NUMBERING)
+            L = aligned_seqs[len(H_chunk)] if len(L_chunk) > 0 else " "*len(CANONICAL_NUMBERING)
+            for imgt, h_AA, l_AA in zip(CANONICAL_NUMBERING, H, L):
+                print(f"{imgt}\t{h_AA}\t{l_AA}")
+        elif columnar:
+            for chain, char_array in char_arrays.items():
+                if chain not in header_size: header_size[chain] = write_npy_header(out_files[chain], 0)
+                out_files[chain].write(char_array.tobytes())
+        else:
+            if chunk_idx == 0:
+                out_files["csv"].write(get_csv_header(list(char_arrays), imgt_cols=args.imgt_cols, row_col=ROW_COL if args.shard is not None else None,
+                                                      id_col="ID" if save_ids else None).encode())
+            out_files["csv"].write(char_arrays_to_csv_bytes(list(char_arrays.values()), imgt_cols=args.imgt_cols,
+                                                            row_idxs=chunk_input_rows if args.shard is not None else None,
+                                                            ids=id_chunk if save_ids else None))
+
+    if args.verbose and args.input is not None: print(format_read_stats(read_stats))
+    if num_failed["H"] > 0 or num_failed["L"] > 0:
+        print(f"Warning: {num_failed['H']} VH and {num_failed['L']} VL sequences could not be numbered by ANARCI")
+
+    # finish output files - the .npy headers are rewritten with the final number of rows
+    if out_path is not None:
+        for key, f in out_files.items():
+            if columnar:
+                if key in header_size and write_npy_header(f, num_seqs[key]) != header_size[key]:
+                    raise ValueError(f"Could not finalise {out_paths[key]}")
+                f.close()
+                if key not in header_size: os.remove(out_paths[key])
             else:
-                df_L = pd.DataFrame({"VL": L_seqs})
-        df_out = pd.concat([df_H, df_L], axis=1) if df_H is not None and df_L is not None else df_H if df_H is not None else df_L
-        df_out.to_csv(out_path, index=False)
-    # print output for single Fv if out path not provided
-    else:
-        H = H_seqs[0] if len(H_seqs) > 0 else " "*len(CANONICAL_NUMBERING)
-        L = L_seqs[0] if len(L_seqs) > 0 else " "*len(CANONICAL_NUMBERING)
-        for imgt, h_AA, l_AA in zip(CANONICAL_NUMBERING, H, L):
-            print(f"{imgt}\t{h_AA}\t{l_AA}")
+                f.close()
+        if args.shard is not None:
+            save_shard_manifest(out_path, shard_idx, num_shards, input_rows, num_input_rows)
@@ -0,0 +1,114 @@
+import os
+import numpy as np
+from collections import OrderedDict
+
+
+def get_model_id(model):
+    '''
+    Get an identifier for a model that is stable across runs (set by load_cnn from the weights file)
+    :param model: model e.g. trained CNN or BucketedPredictor
+    :returns: str model id
+    '''
+    return getattr(model, "humatch_id", None) or model.name
+
+
+class PredictionCache:
+    '''
+    Bounded LRU cache of CNN prediction vectors keyed by (model id, aligned sequence)
+    Sequences recur across a humanisation campaign (re-runs with tweaked configs, sibling antibodies
+    sharing chains, revisited designs) so only cache misses need to be sent to the CNN
+
+    :param max_size: int, max number of cached predictions - least recently used are evicted first
+    :param path: str, optional .npz file to load the cache from (if it exists) and save it to
+    :param parent: PredictionCache, optional cache consulted on misses before calling the CNN - hits and misses
+        of this cache then count only lookups made through it (e.g. by one humanise_sweep)
+    '''
+    def __init__(self, max_size=1000000, path=None, parent=None):
+        self.max_size = max_size
+        self.path = path
+        self.parent = parent
+        self.hits = 0
+        self.misses = 0
+        # unique missed sequences passed on to the CNN (or parent cache)
+        self.evaluations = 0
+        self._store = OrderedDict()
+        if path is not None and os.path.exists(path):
+            self.load(path)
+
+    def __len__(self):
+        return len(self._store)
+
+    def get(self, model_id, seq):
+        '''
+        Get a cached prediction
+        :returns: ndarray prediction vector, or None if not cached
+        '''
+        prediction = self._store.get((model_id, seq))
+        if prediction is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._store.move_to_end((model_id, seq))
+        return prediction
+
+    def put(self, model_id, seq, prediction):
+        '''
+        Add a prediction to the cache, evicting the least recently used if full
+        '''
+        self._store[(model_id, seq)] = np.array(prediction, dtype=np.float32)
+        self._store.move_to_end((model_id, seq))
+        while len(self._store) > self.max_size:
+            self._store.popitem(last=False)
+
+    def get_or_predict(self, model_id, seqs, predict_fn):
+        '''
+        Get predictions for a list of sequences, only calling predict_fn on (unique) cache misses
+
+        :param model_id: str, model id e.g. from get_model_id
+        :param seqs: list of str sequences
+        :param predict_fn: function, list of str sequences --> ndarray of predictions (# seqs, # classes)
+        :returns: ndarray of predictions (# seqs, # classes)
+        '''
+        predictions = [self.get(model_id, seq) for seq in seqs]
+        miss_seqs = list(dict.fromkeys(seq for seq, pred in zip(seqs, predictions) if pred is None))
+        if len(miss_seqs) > 0:
+            self.evaluations += len(miss_seqs)
+            miss_preds = predict_fn(miss_seqs) if self.parent is None else self.parent.get_or_predict(model_id, miss_seqs, predict_fn)
+            miss_preds = dict(zip(miss_seqs, np.asarray(miss_preds, dtype=np.float32)))
+            for seq, pred in miss_preds.items():
+                self.put(model_id, seq, pred)
+            predictions = [miss_preds[seq] if pred is None else pred for seq, pred in zip(seqs, predictions)]
+        return np.stack(predictions)
+
+    def get_stats(self):
+        '''
+        Get cache size and hit-rate statistics
+        :returns: dict of stats
+        '''
+        lookups = self.hits + self.misses
+        return {"size": len(self), "hits": self.hits, "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups > 0 else 0.0}
+
+    def save(self, path=None):
+        '''
+        Save the cache to an .npz file (one array of sequences and one of predictions per model)
+        :param path: str, defaults to the path given at construction
+        '''
+        path = self.path if path is None else path
+        model_ids = list(dict.fromkeys(model_id for model_id, _ in self._store))
+        arrays = {"model_ids": np.array(model_ids)}
+        for i, model_id in enumerate(model_ids):
+            keys = [key for key in self._store if key[0] == model_id]
+            arrays[f"seqs_{i}"] = np.array([seq for _, seq in keys])
+            arrays[f"preds_{i}"] = np.stack([self._store[key] for key in keys])
+        np.savez(path, **arrays)
+
+    def load(self, path):
+        '''
+        Load cached predictions from an .npz file saved with PredictionCache.save
+        :param path: str, path to .npz file
+        '''
+        with np.load(path) as arrays:
+            for i, model_id in enumerate(arrays["model_ids"]):
+                for seq, pred in zip(arrays[f"seqs_{i}"], arrays[f"preds_{i}"]):
+                    self.put(str(model_id), str(seq), pred)
@@ -2,39 +2,72 @@ import os
 import sys
 # supress warnings about having no GPU
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
-import tensorflow as tf
-import logging
-# suppress warnings about tf retracing
-tf.get_logger().setLevel('ERROR')
-logging.getLogger('tensorflow').setLevel(logging.ERROR)
 import numpy as np
 import pandas as pd
 import argparse
-from Humatch.utils import HEAVY_V_GENE_CLASSES, LIGHT_V_GENE_CLASSES, PAIRED_CLASSES, CANONICAL_NUMBERING
-from Humatch.dataset import CustomDataGenerator
-from Humatch.align import get_padded_seq, strip_padding_from_seq
-from Humatch.model import load_cnn, HEAVY_WEIGHTS, LIGHT_WEIGHTS, PAIRED_WEIGHTS
+from Humatch.utils import (HEAVY_V_GENE_CLASSES, LIGHT_V_GENE_CLASSES, PAIRED_CLASSES, CANONICAL_NUMBERING, KIDERA_ARRAY,
+                           configure_cpus, seq_strs_to_token_array)
+from Humatch.dataset import CustomDataGenerator, iter_prefetched_batches
+from Humatch.align import align_seqs
+from Humatch.shard import select_shard, save_shard, ROW_COL
+from Humatch.readers import iter_input_chunks, read_input, get_input_format, get_default_output_path, format_read_stats
+from Humatch.model import load_cnn, get_weights_path
+from Humatch.inference import BucketedPredictor, LookupConvPredictor, compile_cnn
+from Humatch.cache import get_model_id
+from Humatch.germline_likeness import get_germline_likeness_score_matrix
 
 PAD = "----------"
 ORDERED_COLS = ["VH", "VL"] + ["hv"] + HEAVY_V_GENE_CLASSES[1:] + ["lv"] + LIGHT_V_GENE_CLASSES[1:] + ["CNN_H", "CNN_L", "CNN_P"]
 
 
-def predict_from_list_of_seq_strs(list_of_seq_strs, model, batch_size=16384, CNN_verbose=0, num_cpus=None):
+def predict_from_list_of_seq_strs(list_of_seq_strs, model, batch_size=16384, CNN_verbose=0, num_cpus=None,
+                                  prefetch_depth=0, cache=None):
     '''
     Predict from a list of sequence strings using a model
     :param list_of_seq_strs: list of str sequences
-    :param model: model e.g. trained CNN
+    :param model: model e.g. trained CNN, or BucketedPredictor for the low-latency compiled path
     :param batch_size: int batch size for prediction
     :param CNN_verbose: int verbose level for CNN
     :param num_cpus: int number of cpus to use when encoding sequences
+    :param prefetch_depth: int number of encoded batches to prefetch while the CNN runs (0 = no prefetching)
+    :param cache: PredictionCache, if given only sequences missing from the cache are sent to the model
     :returns: ndarray of predictions (# seqs, # classes)
     '''
+    if cache is not None and len(list_of_seq_strs) > 0:
+        return cache.get_or_predict(get_model_id(model), list_of_seq_strs,
+                                    lambda seqs: predict_from_list_of_seq_strs(seqs, model, batch_size=batch_size, CNN_verbose=CNN_verbose,
+                                                                               num_cpus=num_cpus, prefetch_depth=prefetch_depth))
+    if isinstance(model, BucketedPredictor):
+        return model.predict_seqs(list_of_seq_strs)
+    if prefetch_depth > 0 and len(list_of_seq_strs) > 0:
+        return np.concatenate(list(iter_predictions_from_list_of_seq_strs(list_of_seq_strs, model, batch_size=batch_size,
+                                                                          num_cpus=num_cpus, prefetch_depth=prefetch_depth)), axis=0)
     test_generator = CustomDataGenerator(list_of_seq_strs, batch_size=batch_size, num_cpus=num_cpus)
     return model.predict(test_generator, verbose=CNN_verbose)
 
 
+def iter_predictions_from_list_of_seq_strs(list_of_seq_strs, model, batch_size=16384, num_cpus=None, prefetch_depth=2):
+    '''
+    Predict batch by batch, encoding batch i+1 in the background while the model runs on batch i
+    Predictions are yielded in the same order as the input sequences
+    :param list_of_seq_strs: list of str sequences
+    :param model: model e.g. trained CNN
+    :param batch_size: int batch size for prediction
+    :param num_cpus: int number of cpus to use when encoding sequences
+    :param prefetch_depth: int max number of encoded batches waiting for the CNN
+    :returns: generator of ndarrays of predictions (# batch seqs, # classes)
+    '''
+    if isinstance(model, BucketedPredictor):
+        for low_idx in range(0, len(list_of_seq_strs), batch_size):
+            yield model.predict_seqs(list_of_seq_strs[low_idx:low_idx+batch_size])
+        return
+    for X in iter_prefetched_batches(list_of_seq_strs, batch_size=batch_size, num_cpus=num_cpus,
+                                     prefetch_depth=prefetch_depth):
+        yield np.asarray(model.predict_on_batch(X))
+
+
 def get_predictions_for_target_class(list_of_seq_strs, model, target_class, classifier_type,
-                                     batch_size=16384, CNN_verbose=0, num_cpus=None):
+                                     batch_size=16384, CNN_verbose=0, num_cpus=None, cache=None):
     '''
     Get the prediction for a target class
     :param list_of_seq_strs: list of str sequences
@@ -44,10 +77,11 @@ def get_predictions_for_target_class(list_of_seq_strs, model, target_class, clas
     :param batch_size: int batch size for prediction
     :param CNN_verbose: int verbose level for CNN
     :param num_cpus: int number of cpus to use when encoding sequences
+    :param cache: PredictionCache, optional cache of previous predictions
     :returns: ndarray of predictions (# seqs,)
     '''
     predictions = predict_from_list_of_seq_strs(list_of_seq_strs, model, batch_size=batch_size,
-                                                CNN_verbose=CNN_verbose, num_cpus=num_cpus)
+                                                CNN_verbose=CNN_verbose, num_cpus=num_cpus, cache=cache)
     class_strs = HEAVY_V_GENE_CLASSES if classifier_type == "heavy" else LIGHT_V_GENE_CLASSES if classifier_type == "light" else PAIRED_CLASSES
     target_idx = class_strs.index(target_class)
     return predictions[:, target_idx]
@@ -55,12 +89,12 @@ def get_predictions_for_target_class(list_of_seq_strs, model, target_class, clas
 
 def get_idx_of_max_prob(predictions, exclude_neg_class=True):
     '''
-    Get the index of the maximum probability
+    Get the index of the maximum probability (predictions are left unchanged)
     :param predictions: ndarray of predictions
     :returns: ndarray of indices (# seqs,)
     '''
     if exclude_neg_class:
-        predictions[:, 0] = 0
+        return np.argmax(predictions[:, 1:], axis=1) + 1
     return np.argmax(predictions, axis=1)
 
 
@@ -81,9 +115,9 @@ def get_values_from_idxs(idxs, predictions):
     Get the values from the index
     :param idx: ndarray of indices
     :param predictions: ndarray of predictions
-    :returns: list of float values
+    :returns: ndarray of float values
     '''
-    return [predictions[i, idx] for i, idx in enumerate(idxs)]
+    return predictions[np.arange(len(idxs)), idxs]
 
 
 def get_class_and_score_of_max_predictions_only(predictions, classifier_type, exclude_neg_class=True):
@@ -100,6 +134,231 @@ def get_class_and_score_of_max_predictions_only(predictions, classifier_type, ex
     return list(zip(classes, values))
 
 
+def get_top_k_idxs(predictions, k=1, exclude_neg_class=True):
+    '''
+    Get the indices of the k highest probabilities (ties go to the lower index, as with argmax)
+    :param predictions: ndarray of predictions
+    :param k: int, number of classes to return
+    :param exclude_neg_class: bool, exclude the negative class
+    :returns: ndarray of indices (# seqs, k), highest probability first
+    '''
+    offset = 1 if exclude_neg_class else 0
+    return np.argsort(-predictions[:, offset:], axis=1, kind="stable")[:, :k] + offset
+
+
+def get_entropy(predictions):
+    '''
+    Get the entropy (nats) of each prediction over all classes - higher is less certain
+    :param predictions: ndarray of predictions
+    :returns: ndarray of entropies (# seqs,)
+    '''
+    return -np.sum(predictions * np.log(np.clip(predictions, 1e-12, 1)), axis=1)
+
+
+def summarise_predictions(predictions, classifier_type, top_k=1, threshold=None, uncertainty=False):
+    '''
+    Vectorised summary of a batch of predictions. For the heavy/light CNNs - the top-k human v-genes
+    and scores (negative class excluded), and for the paired CNN - the score of the true class
+
+    :param predictions: ndarray of predictions
+    :param classifier_type: str type of classifier heavy | light | paired
+    :param top_k: int, number of top v-genes to return
+    :param threshold: float, if given also call each sequence human if its (top) score >= threshold
+    :param uncertainty: bool, also return entropy and margin (top 1 - top 2 v-gene score)
+    :returns: dict of column name to ndarray (# seqs,) e.g. hv, CNN_H, hv_2, CNN_H_2, H_entropy, ...
+    '''
+    assert classifier_type in ["heavy", "light", "paired"], "classifier_type must be heavy | light | paired"
+    chain = {"heavy": "H", "light": "L", "paired": "P"}[classifier_type]
+    summary = {}
+    if classifier_type == "paired":
+        scores = predictions[:, PAIRED_CLASSES.index("true")]
+        summary["CNN_P"] = scores
+    else:
+        class_strs = np.array(HEAVY_V_GENE_CLASSES if classifier_type == "heavy" else LIGHT_V_GENE_CLASSES)
+        idxs = get_top_k_idxs(predictions, k=max(top_k, 2 if uncertainty else 1))
+        top_scores = np.take_along_axis(predictions, idxs, axis=1)
+        scores = top_scores[:, 0]
+        for rank in range(top_k):
+            suffix = "" if rank == 0 else f"_{rank+1}"
+            summary[f"{chain.lower()}v{suffix}"] = class_strs[idxs[:, rank]]
+            summary[f"CNN_{chain}{suffix}"] = top_scores[:, rank]
+        if uncertainty:
+            summary[f"{chain}_margin"] = top_scores[:, 0] - top_scores[:, 1]
+    if uncertainty:
+        summary[f"{chain}_entropy"] = get_entropy(predictions)
+    if threshold is not None:
+        summary[f"{chain}_human"] = scores >= threshold
+    return summary
+
+
+def summarise_from_list_of_seq_strs(list_of_seq_strs, model, classifier_type, batch_size=16384, num_cpus=None,
+                                    prefetch_depth=2, top_k=1, threshold=None, uncertainty=False):
+    '''
+    Predict and summarise batch by batch so that only the summaries, and never the full
+    matrix of predictions, are kept in memory
+
+    :param list_of_seq_strs: list of str sequences
+    :param model: model e.g. trained CNN, or BucketedPredictor
+    :param classifier_type: str type of classifier heavy | light | paired
+    :param batch_size: int batch size for prediction
+    :param num_cpus: int number of cpus to use when encoding sequences
+    :param prefetch_depth: int max number of encoded batches waiting for the CNN
+    :param top_k/threshold/uncertainty: see summarise_predictions
+    :returns: DataFrame of summaries (# seqs rows) and ndarray of counts of the top class of each sequence
+    '''
+    class_strs = HEAVY_V_GENE_CLASSES if classifier_type == "heavy" else LIGHT_V_GENE_CLASSES if classifier_type == "light" else PAIRED_CLASSES
+    summaries, class_counts = [], np.zeros(len(class_strs), dtype=int)
+    for predictions in iter_predictions_from_list_of_seq_strs(list_of_seq_strs, model, batch_size=batch_size,
+                                                              num_cpus=num_cpus, prefetch_depth=max(1, prefetch_depth)):
+        summaries.append(pd.DataFrame(summarise_predictions(predictions, classifier_type, top_k=top_k,
+                                                            threshold=threshold, uncertainty=uncertainty)))
+        top_idxs = get_idx_of_max_prob(predictions, exclude_neg_class=classifier_type != "paired")
+        class_counts += np.bincount(top_idxs, minlength=len(class_strs))
+    df_summary = pd.concat(summaries, ignore_index=True) if len(summaries) > 0 else pd.DataFrame()
+    return df_summary, class_counts
+
+
+def cascade_classify(H_seqs, L_seqs, cnn_heavy, cnn_light, cnn_paired, GL_nonhuman_below=None, GL_human_above=None,
+                     CNN_nonhuman_below=0.5, CNN_human_above=None, paired_human_above=0.5, batch_size=16384,
+                     num_cpus=None, prefetch_depth=2):
+    '''
+    Classify Fvs as human / non-human in stages of increasing cost, each stage only running on the
+    rows left undecided by the previous ones:
+        GL  - germline likeness of each chain to its closest V-gene (no CNNs)
+        CNN_H, CNN_L  - top human v-gene score of the heavy, then light, CNN (non-human calls)
+        CNN_HL - both chain CNN scores above CNN_human_above (human calls)
+        CNN_P - paired CNN score
+    A row is non-human as soon as any score falls below its nonhuman threshold, and human if both chains
+    are above a human threshold (or, at the final stage, the paired score is above paired_human_above)
+
+    :param H_seqs/L_seqs: list of str, aligned heavy/light sequences
+    :param cnn_heavy/light/paired: model e.g. trained CNN for heavy/light/paired chain
+    :param GL_nonhuman_below/GL_human_above: float, germline likeness thresholds (None to skip)
+    :param CNN_nonhuman_below/CNN_human_above: float, chain CNN thresholds (None to skip)
+    :param paired_human_above: float, paired CNN threshold deciding all remaining rows
+    :returns: DataFrame with the scores computed for each row (NaN if never needed), the human call and
+        the stage that decided it
+    '''
+    num_seqs = len(H_seqs)
+    no_scores = np.full(num_seqs, np.nan, dtype=np.float32)
+    df = pd.DataFrame({"VH": H_seqs, "VL": L_seqs, "hv": None, "lv": None, "CNN_H": no_scores, "CNN_L": no_scores.copy(),
+                       "CNN_P": no_scores.copy(), "Human": False, "Decided_by": None})
+    undecided = np.ones(num_seqs, dtype=bool)
+
+    def decide(mask, human, stage):
+        df.loc[mask, "Human"], df.loc[mask, "Decided_by"] = human, stage
+        undecided[mask] = False
+
+    # stage 1 - germline likeness gate
+    if GL_nonhuman_below is not None or GL_human_above is not None:
+        df["GL_H"] = get_germline_likeness_score_matrix(H_seqs, HEAVY_V_GENE_CLASSES[1:]).max(axis=1)
+        df["GL_L"] = get_germline_likeness_score_matrix(L_seqs, LIGHT_V_GENE_CLASSES[1:]).max(axis=1)
+        min_GL = np.minimum(df["GL_H"].to_numpy(), df["GL_L"].to_numpy())
+        if GL_nonhuman_below is not None:
+            decide(undecided & (min_GL < GL_nonhuman_below), False, "GL")
+        if GL_human_above is not None:
+            decide(undecided & (min_GL >= GL_human_above), True, "GL")
+
+    # stage 2 - chain CNNs, heavy then light
+    for seqs, cnn, classifier_type, chain in [(H_seqs, cnn_heavy, "heavy", "H"), (L_seqs, cnn_light, "light", "L")]:
+        idxs = np.flatnonzero(undecided)
+        if len(idxs) == 0: break
+        df_summary, _ = summarise_from_list_of_seq_strs([seqs[i] for i in idxs], cnn, classifier_type, batch_size=batch_size,
+                                                        num_cpus=num_cpus, prefetch_depth=prefetch_depth)
+        df.loc[idxs, f"{chain.lower()}v"] = df_summary[f"{chain.lower()}v"].to_numpy()
+        df.loc[idxs, f"CNN_{chain}"] = df_summary[f"CNN_{chain}"].to_numpy()
+        if CNN_nonhuman_below is not None:
+            decide(undecided & (df[f"CNN_{chain}"].to_numpy() < CNN_nonhuman_below), False, f"CNN_{chain}")
+    if CNN_human_above is not None:
+        decide(undecided & (np.minimum(df["CNN_H"].to_numpy(), df["CNN_L"].to_numpy()) >= CNN_human_above), True, "CNN_HL")
+
+    # stage 3 - paired CNN on the rest
+    idxs = np.flatnonzero(undecided)
+    if len(idxs) > 0:
+        df_summary, _ = summarise_from_list_of_seq_strs([H_seqs[i] + PAD + L_seqs[i] for i in idxs], cnn_paired, "paired",
+                                                        batch_size=batch_size, num_cpus=num_cpus, prefetch_depth=prefetch_depth)
+        df.loc[idxs, "CNN_P"] = df_summary["CNN_P"].to_numpy()
+        decide(undecided & (df["CNN_P"].to_numpy() >= paired_human_above), True, "CNN_P")
+        decide(undecided.copy(), False, "CNN_P")
+    return df
+
+
+def iter_pairing_screen_tiles(H_seqs, L_seqs, cnn_paired, block_size=16384):
+    '''
+    Paired CNN scores for every heavy x light combination, tile by tile
+    Each chain is tokenised once - the paired inputs of a tile of heavy x light chains are built by
+    repeating / tiling the chain token arrays around the pad and are only Kidera encoded per tile,
+    so the N x M paired sequence strings are never materialised
+
+    :param H_seqs/L_seqs: list of str, aligned heavy/light sequences
+    :param cnn_paired: model e.g. trained paired CNN, or BucketedPredictor
+    :param block_size: int, max number of pairs scored per CNN batch
+    :returns: generator of (heavy start idx, light start idx, ndarray of paired scores (# tile heavy, # tile light))
+    '''
+    H_tokens, L_tokens = seq_strs_to_token_array(H_seqs), seq_strs_to_token_array(L_seqs)
+    pad_tokens = seq_strs_to_token_array([PAD])
+    tile_L = max(1, min(len(L_seqs), block_size))
+    tile_H = max(1, block_size // tile_L)
+    model = cnn_paired.predict if isinstance(cnn_paired, BucketedPredictor) else cnn_paired.predict_on_batch
+    for H_low_idx in range(0, len(H_seqs), tile_H):
+        H_tile = H_tokens[H_low_idx:H_low_idx+tile_H]
+        for L_low_idx in range(0, len(L_seqs), tile_L):
+            L_tile = L_tokens[L_low_idx:L_low_idx+tile_L]
+            # pair (h, l) of the tile is row h * # tile light + l
+            tokens = np.concatenate([np.repeat(H_tile, len(L_tile), axis=0),
+                                     np.broadcast_to(pad_tokens, (len(H_tile) * len(L_tile), pad_tokens.shape[1])),
+                                     np.tile(L_tile, (len(H_tile), 1))], axis=1)
+            # lookup predictors take tokens directly, skipping the Kidera encoding
+            predictions = np.asarray(model(tokens if isinstance(cnn_paired, LookupConvPredictor) else KIDERA_ARRAY[tokens]))
+            yield H_low_idx, L_low_idx, predictions[:, PAIRED_CLASSES.index("true")].reshape(len(H_tile), len(L_tile))
+
+
+def pairing_screen(H_seqs, L_seqs, cnn_paired, block_size=16384, top_k=None, out_path=None):
+    '''
+    Paired CNN scores for every combination of N heavy and M light chains e.g. for chain shuffling
+
+    :param H_seqs/L_seqs: list of str, aligned heavy/light sequences
+    :param cnn_paired: model e.g. trained paired CNN, or BucketedPredictor
+    :param block_size: int, max number of pairs scored per CNN batch
+    :param top_k: int, if given only the top-k partners of each chain are kept (the N x M matrix is never stored)
+    :param out_path: str, optional .npy path to write the N x M matrix to as it is filled (memory mapped)
+    :returns: ndarray (N, M) of paired scores, or if top_k is given a DataFrame of the top-k partners of each
+        heavy and light chain (chain, idx, rank, partner idx and CNN_P)
+    '''
+    N, M = len(H_seqs), len(L_seqs)
+    if top_k is None:
+        scores = np.zeros((N, M), dtype=np.float32) if out_path is None else \
+                 np.lib.format.open_memmap(out_path, mode="w+", dtype=np.float32, shape=(N, M))
+        for H_low_idx, L_low_idx, tile in iter_pairing_screen_tiles(H_seqs, L_seqs, cnn_paired, block_size=block_size):
+            scores[H_low_idx:H_low_idx+tile.shape[0], L_low_idx:L_low_idx+tile.shape[1]] = tile
+        if out_path is not None:
+            scores.flush()
+        return scores
+
+    # running top-k partners - merged tile by tile
+    k_H, k_L = min(top_k, M), min(top_k, N)
+    top_scores_H, top_idxs_H = np.full((N, k_H), -np.inf, dtype=np.float32), np.zeros((N, k_H), dtype=int)
+    top_scores_L, top_idxs_L = np.full((M, k_L), -np.inf, dtype=np.float32), np.zeros((M, k_L), dtype=int)
+    for H_low_idx, L_low_idx, tile in iter_pairing_screen_tiles(H_seqs, L_seqs, cnn_paired, block_size=block_size):
+        H_rows = slice(H_low_idx, H_low_idx + tile.shape[0])
+        L_rows = slice(L_low_idx, L_low_idx + tile.shape[1])
+        for top_scores, top_idxs, rows, tile_scores, low_idx in [(top_scores_H, top_idxs_H, H_rows, tile, L_low_idx),
+                                                                 (top_scores_L, top_idxs_L, L_rows, tile.T, H_low_idx)]:
+            merged_scores = np.concatenate([top_scores[rows], tile_scores], axis=1)
+            merged_idxs = np.concatenate([top_idxs[rows], np.broadcast_to(np.arange(low_idx, low_idx + tile_scores.shape[1]),
+                                                                           tile_scores.shape)], axis=1)
+            keep = np.argsort(-merged_scores, axis=1, kind="stable")[:, :top_scores.shape[1]]
+            top_scores[rows] = np.take_along_axis(merged_scores, keep, axis=1)
+            top_idxs[rows] = np.take_along_axis(merged_idxs, keep, axis=1)
+
+    dfs = []
+    for chain, top_scores, top_idxs in [("H", top_scores_H, top_idxs_H), ("L", top_scores_L, top_idxs_L)]:
+        num_seqs, k = top_scores.shape
+        dfs.append(pd.DataFrame({"Chain": chain, "Idx": np.repeat(np.arange(num_seqs), k), "Rank": np.tile(np.arange(1, k + 1), num_seqs),
+                                 "Partner_idx": top_idxs.ravel(), "CNN_P": top_scores.ravel()}))
+    return pd.concat(dfs, ignore_index=True)
+
+
 def command_line_interface():
     description="""
     Humatch - Classify
@@ -111,11 +370,33 @@ def command_line_interface():
     parser = argparse.ArgumentParser(prog="Humatch-classify", description=description, formatter_class=argparse.RawDescriptionHelpFormatter)
     parser.add_argument("-H", "--VH", help="Heavy chain amino acid sequence", default=None)
     parser.add_argument("-L", "--VL", help="Light chain amino acid sequence", default=None)
-    parser.add_argument("-i", "--input", help="Path to csv with antibody sequences", default=None)
-    parser.add_argument("--vh_col", help="Column name for VH sequences in input file", default="VH")
-    parser.add_argument("--vl_col", help="Column name for VL sequences in input file", default="VL")
+    parser.add_argument("-i", "--input", help="Path to csv, tsv or FASTA with antibody sequences (optionally .gz or .zst compressed)", default=None)
+    parser.add_argument("--input_L", help="FASTA of light chains paired with the -i FASTA of heavy chains by id", default=None)
+    parser.add_argument("--vh_col", help="Column name for VH sequences in input file (id suffix of VH records in FASTA e.g. ab1_VH)", default="VH")
+    parser.add_argument("--vl_col", help="Column name for VL sequences in input file (id suffix of VL records in FASTA e.g. ab1_VL)", default="VL")
     parser.add_argument("-a", "--aligned", help="Input sequences are prealigned to 200 KASearch positions", default=False, action="store_true")
     parser.add_argument("-s", "--summarise", help="Output top predicted human v-gene only", default=False, action="store_true")
+    parser.add_argument("--top_k", help="Summarise - output the top-k human v-genes and scores", default=1, type=int)
+    parser.add_argument("--threshold", help="Summarise - also call each chain / pair human if its top score is >= threshold", default=None, type=float)
+    parser.add_argument("--uncertainty", help="Summarise - also output prediction entropy and top-2 v-gene margin", default=False, action="store_true")
+    parser.add_argument("--gene_counts", help="Summarise - also save counts of the top v-gene of each sequence (*_gene_counts.csv)", default=False, action="store_true")
+    parser.add_argument("--cascade", help="Cascade screening - human / non-human calls, running later (costlier) stages only on undecided rows", default=False, action="store_true")
+    parser.add_argument("--cascade_GL", help="Cascade - germline likeness non-human (below) and human (at or above) thresholds, 'none' to skip either", nargs=2, default=["none", "none"])
+    parser.add_argument("--cascade_CNN", help="Cascade - chain CNN non-human (below) and human (at or above) thresholds, 'none' to skip either", nargs=2, default=["0.5", "none"])
+    parser.add_argument("--cascade_paired", help="Cascade - paired CNN human threshold deciding all remaining rows", default=0.5, type=float)
+    parser.add_argument("--pairing_screen", help="Paired CNN scores for every VH x VL combination in the input, saved as an (# VH, # VL) .npy matrix "
+                        "(rows / columns are the non-missing VH / VL in input order)", default=False, action="store_true")
+    parser.add_argument("--pairing_top_k", help="Pairing screen - save the top-k partners of each chain to csv instead of the full matrix", default=None, type=int)
+    parser.add_argument("--germline_likeness", help="Also output germline likeness to each V-gene (top gene only if summarising)", default=False, action="store_true")
+    parser.add_argument("--chunk_size", help="Number of Fvs read, classified and written at a time (bounds memory for large inputs)", default=100000, type=int)
+    parser.add_argument("--batch_size", help="Number of sequences per CNN batch", default=16384, type=int)
+    parser.add_argument("--prefetch_depth", help="Number of encoded batches to prepare while the CNN runs (0 to disable)", default=2, type=int)
+    parser.add_argument("--num_cpus", help="Number of CPUs to use (defaults to all available)", default=None, type=int)
+    parser.add_argument("--compiled", help="Use the compiled, shape-bucketed prediction path", default=False, action="store_true")
+    parser.add_argument("--xla", help="XLA compile the CNNs (implies --compiled)", default=False, action="store_true")
+    parser.add_argument("--compressed_rank", help="Use low-rank compressed CNNs of this rank (see Humatch-compress)", default=None, type=int)
+    parser.add_argument("--lookup_first_layer", help="Run the first conv layer as table lookups on tokens (implies --compiled)", default=False, action="store_true")
+    parser.add_argument("--shard", help="Only process shard i of N of the input e.g. 0/8 (merge outputs with Humatch-merge)", default=None)
     parser.add_argument("-o", "--output", help="Output save path - defaults to the same dir as input", default=None)
     parser.add_argument("-v", "--verbose", help="Verbose output flag", default=False, action="store_true")
     args = parser.parse_args()
@@ -131,69 +412,213 @@ def command_line_interface():
     if args.VH is not None or args.VL is not None:
         if args.input is not None:
             raise ValueError("Cannot provide input file if VH or VL is given")
+    if args.shard is not None and args.input is None:
+        raise ValueError("--shard requires an input file")
+    if args.input_L is not None and args.input is None:
+        raise ValueError("--input_L requires a FASTA input file of heavy chains")
+    if args.cascade and (args.VH is None) != (args.VL is None):
+        raise ValueError("Cascade screening requires both VH and VL sequences")
+    if args.pairing_screen and (args.input is None or args.shard is not None or args.cascade):
+        raise ValueError("Pairing screen requires an input file and cannot be combined with --shard or --cascade")
 
-    # get sequences
+    # get sequences - input files are read in chunks unless sharding or pairing screening, which need the whole input
     H_seqs, L_seqs = [args.VH] if args.VH else [], [args.VL] if args.VL else []
     vh_col, vl_col = args.vh_col, args.vl_col
-    if args.input: df = pd.read_csv(args.input); H_seqs.extend(df[vh_col].tolist() if vh_col in df.columns else []); L_seqs.extend(df[vl_col].tolist() if vl_col in df.columns else [])
+    read_stats, ids = {}, None
+    stream_input = args.input is not None and args.shard is None and not args.pairing_screen
+    if args.input and not stream_input:
+        ids, H_seqs, L_seqs = read_input(args.input, vh_col, vl_col, paired_path=args.input_L, stats=read_stats)
+        if args.verbose: print(format_read_stats(read_stats))
+    # FASTA ids are saved with the output (csv/tsv rows are identified by order)
+    save_ids = args.input is not None and get_input_format(args.input) == "fasta"
+    # pairing screen - heavy and light chains are independent lists (e.g. of different lengths)
+    if args.pairing_screen:
+        if len(H_seqs) == 0 or len(L_seqs) == 0:
+            raise ValueError(f"Pairing screen requires both VH and VL sequences. Could not find columns '{vh_col}' and '{vl_col}' in input file")
+        H_rows, L_rows = [i for i, seq in enumerate(H_seqs) if isinstance(seq, str)], [i for i, seq in enumerate(L_seqs) if isinstance(seq, str)]
+        H_seqs, L_seqs = [H_seqs[i] for i in H_rows], [L_seqs[i] for i in L_rows]
+
+    # keep only this shard's Fvs (balanced by predicted work)
+    input_rows, num_input_rows = list(range(max(len(H_seqs), len(L_seqs)))), max(len(H_seqs), len(L_seqs))
+    if args.shard is not None:
+        H_seqs, L_seqs, input_rows, shard_idx, num_shards = select_shard(H_seqs, L_seqs, args.shard, aligned=False, humanise=False)
+        if args.verbose: print(f"Shard {shard_idx}/{num_shards}: {len(input_rows)}/{num_input_rows} Fvs")
+    chunks = iter_input_chunks(args.input, vh_col, vl_col, chunk_size=args.chunk_size, paired_path=args.input_L, stats=read_stats) \
+             if stream_input else [([ids[row] for row in input_rows] if ids is not None else None, H_seqs, L_seqs)]
 
-    # align
-    if not args.aligned:
+    cpu_budget = configure_cpus(args.num_cpus, verbose=args.verbose)
+    cnn_config = {"compile_CNNs": args.compiled or args.xla or args.lookup_first_layer, "XLA_compile": args.xla,
+                  "CNN_lookup_first_layer": args.lookup_first_layer}
+    # CNNs are loaded once and reused for every chunk
+    cnns = {}
+    def get_cnn(classifier_type):
+        if classifier_type not in cnns:
+            cnns[classifier_type] = compile_cnn(load_cnn(get_weights_path(classifier_type, args.compressed_rank), classifier_type), cnn_config)
+        return cnns[classifier_type]
+
+    def align_chunk(H_seqs, L_seqs):
+        if args.aligned:
+            return H_seqs, L_seqs
         if args.verbose:
             num_seq_info = "" if args.input is None else f" ({len(H_seqs)} VH, {len(L_seqs)} VL)"
             print(f"Aligning sequences{num_seq_info}")
-        H_seqs = [get_padded_seq(strip_padding_from_seq(seq)) for seq in H_seqs]
-        L_seqs = [get_padded_seq(strip_padding_from_seq(seq)) for seq in L_seqs]
+        aligned_seqs = align_seqs(H_seqs + L_seqs, num_cpus=cpu_budget["align_workers"])
+        return aligned_seqs[:len(H_seqs)], aligned_seqs[len(H_seqs):]
+
+    # pairing screen - every VH x VL combination is scored by the paired CNN in tiles built from each chain's encoding
+    if args.pairing_screen:
+        H_seqs, L_seqs = align_chunk(H_seqs, L_seqs)
+        num_failed_H = len([seq for seq in H_seqs if seq == "-"*len(CANONICAL_NUMBERING)])
+        num_failed_L = len([seq for seq in L_seqs if seq == "-"*len(CANONICAL_NUMBERING)])
+        if num_failed_H > 0 or num_failed_L > 0:
+            print(f"Warning: {num_failed_H} VH and {num_failed_L} VL sequences could not be numbered by ANARCI")
+        if args.verbose: print(f"Scoring {len(H_seqs)} x {len(L_seqs)} VH x VL pairings")
+        cnn_paired = get_cnn("paired")
+        out_path = args.output if args.output is not None else get_default_output_path(args.input, "_Humatch_pairing.csv")
+        if args.pairing_top_k is None:
+            out_path = os.path.splitext(out_path)[0] + ".npy"
+            scores = pairing_screen(H_seqs, L_seqs, cnn_paired, block_size=args.batch_size, out_path=out_path)
+            print(f"{(scores >= 0.5).sum()}/{scores.size} pairings with CNN_P >= 0.5")
+        else:
+            df_out = pairing_screen(H_seqs, L_seqs, cnn_paired, block_size=args.batch_size, top_k=args.pairing_top_k)
+            # report input rows rather than positions in the non-missing VH / VL lists
+            for chain, rows, partner_rows in [("H", H_rows, L_rows), ("L", L_rows, H_rows)]:
+                mask = df_out["Chain"] == chain
+                df_out.loc[mask, "Idx"] = np.array(rows)[df_out.loc[mask, "Idx"]]
+                df_out.loc[mask, "Partner_idx"] = np.array(partner_rows)[df_out.loc[mask, "Partner_idx"]]
+            df_out.to_csv(out_path, index=False)
+        if args.verbose: print(f"Saved to {out_path}")
+        return
+
+    # save if output or input provided - chunks are appended to the output csv
+    out_path = args.output if args.output is not None else get_default_output_path(args.input, "_Humatch_classified.csv") if args.input is not None else None
+    if out_path is not None and args.verbose: print(f"Saving to {out_path}")
+
+    # classify chunk by chunk - summaries, counts and cascade statistics are accumulated across chunks
+    num_failed_H, num_failed_L, num_rows = 0, 0, 0
+    gene_counts, num_human, cascade_stages, cascade_CNN_evals = {}, {}, {}, np.zeros(3, dtype=int)
+    for chunk_idx, (id_chunk, H_seqs, L_seqs) in enumerate(chunks):
+        chunk_rows = input_rows if not stream_input else list(range(num_rows, num_rows + max(len(H_seqs), len(L_seqs))))
+        num_rows += len(chunk_rows)
+        H_seqs, L_seqs = align_chunk(H_seqs, L_seqs)
 
-    # identify if anarci failed on any sequences
-    num_failed_H = len([seq for seq in H_seqs if seq == "-"*len(CANONICAL_NUMBERING)])
-    num_failed_L = len([seq for seq in L_seqs if seq == "-"*len(CANONICAL_NUMBERING)])
+        # identify if anarci failed on any sequences
+        num_failed_H += len([seq for seq in H_seqs if seq == "-"*len(CANONICAL_NUMBERING)])
+        num_failed_L += len([seq for seq in L_seqs if seq == "-"*len(CANONICAL_NUMBERING)])
+
+        # cascade screening - each stage only runs on the rows left undecided by earlier (cheaper) ones
+        if args.cascade:
+            if len(H_seqs) != len(L_seqs):
+                raise ValueError(f"Cascade screening requires both VH and VL sequences. Could not find columns '{vh_col}' and '{vl_col}' in input file")
+            thresholds = [None if str(val).lower() == "none" else float(val) for val in args.cascade_GL + args.cascade_CNN]
+            if args.verbose: print("Running cascade screen")
+            df_out = cascade_classify(H_seqs, L_seqs, get_cnn("heavy"), get_cnn("light"), get_cnn("paired"),
+                                      GL_nonhuman_below=thresholds[0], GL_human_above=thresholds[1], CNN_nonhuman_below=thresholds[2],
+                                      CNN_human_above=thresholds[3], paired_human_above=args.cascade_paired, batch_size=args.batch_size,
+                                      num_cpus=cpu_budget["encode_workers"], prefetch_depth=args.prefetch_depth)
+            cascade_CNN_evals += df_out[["CNN_H", "CNN_L", "CNN_P"]].notna().sum().to_numpy()
+            for stage, count in df_out["Decided_by"].value_counts().items():
+                cascade_stages[stage] = cascade_stages.get(stage, 0) + count
+            num_human["cascade"] = num_human.get("cascade", 0) + df_out["Human"].sum()
+        else:
+            # predict
+            if args.verbose: print("Getting CNN predictions")
+            predictions_heavy, predictions_light, predictions_paired = None, None, None
+            summaries = {}
+            paired_seqs = [H_seq + PAD + L_seq for H_seq, L_seq in zip(H_seqs, L_seqs)] if len(H_seqs) > 0 and len(L_seqs) > 0 else []
+            for seqs, classifier_type in [(H_seqs, "heavy"), (L_seqs, "light"), (paired_seqs, "paired")]:
+                if len(seqs) == 0: continue
+                cnn = get_cnn(classifier_type)
+                # summaries are reduced batch by batch as predictions are made
+                if args.summarise:
+                    summaries[classifier_type], counts = summarise_from_list_of_seq_strs(
+                        seqs, cnn, classifier_type, batch_size=args.batch_size, num_cpus=cpu_budget["encode_workers"],
+                        prefetch_depth=args.prefetch_depth, top_k=args.top_k, threshold=args.threshold, uncertainty=args.uncertainty)
+                    gene_counts[classifier_type] = gene_counts.get(classifier_type, 0) + counts
+                    continue
+                predictions = predict_from_list_of_seq_strs(seqs, cnn, batch_size=args.batch_size, num_cpus=cpu_budget["encode_workers"],
+                                                            prefetch_depth=args.prefetch_depth)
+                if classifier_type == "heavy": predictions_heavy = predictions
+                elif classifier_type == "light": predictions_light = predictions
+                else: predictions_paired = predictions
+
+            # output
+            df_out = pd.DataFrame()
+            if len(H_seqs) > 0:
+                df_out["VH"] = H_seqs
+                if args.summarise:
+                    df_out = pd.concat([df_out, summaries["heavy"]], axis=1)
+                else:
+                    df_out[HEAVY_V_GENE_CLASSES[1:]] = predictions_heavy[:, 1:]
+            if len(L_seqs) > 0:
+                df_out["VL"] = L_seqs
+                if args.summarise:
+                    df_out = pd.concat([df_out, summaries["light"]], axis=1)
+                else:
+                    df_out[LIGHT_V_GENE_CLASSES[1:]] = predictions_light[:, 1:]
+            if len(paired_seqs) > 0:
+                if args.summarise:
+                    df_out = pd.concat([df_out, summaries["paired"]], axis=1)
+                else:
+                    df_out["CNN_P"] = predictions_paired[:, 1:]
+
+            # germline likeness of each chain to all of its V-genes (a fast, CNN-free measure of humanness)
+            if args.germline_likeness:
+                if args.verbose: print("Getting germline likeness scores")
+                for seqs, chain, genes in [(H_seqs, "H", HEAVY_V_GENE_CLASSES[1:]), (L_seqs, "L", LIGHT_V_GENE_CLASSES[1:])]:
+                    if len(seqs) == 0: continue
+                    GL_scores = get_germline_likeness_score_matrix(seqs, genes)
+                    if args.summarise:
+                        df_out[f"GL_{chain.lower()}v"] = np.array(genes)[np.argmax(GL_scores, axis=1)]
+                        df_out[f"GL_{chain}"] = np.max(GL_scores, axis=1)
+                    else:
+                        df_out[[f"GL_{gene}" for gene in genes]] = GL_scores
+            for chain in ["H", "L", "P"]:
+                if f"{chain}_human" in df_out.columns:
+                    num_human[chain] = num_human.get(chain, 0) + df_out[f"{chain}_human"].sum()
+
+        # rearrange columns so that VH, VL are first if present, then hv, lv, CNN_H, CNN_L, CNN_P (then any extra summary columns)
+        present_ordered_cols = [col for col in ORDERED_COLS if col in df_out.columns]
+        df_out = df_out[present_ordered_cols + [col for col in df_out.columns if col not in present_ordered_cols]]
+        if save_ids:
+            df_out.insert(0, "ID", id_chunk)
+
+        if out_path is not None:
+            if args.shard is not None:
+                df_out.insert(0, ROW_COL, input_rows)
+                save_shard(df_out, out_path, shard_idx, num_shards, input_rows, num_input_rows)
+            else:
+                df_out.to_csv(out_path, index=False, mode="w" if chunk_idx == 0 else "a", header=chunk_idx == 0)
+    if out_path is not None and num_rows == 0:
+        pd.DataFrame().to_csv(out_path, index=False)
+    if stream_input and args.verbose: print(format_read_stats(read_stats))
     if num_failed_H > 0 or num_failed_L > 0:
         print(f"Warning: {num_failed_H} VH and {num_failed_L} VL sequences could not be numbered by ANARCI")
 
-    # predict
-    if args.verbose: print("Getting CNN predictions")
-    predictions_heavy, predictions_light, predictions_paired = None, None, None
-    if len(H_seqs) > 0:
-        predictions_heavy = predict_from_list_of_seq_strs(H_seqs, load_cnn(HEAVY_WEIGHTS, "heavy"))
-        top_heavy = get_class_and_score_of_max_predictions_only(predictions_heavy, "heavy") if args.summarise else None
-    if len(L_seqs) > 0:
-        predictions_light = predict_from_list_of_seq_strs(L_seqs, load_cnn(LIGHT_WEIGHTS, "light"))
-        top_light = get_class_and_score_of_max_predictions_only(predictions_light, "light") if args.summarise else None
-    if len(H_seqs) > 0 and len(L_seqs) > 0:
-        paired_seqs = [H_seq + PAD + L_seq for H_seq, L_seq in zip(H_seqs, L_seqs)]
-        predictions_paired = predict_from_list_of_seq_strs(paired_seqs, load_cnn(PAIRED_WEIGHTS, "paired"))
-
-    # output
-    df_out = pd.DataFrame()
-    if len(H_seqs) > 0:
-        df_out["VH"] = H_seqs
-        if top_heavy is not None:
-            df_out["hv"] = [class_str for class_str, _ in top_heavy]
-            df_out["CNN_H"] = [score for _, score in top_heavy]
-        else:
-            df_out[HEAVY_V_GENE_CLASSES[1:]] = predictions_heavy[:, 1:]
-    if len(L_seqs) > 0:
-        df_out["VL"] = L_seqs
-        if top_light is not None:
-            df_out["lv"] = [class_str for class_str, _ in top_light]
-            df_out["CNN_L"] = [score for _, score in top_light]
-        else:
-            df_out[LIGHT_V_GENE_CLASSES[1:]] = predictions_light[:, 1:]
-    if len(H_seqs) > 0 and len(L_seqs) > 0:
-        df_out["CNN_P"] = predictions_paired[:, 1:]
-
-    # rearrange columns so that VH, VL are first if present, then hv, lv, CNN_H, CNN_L, CNN_P
-    present_ordered_cols = [col for col in ORDERED_COLS if col in df_out.columns]
-    df_out = df_out[present_ordered_cols]
-
-    # save if output or input provided
-    out_path = args.output if args.output is not None else args.input.replace(".csv", "_Humatch_classified.csv") if args.input is not None else None
-    if out_path is not None:
-        if args.verbose: print(f"Saving to {out_path}")
-        df_out.to_csv(out_path, index=False)
+    # report cascade stages, human calls and per v-gene counts of the top predicted gene
+    if args.cascade and args.input is not None:
+        stage_counts = ", ".join(f"{stage}: {count}" for stage, count in sorted(cascade_stages.items(), key=lambda item: -item[1]))
+        print(f"Cascade decided rows by stage ({stage_counts}), {num_human.get('cascade', 0)}/{num_rows} human - "
+              f"CNN evaluations: {cascade_CNN_evals[0]} heavy, {cascade_CNN_evals[1]} light, {cascade_CNN_evals[2]} paired "
+              f"(vs {num_rows} each)")
+    if args.summarise and not args.cascade:
+        df_counts = pd.DataFrame([{"chain": classifier_type, "class": class_str, "count": count}
+                                  for classifier_type, counts in gene_counts.items()
+                                  for class_str, count in zip(HEAVY_V_GENE_CLASSES if classifier_type == "heavy" else LIGHT_V_GENE_CLASSES
+                                                              if classifier_type == "light" else PAIRED_CLASSES, counts)
+                                  if classifier_type == "paired" or class_str != "neg"])
+        if args.verbose:
+            print("Top class counts:")
+            print(df_counts[df_counts["count"] > 0].to_string(index=False))
+        if args.threshold is not None and args.input is not None:
+            for chain in ["H", "L", "P"]:
+                if chain in num_human:
+                    print(f"{num_human[chain]}/{num_rows} {chain} scores >= {args.threshold}")
+        if out_path is not None and args.gene_counts:
+            df_counts.to_csv(out_path.replace(".csv", "") + "_gene_counts.csv", index=False)
+
     # print output for single Fv if out path not provided
-    else:
+    if out_path is None:
         for col, val in df_out.iloc[0].items():
             if col in ["VH", "VL"]: continue
             val = f"{val:.3f}" if isinstance(val, np.float32) else val
@@ -0,0 +1,280 @@
+import os
+import sys
+import time
+import numpy as np
+import pandas as pd
+import argparse
+import multiprocessing as mp
+
+from Humatch.utils import seq_strs_to_token_array, get_available_cpus, KIDERA_AA_CODES
+from Humatch.readers import read_input, get_input_format, get_default_output_path, format_read_stats
+
+PAD = "----------"
+NUM_BIT_PLANES = int(np.ceil(np.log2(len(KIDERA_AA_CODES))))   # 5 bits per residue token
+
+
+def pack_seqs(seq_strs):
+    '''
+    Pack aligned sequences into bit planes - bit k of each residue token is stored in plane k with one bit
+    per position (64 positions per uint64 word). Two residues differ if they differ in any plane, so the
+    Hamming distance of two sequences is the popcount of the OR over planes of their XORs
+
+    :param seq_strs: list of str, aligned sequences (all the same length) e.g. VH + VL
+    :returns: ndarray of uint64 (# planes, # seqs, # words)
+    '''
+    tokens = seq_strs_to_token_array(seq_strs)
+    num_seqs, seq_len = tokens.shape
+    num_words = (seq_len + 63) // 64
+    bits = np.zeros((NUM_BIT_PLANES, num_seqs, num_words * 64), dtype=np.uint8)
+    for plane in range(NUM_BIT_PLANES):
+        bits[plane, :, :seq_len] = (tokens >> plane) & 1
+    # little-endian bit order within each byte, bytes within each word
+    return np.packbits(bits, axis=2, bitorder="little").view(np.uint64).reshape(NUM_BIT_PLANES, num_seqs, num_words)
+
+
+def popcount(arr):
+    '''
+    Number of set bits in each element of a uint64 array
+    '''
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(arr)
+    return np.unpackbits(arr.view(np.uint8).reshape(arr.shape + (8,)), axis=-1).sum(axis=-1)
+
+
+def get_hamming_distances(packed_A, packed_B):
+    '''
+    All-pairs Hamming distances between two sets of packed sequences (see pack_seqs)
+    :returns: ndarray of int (# seqs A, # seqs B)
+    '''
+    mismatches = np.zeros((packed_A.shape[1], packed_B.shape[1], packed_A.shape[2]), dtype=np.uint64)
+    for plane_A, plane_B in zip(packed_A, packed_B):
+        mismatches |= plane_A[:, None, :] ^ plane_B[None, :, :]
+    return popcount(mismatches).sum(axis=2, dtype=np.int32)
+
+
+def get_paired_hamming_distances(packed_A, packed_B):
+    '''
+    Hamming distances between packed sequences A[i] and B[i]
+    :returns: ndarray of int (# seqs,)
+    '''
+    mismatches = np.zeros(packed_A.shape[1:], dtype=np.uint64)
+    for plane_A, plane_B in zip(packed_A, packed_B):
+        mismatches |= plane_A ^ plane_B
+    return popcount(mismatches).sum(axis=1, dtype=np.int32)
+
+
+def get_block_pairs(num_seqs, block_size):
+    '''
+    Upper triangle (including the diagonal) of row x column blocks
+    :returns: list of tuple of (row start idx, column start idx)
+    '''
+    starts = range(0, num_seqs, block_size)
+    return [(row_start, col_start) for row_start in starts for col_start in starts if col_start >= row_start]
+
+
+_worker_packed = None
+
+
+def _init_worker(packed):
+    '''
+    Share the packed sequences with each worker once rather than with every block
+    '''
+    global _worker_packed
+    _worker_packed = packed
+
+
+def _get_block_neighbours(args):
+    '''
+    Pairs (i < j) within radius in one block of the all-pairs distance matrix
+    '''
+    row_start, col_start, block_size, radius = args
+    block_A = _worker_packed[:, row_start:row_start+block_size]
+    block_B = _worker_packed[:, col_start:col_start+block_size]
+    distances = get_hamming_distances(block_A, block_B)
+    rows, cols = np.nonzero(distances <= radius)
+    rows, cols = rows + row_start, cols + col_start
+    keep = rows < cols
+    return rows[keep], cols[keep], distances[rows[keep] - row_start, cols[keep] - col_start]
+
+
+def get_radius_neighbours(packed, radius, block_size=512, num_cpus=1):
+    '''
+    All pairs of sequences within a Hamming radius, computed over blocks of the upper triangle of the
+    distance matrix (only one block of distances is held in memory per worker)
+
+    :param packed: ndarray, packed sequences (see pack_seqs)
+    :param radius: int, max Hamming distance
+    :param block_size: int, sequences per block (memory ~ block_size^2 x # words x 8 bytes per worker)
+    :param num_cpus: int, number of worker processes
+    :returns: ndarrays of int, i, j (i < j) and distance of each neighbouring pair
+    '''
+    tasks = [(row_start, col_start, block_size, radius) for row_start, col_start in get_block_pairs(packed.shape[1], block_size)]
+    if num_cpus is None or num_cpus <= 1 or len(tasks) <= 1:
+        _init_worker(packed)
+        results = [_get_block_neighbours(task) for task in tasks]
+    else:
+        with mp.Pool(min(num_cpus, len(tasks)), initializer=_init_worker, initargs=(packed,)) as pool:
+            results = pool.map(_get_block_neighbours, tasks, chunksize=max(1, len(tasks) // (4 * num_cpus)))
+    if len(results) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int32)
+    return tuple(np.concatenate(arrs) for arrs in zip(*results))
+
+
+def get_distance_matrix(packed, block_size=512, out_path=None):
+    '''
+    Full all-pairs Hamming distance matrix, filled block by block
+
+    :param out_path: str, optional .npy path - the matrix is written to a memory map instead of held in memory
+    :returns: ndarray of uint16 (# seqs, # seqs)
+    '''
+    num_seqs = packed.shape[1]
+    if out_path is None:
+        matrix = np.zeros((num_seqs, num_seqs), dtype=np.uint16)
+    else:
+        matrix = np.lib.format.open_memmap(out_path, mode="w+", dtype=np.uint16, shape=(num_seqs, num_seqs))
+    for row_start, col_start in get_block_pairs(num_seqs, block_size):
+        distances = get_hamming_distances(packed[:, row_start:row_start+block_size], packed[:, col_start:col_start+block_size])
+        matrix[row_start:row_start+len(distances), col_start:col_start+distances.shape[1]] = distances
+        matrix[col_start:col_start+distances.shape[1], row_start:row_start+len(distances)] = distances.T
+    return matrix
+
+
+def find_root(parents, i):
+    '''
+    Root of i in a union-find forest (with path halving)
+    '''
+    while parents[i] != i:
+        parents[i] = parents[parents[i]]
+        i = parents[i]
+    return i
+
+
+def get_clusters(num_seqs, pairs_i, pairs_j):
+    '''
+    Single-linkage clusters - connected components of the neighbour graph - with union-find
+
+    :param num_seqs: int, number of sequences
+    :param pairs_i/pairs_j: array of int, neighbouring pairs
+    :returns: ndarray of int, cluster of each sequence numbered in order of first member
+    '''
+    parents = list(range(num_seqs))
+    for i, j in zip(pairs_i.tolist(), pairs_j.tolist()):
+        root_i, root_j = find_root(parents, i), find_root(parents, j)
+        if root_i != root_j:
+            parents[max(root_i, root_j)] = min(root_i, root_j)
+    roots = np.array([find_root(parents, i) for i in range(num_seqs)], dtype=np.int64)
+    _, first_idxs, labels = np.unique(roots, return_index=True, return_inverse=True)
+    # renumber clusters by first member
+    return np.argsort(np.argsort(first_idxs))[labels.ravel()]
+
+
+def get_representatives(labels, pairs_i, pairs_j):
+    '''
+    Representative of each cluster - the member with most neighbours (ties to the first member)
+    :returns: ndarray of int, representative index of each cluster
+    '''
+    degrees = np.bincount(np.concatenate([pairs_i, pairs_j]), minlength=len(labels))
+    order = np.lexsort((np.arange(len(labels)), -degrees, labels))
+    # first sorted member of each cluster
+    is_first = np.ones(len(order), dtype=bool)
+    is_first[1:] = labels[order[1:]] != labels[order[:-1]]
+    return order[is_first]
+
+
+def cluster_seqs(seq_strs, radius=3, block_size=512, num_cpus=1):
+    '''
+    Cluster aligned sequences (e.g. VH + pad + VL) by Hamming distance - sequences within radius are linked
+    and clusters are the connected components (single linkage)
+
+    :param seq_strs: list of str, aligned sequences (all the same length)
+    :param radius: int, max Hamming distance between linked sequences
+    :param block_size: int, sequences per block of distances
+    :param num_cpus: int, number of worker processes
+    :returns: DataFrame with the Cluster of each sequence, its Representative index, Distance_to_rep, Cluster_size
+        and Num_neighbours, and a dict of stats (seconds packing, finding neighbours and clustering, # neighbour pairs)
+    '''
+    start = time.time()
+    packed = pack_seqs(seq_strs)
+    pack_seconds = time.time() - start
+    pairs_i, pairs_j, _ = get_radius_neighbours(packed, radius, block_size=block_size, num_cpus=num_cpus)
+    neighbour_seconds = time.time() - start - pack_seconds
+    labels = get_clusters(len(seq_strs), pairs_i, pairs_j)
+    representatives = get_representatives(labels, pairs_i, pairs_j)
+    rep_idxs = representatives[labels]
+    df = pd.DataFrame({"Cluster": labels, "Representative": rep_idxs,
+                       "Distance_to_rep": get_paired_hamming_distances(packed, packed[:, rep_idxs]),
+                       "Cluster_size": np.bincount(labels)[labels],
+                       "Num_neighbours": np.bincount(np.concatenate([pairs_i, pairs_j]), minlength=len(labels))})
+    stats = {"pack_seconds": pack_seconds, "neighbour_seconds": neighbour_seconds,
+             "cluster_seconds": time.time() - start - pack_seconds - neighbour_seconds, "neighbour_pairs": len(pairs_i)}
+    return df, stats
+
+
+def command_line_interface():
+    description="""
+    Humatch - Cluster
+                                       QVQ-LVQSGA...  \\
+    Author: Lewis Chinery              QVQ-LVESGA...  --> cluster 0
+    Supervisor: Charlotte M. Deane     QVQ-LVQSGG...  /
+    Contact: opig@stats.ox.ac.uk
+    """
+    parser = argparse.ArgumentParser(prog="Humatch-cluster", description=description, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-i", "--input", help="Path to csv, tsv or FASTA with antibody sequences (e.g. Humatch-humanise output)", default=None)
+    parser.add_argument("--input_L", help="FASTA of light chains paired with the -i FASTA of heavy chains by id", default=None)
+    parser.add_argument("--vh_col", help="Column name for VH sequences in input file e.g. Humatch_H for humanised designs", default="VH")
+    parser.add_argument("--vl_col", help="Column name for VL sequences in input file e.g. Humatch_L for humanised designs", default="VL")
+    parser.add_argument("-a", "--aligned", help="Input sequences are prealigned to 200 KASearch positions", default=False, action="store_true")
+    parser.add_argument("-r", "--radius", help="Max Hamming distance (over VH and VL) between linked sequences", default=3, type=int)
+    parser.add_argument("--block_size", help="Number of sequences per block of pairwise distances", default=512, type=int)
+    parser.add_argument("--distance_matrix", help="Also save the full (# seqs, # seqs) distance matrix to this .npy path", default=None)
+    parser.add_argument("--num_cpus", help="Number of CPUs to use (defaults to all available)", default=None, type=int)
+    parser.add_argument("-o", "--output", help="Output save path - defaults to the same dir as input. Representatives are saved "
+                        "alongside (*_representatives.csv)", default=None)
+    parser.add_argument("-v", "--verbose", help="Verbose output flag", default=False, action="store_true")
+    args = parser.parse_args()
+
+    # show help menu if no options given
+    if len(sys.argv) <= 1:
+        parser.print_help()
+        sys.exit(0)
+    if args.input is None:
+        raise ValueError("Must provide input file")
+
+    # get sequences - clustering is over VH + VL if both are present, otherwise the chain given
+    read_stats = {}
+    ids, H_seqs, L_seqs = read_input(args.input, args.vh_col, args.vl_col, paired_path=args.input_L, stats=read_stats)
+    if args.verbose: print(format_read_stats(read_stats))
+    if len(H_seqs) == 0 and len(L_seqs) == 0:
+        raise ValueError(f"Could not find columns '{args.vh_col}' or '{args.vl_col}' in input file")
+    num_cpus = get_available_cpus() if args.num_cpus is None else max(1, min(args.num_cpus, get_available_cpus()))
+    if not args.aligned:
+        from Humatch.align import align_seqs
+        if args.verbose: print(f"Aligning sequences ({len(H_seqs)} VH, {len(L_seqs)} VL)")
+        aligned_seqs = align_seqs(H_seqs + L_seqs, num_cpus=num_cpus)
+        H_seqs, L_seqs = aligned_seqs[:len(H_seqs)], aligned_seqs[len(H_seqs):]
+    num_failed = len([seq for seq in H_seqs + L_seqs if set(seq) == {"-"}])
+    if num_failed > 0:
+        print(f"Warning: {num_failed} sequences could not be numbered by ANARCI (these are all padding and cluster together)")
+    seqs = [H + PAD + L for H, L in zip(H_seqs, L_seqs)] if len(H_seqs) > 0 and len(L_seqs) > 0 else H_seqs + L_seqs
+
+    # cluster
+    if args.verbose: print(f"Clustering {len(seqs)} sequences within Hamming radius {args.radius} using {num_cpus} CPUs")
+    df_clusters, stats = cluster_seqs(seqs, radius=args.radius, block_size=args.block_size, num_cpus=num_cpus)
+    num_pairs = len(seqs) * (len(seqs) - 1) // 2
+    print(f"{df_clusters['Cluster'].nunique()} clusters from {len(seqs)} sequences ({stats['neighbour_pairs']} linked pairs) - "
+          f"{num_pairs / max(stats['neighbour_seconds'], 1e-9):.3g} pairwise distances/s")
+    if args.distance_matrix is not None:
+        if args.verbose: print(f"Saving distance matrix to {args.distance_matrix}")
+        get_distance_matrix(pack_seqs(seqs), block_size=args.block_size, out_path=args.distance_matrix)
+
+    # save cluster assignments (in input order) and one representative per cluster e.g. for deduplicated scoring
+    # FASTA ids are saved with the output (csv/tsv rows are identified by order, as are representatives)
+    df_out = pd.DataFrame({"ID": ids} if get_input_format(args.input) == "fasta" else {})
+    if len(H_seqs) > 0: df_out[args.vh_col] = H_seqs
+    if len(L_seqs) > 0: df_out[args.vl_col] = L_seqs
+    df_out = pd.concat([df_out, df_clusters], axis=1)
+    out_path = args.output if args.output is not None else get_default_output_path(args.input, "_Humatch_clusters.csv")
+    rep_path = os.path.splitext(out_path)[0] + "_representatives.csv"
+    if args.verbose: print(f"Saving to {out_path} and {rep_path}")
+    df_out.to_csv(out_path, index=False)
+    df_out[df_out["Representative"] == np.arange(len(df_out))].to_csv(rep_path, index=False)
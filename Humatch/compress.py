@@ -0,0 +1,200 @@
+import os
+import sys
+# supress warnings about having no GPU
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+import tensorflow as tf
+import time
+import numpy as np
+import pandas as pd
+import argparse
+
+from Humatch.align import align_seqs
+from Humatch.model import load_cnn, create_cnn, get_weights_path, get_low_rank_params, PARAMS
+from Humatch.readers import read_input, get_default_output_path
+from Humatch.utils import seq_strs_to_kidera_array, configure_cpus, CANONICAL_NUMBERING
+
+PAD = "----------"
+
+
+def get_dense_idx(model):
+    '''
+    Index of the first Dense layer (after Flatten) in model.layers - the layer holding most weights and FLOPs
+    '''
+    for i, layer in enumerate(model.layers):
+        if isinstance(layer, tf.keras.layers.Dense):
+            return i
+    raise ValueError("Model has no Dense layer")
+
+
+def get_dense_svd(model):
+    '''
+    Singular value decomposition of the first Dense layer's kernel (# inputs, # units)
+    :returns: U (# inputs, k), singular values (k,), V^T (k, # units) with k = min(# inputs, # units)
+    '''
+    kernel = model.layers[get_dense_idx(model)].get_weights()[0]
+    return np.linalg.svd(kernel.astype(np.float64), full_matrices=False)
+
+
+def compress_cnn(model, rank, params=PARAMS, svd=None):
+    '''
+    Factorise the first Dense layer of a CNN with a truncated SVD, kernel ~= (U_r S_r) V_r^T, into a
+    linear projection to rank dims (no bias) followed by the dense layer (bias and activation unchanged)
+
+    :param model: keras model e.g. output of load_cnn
+    :param rank: int, number of singular values kept
+    :param params: list, params the model was built with (see create_cnn)
+    :param svd: optional output of get_dense_svd (to reuse across ranks)
+    :returns: keras model built with DENSE_LR params
+    '''
+    U, S, Vt = get_dense_svd(model) if svd is None else svd
+    if not 0 < rank < len(S):
+        raise ValueError(f"Rank must be in (0, {len(S)}) - got {rank}")
+    compressed = create_cnn(get_low_rank_params(rank, params), model.input_shape[1:], 'relu', None, out_dim=model.output_shape[-1])
+    dense_idx = get_dense_idx(model)
+    weights = []
+    for i, layer in enumerate(model.layers):
+        if i == dense_idx:
+            weights.extend([(U[:, :rank] * S[:rank]).astype(np.float32), Vt[:rank].astype(np.float32), layer.get_weights()[1]])
+        else:
+            weights.extend(layer.get_weights())
+    compressed.set_weights(weights)
+    compressed.humatch_id = f"{getattr(model, 'humatch_id', model.name)}-rank{rank}"
+    return compressed
+
+
+def save_compressed_cnn(model, cnn_type, rank, out_dir=None):
+    '''
+    Save compressed weights to e.g. trained_models/paired.rank32.weights.h5 so they can be loaded with load_cnn
+    :param out_dir: str, optional directory (defaults to the trained models dir)
+    :returns: str, path weights were saved to
+    '''
+    path = get_weights_path(cnn_type, rank)
+    if out_dir is not None:
+        os.makedirs(out_dir, exist_ok=True)
+        path = os.path.join(out_dir, os.path.basename(path))
+    model.save_weights(path)
+    return path
+
+
+def predict_in_batches(model, X, batch_size=512):
+    '''
+    Predictions of a keras model for Kidera encoded X in batches
+    '''
+    return np.concatenate([np.asarray(model.predict_on_batch(X[low_idx:low_idx+batch_size])) for low_idx in range(0, len(X), batch_size)])
+
+
+def get_throughput(model, X, batch_size=512, num_repeats=3):
+    '''
+    Prediction throughput (seqs/s, best of num_repeats after one untimed warm up pass) of a keras model
+    '''
+    best_seconds = np.inf
+    for repeat in range(num_repeats + 1):
+        start = time.time()
+        for low_idx in range(0, len(X), batch_size):
+            model.predict_on_batch(X[low_idx:low_idx+batch_size])
+        if repeat > 0:
+            best_seconds = min(best_seconds, time.time() - start)
+    return len(X) / best_seconds
+
+
+def compare_ranks(model, seq_strs, ranks, params=PARAMS, batch_size=512, num_repeats=3):
+    '''
+    Accuracy and throughput of low-rank compressed CNNs relative to the full model on a reference set
+
+    :param model: keras model e.g. output of load_cnn
+    :param seq_strs: list of str, aligned reference sequences for the model
+    :param ranks: list of int, ranks to compare
+    :returns: DataFrame with a row for the full model and each rank - Dense layer params, weight MB, fraction of
+        squared singular values kept (Energy), max/mean abs prediction difference, top class agreement and throughput
+    '''
+    X = seq_strs_to_kidera_array(seq_strs)
+    svd = get_dense_svd(model)
+    full_predictions = predict_in_batches(model, X, batch_size)
+    full_throughput = get_throughput(model, X, batch_size, num_repeats)
+    dense_idx = get_dense_idx(model)
+    rows = [{"Rank": "full", "Dense_params": int(sum(w.size for w in model.layers[dense_idx].get_weights())),
+             "Weight_MB": sum(w.nbytes for w in model.get_weights()) / 1e6, "Energy": 1.0, "Max_abs_diff": 0.0,
+             "Mean_abs_diff": 0.0, "Agreement": 1.0, "Seqs_per_s": full_throughput, "Speedup": 1.0}]
+    for rank in ranks:
+        compressed = compress_cnn(model, rank, params, svd)
+        predictions = predict_in_batches(compressed, X, batch_size)
+        throughput = get_throughput(compressed, X, batch_size, num_repeats)
+        diffs = np.abs(predictions - full_predictions)
+        rows.append({"Rank": rank,
+                     "Dense_params": int(sum(w.size for layer in compressed.layers[dense_idx:dense_idx+2] for w in layer.get_weights())),
+                     "Weight_MB": sum(w.nbytes for w in compressed.get_weights()) / 1e6,
+                     "Energy": float((svd[1][:rank] ** 2).sum() / (svd[1] ** 2).sum()),
+                     "Max_abs_diff": float(diffs.max()), "Mean_abs_diff": float(diffs.mean()),
+                     "Agreement": float((predictions.argmax(axis=1) == full_predictions.argmax(axis=1)).mean()),
+                     "Seqs_per_s": throughput, "Speedup": throughput / full_throughput})
+    return pd.DataFrame(rows)
+
+
+def command_line_interface():
+    description="""
+    Humatch - Compress
+                                      Dense(300)  -->  Dense(r) -> Dense(300)
+    Author: Lewis Chinery
+    Supervisor: Charlotte M. Deane
+    Contact: opig@stats.ox.ac.uk
+    """
+    parser = argparse.ArgumentParser(prog="Humatch-compress", description=description, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-i", "--input", help="Reference csv, tsv or FASTA of antibody sequences to compare ranks on", default=None)
+    parser.add_argument("--input_L", help="FASTA of light chains paired with the -i FASTA of heavy chains by id", default=None)
+    parser.add_argument("--vh_col", help="Column name for VH sequences in input file", default="VH")
+    parser.add_argument("--vl_col", help="Column name for VL sequences in input file", default="VL")
+    parser.add_argument("-a", "--aligned", help="Input sequences are prealigned to 200 KASearch positions", default=False, action="store_true")
+    parser.add_argument("--ranks", help="Ranks to compare", default=[8, 16, 32, 64, 128], type=int, nargs="+")
+    parser.add_argument("--save", help="Ranks to save compressed heavy, light and paired weights for (load with load_cnn or --compressed_rank)",
+                        default=[], type=int, nargs="+")
+    parser.add_argument("--cnn_types", help="CNNs to compress", default=["heavy", "light", "paired"], nargs="+", choices=["heavy", "light", "paired"])
+    parser.add_argument("--batch_size", help="Number of sequences per CNN batch when timing", default=512, type=int)
+    parser.add_argument("--num_cpus", help="Number of CPUs to use (defaults to all available)", default=None, type=int)
+    parser.add_argument("--out_dir", help="Directory to save compressed weights - defaults to the trained models dir", default=None)
+    parser.add_argument("-o", "--output", help="Rank comparison csv save path - defaults to the same dir as input", default=None)
+    parser.add_argument("-v", "--verbose", help="Verbose output flag", default=False, action="store_true")
+    args = parser.parse_args()
+
+    # show help menu if no options given
+    if len(sys.argv) <= 1:
+        parser.print_help()
+        sys.exit(0)
+    if args.input is None and len(args.save) == 0:
+        raise ValueError("Must provide a reference input file to compare ranks and/or ranks to --save")
+
+    # reference sequences - heavy and light chains for their CNNs, and pairs for the paired CNN
+    cpu_budget = configure_cpus(args.num_cpus, verbose=args.verbose)
+    if args.input is not None:
+        _, H_seqs, L_seqs = read_input(args.input, args.vh_col, args.vl_col, paired_path=args.input_L)
+        if len(H_seqs) == 0 or len(L_seqs) == 0:
+            raise ValueError(f"Rank comparison requires both VH and VL sequences. Could not find columns '{args.vh_col}' and '{args.vl_col}' in input file")
+        if not args.aligned:
+            if args.verbose: print(f"Aligning sequences ({len(H_seqs)} VH, {len(L_seqs)} VL)")
+            aligned_seqs = align_seqs(H_seqs + L_seqs, num_cpus=cpu_budget["align_workers"])
+            H_seqs, L_seqs = aligned_seqs[:len(H_seqs)], aligned_seqs[len(H_seqs):]
+        # skip Fvs anarci failed on
+        keep_idxs = [i for i, (H, L) in enumerate(zip(H_seqs, L_seqs)) if "-"*len(CANONICAL_NUMBERING) not in [H, L]]
+        if len(keep_idxs) < len(H_seqs):
+            print(f"Warning: {len(H_seqs) - len(keep_idxs)} Fvs could not be numbered by ANARCI and will not be used")
+        reference_seqs = {"heavy": [H_seqs[i] for i in keep_idxs], "light": [L_seqs[i] for i in keep_idxs],
+                          "paired": [H_seqs[i] + PAD + L_seqs[i] for i in keep_idxs]}
+
+    dfs = []
+    for cnn_type in args.cnn_types:
+        model = load_cnn(get_weights_path(cnn_type), cnn_type)
+        if args.input is not None:
+            if args.verbose: print(f"Comparing ranks {args.ranks} for the {cnn_type} CNN on {len(reference_seqs[cnn_type])} sequences")
+            df = compare_ranks(model, reference_seqs[cnn_type], args.ranks, batch_size=args.batch_size)
+            df.insert(0, "CNN", cnn_type)
+            dfs.append(df)
+        for rank in args.save:
+            path = save_compressed_cnn(compress_cnn(model, rank), cnn_type, rank, out_dir=args.out_dir)
+            if args.verbose: print(f"Saved rank {rank} {cnn_type} weights to {path}")
+
+    # report and save rank comparison
+    if len(dfs) > 0:
+        df_out = pd.concat(dfs, ignore_index=True)
+        print(df_out.to_string(index=False, float_format=lambda val: f"{val:.4g}"))
+        out_path = args.output if args.output is not None else get_default_output_path(args.input, "_Humatch_compression.csv")
+        if args.verbose: print(f"Saving to {out_path}")
+        df_out.to_csv(out_path, index=False)
@@ -1,4 +1,6 @@
 import math
+import queue
+import threading
 import numpy as np
 import tensorflow as tf
 import multiprocessing as mp
@@ -55,3 +57,58 @@ def get_X_from_list_of_seq_strs(seq_strs, num_cpus=None):
     with mp.Pool(num_cpus) as pool:
         X = np.asarray(pool.map(seq_to_2D_kidera, seq_strs))
     return X
+
+
+def iter_prefetched_batches(seqs, batch_size=16384, num_cpus=None, prefetch_depth=2):
+    '''
+    Yield Kidera encoded ndarrays, X, for consecutive batches of sequences
+    Batches are encoded by a background producer thread so that encoding batch i+1 overlaps
+    with whatever the caller does with batch i (e.g. CNN inference). Batches are yielded in order
+
+    :param seqs: list of aligned sequence strings
+    :param batch_size: int, batch size for encoding
+    :param num_cpus: int, number of cpus to use when encoding sequences
+    :param prefetch_depth: int, max number of encoded batches waiting in the queue
+    :returns: generator of ndarrays of Kidera encoded (# batch seqs, seq len, 10)
+    '''
+    num_batches = math.ceil(len(seqs) / batch_size)
+    num_cpus = mp.cpu_count() if num_cpus is None else num_cpus
+    batch_queue = queue.Queue(maxsize=max(1, prefetch_depth))
+    stop_event = threading.Event()
+    end_of_batches = object()
+
+    def put(item):
+        # time out periodically so the producer can exit if the consumer stops early
+        while not stop_event.is_set():
+            try:
+                batch_queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def produce(pool):
+        try:
+            for index in range(num_batches):
+                if stop_event.is_set():
+                    return
+                batch_seqs = seqs[index*batch_size:(index+1)*batch_size]
+                put(np.asarray(pool.map(seq_to_2D_kidera, batch_seqs)))
+        except Exception as e:
+            put(e)
+        put(end_of_batches)
+
+    # pool is created here (not in the producer thread) so workers are forked from the calling thread
+    with mp.Pool(num_cpus) as pool:
+        producer = threading.Thread(target=produce, args=(pool,), daemon=True)
+        producer.start()
+        try:
+            while True:
+                X = batch_queue.get()
+                if X is end_of_batches:
+                    break
+                if isinstance(X, Exception):
+                    raise X
+                yield X
+        finally:
+            stop_event.set()
+            producer.join()
@@ -4,7 +4,8 @@ import numpy as np
 from Humatch.utils import (
     get_ordered_AA_one_letter_codes,
     get_CDR_loop_indices,
-    get_indices_of_selected_imgt_positions_in_canonical_numbering
+    get_indices_of_selected_imgt_positions_in_canonical_numbering,
+    seq_strs_to_token_array
     )
 
 # gl arrays added to compiled env package_data
@@ -115,6 +116,42 @@ def get_normalised_germline_likeness_score(seq, target_gene, germline_likeness_l
     return np.sum(freqs) / len(seq)
 
 
+def load_stacked_observed_position_AA_freqs(genes=vgenes, germline_likeness_lookup_arrays_dir=GL_DIR):
+    '''
+    Load and stack the observed position AA frequencies of many genes, with an extra all zero
+    column for padding "-" (as in get_list_of_occurence_freqs_for_seq_based_on_gene_arr)
+
+    :param genes: list of str, genes e.g. ["hv1", "hv2", ...]
+    :return: np.array, stacked observed position AA frequencies, shape (# genes, 200, 21)
+    '''
+    arrs = [load_observed_position_AA_freqs(gene, germline_likeness_lookup_arrays_dir)[:, :20] for gene in genes]
+    return np.pad(np.stack(arrs), ((0,0), (0,0), (0,1)), 'constant', constant_values=(0)).astype(np.float32)
+
+
+def get_germline_likeness_score_matrix(seqs, genes=vgenes, germline_likeness_lookup_arrays_dir=GL_DIR, batch_size=65536):
+    '''
+    Normalised germline likeness of many sequences against many genes at once - equivalent to
+        get_normalised_germline_likeness_score for every (seq, gene) pair
+    Sequences are one-hot encoded and contracted with the stacked gene arrays in one matrix product
+        (per batch of sequences to bound memory)
+
+    :param seqs: list of str, aligned sequences (padded with "-" for missing positions)
+    :param genes: list of str, genes to score against e.g. ["hv1", "hv2", ...]
+    :param batch_size: int, number of sequences one-hot encoded at a time
+    :return: np.array, normalised germline likeness scores, shape (# seqs, # genes)
+    '''
+    gene_arrs = load_stacked_observed_position_AA_freqs(genes, germline_likeness_lookup_arrays_dir)
+    num_genes, seq_len, num_AAs = gene_arrs.shape
+    gene_arrs = gene_arrs.reshape(num_genes, seq_len * num_AAs).T
+    scores = np.zeros((len(seqs), num_genes), dtype=np.float32)
+    for low_idx in range(0, len(seqs), batch_size):
+        tokens = seq_strs_to_token_array(seqs[low_idx:low_idx+batch_size], get_ordered_AA_one_letter_codes())
+        one_hot = np.zeros((len(tokens), seq_len, num_AAs), dtype=np.float32)
+        np.put_along_axis(one_hot, tokens[..., None].astype(np.intp), 1, axis=2)
+        scores[low_idx:low_idx+len(tokens)] = one_hot.reshape(len(tokens), -1) @ gene_arrs
+    return scores / seq_len
+
+
 def get_indices_where_two_strs_do_not_match(str1, str2, pad_chars=["-", "X", "*"]):
     return [i for i in range(len(str1)) if (str1[i] != str2[i]) and (str1[i] not in pad_chars) and (str2[i] not in pad_chars)]
 
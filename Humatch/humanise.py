@@ -1,12 +1,9 @@
 import os
 import sys
+import time
 # supress warnings about having no GPU
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
 import tensorflow as tf
-import logging
-# suppress warnings about tf retracing
-tf.get_logger().setLevel('ERROR')
-logging.getLogger('tensorflow').setLevel(logging.ERROR)
 
 import numpy as np
 import pandas as pd
@@ -28,11 +25,25 @@ from Humatch.utils import (
     get_CDR_loop_indices,
     get_indices_of_selected_imgt_positions_in_canonical_numbering,
     get_edit_distance,
-    CANONICAL_NUMBERING
+    seq_strs_to_token_array,
+    seq_strs_to_kidera_array,
+    configure_cpus,
+    KIDERA_AA_CODES,
+    KIDERA_ARRAY,
+    CANONICAL_NUMBERING,
+    HEAVY_V_GENE_CLASSES,
+    LIGHT_V_GENE_CLASSES,
+    PAIRED_CLASSES
 )
 from Humatch.plot import highlight_differnces_between_two_seqs
-from Humatch.align import get_padded_seq, strip_padding_from_seq
-from Humatch.model import load_cnn, HEAVY_WEIGHTS, LIGHT_WEIGHTS, PAIRED_WEIGHTS
+from Humatch.align import align_seqs
+from Humatch.model import load_cnn, get_weights_path
+from Humatch.inference import BucketedPredictor, compile_cnn
+from Humatch.cache import PredictionCache
+from Humatch.shard import select_shard, save_shard, ROW_COL
+from Humatch.readers import read_input, get_input_format, get_input_columns, get_default_output_path, format_read_stats
+
+PAIRED_TRUE_IDX = PAIRED_CLASSES.index("true")
 
 # default config added to compiled env package_data
 HUMATCH_CODE_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -40,24 +51,75 @@ CONFIG = os.path.join(HUMATCH_CODE_DIR, "configs", "default.yaml")
 
 
 def humanise(heavy_seq, light_seq, cnn_heavy, cnn_light, cnn_paired, config,
-             pad="----------", verbose=False):
+             pad="----------", verbose=False, cache=None, trajectory=None, stats=None, warm_start=None, start_scores=None):
     '''
     Jointly humanise heavy and light chain sequences to match germline likeness and CNN predictions
 
     :param heavy/light_seq: str, heavy/light chain sequence to humanise
     :param cnn_heavy/light/paired: model e.g. trained CNN for heavy/light/paired chain
+    :param cache: PredictionCache, optional cache of CNN predictions shared across calls
+    :param trajectory: list, if given a dict of the design after germline matching and after each
+        iteration (sequences, CNN scores, edit and cumulative # CNN evaluations) is appended to it
+    :param stats: dict, if given search statistics (e.g. germline prefilter pruning) are added to it
+    :param warm_start: dict, optional library of previously humanised antibodies (see load_warm_start_library)
+        to seed the search from the nearest one
+    :param start_scores: tuple, optional CNN scores of the input (see humanise_iter)
+    '''
+    trajectory = [] if trajectory is None else trajectory
+    for state in humanise_iter(heavy_seq, light_seq, cnn_heavy, cnn_light, cnn_paired, config, pad=pad,
+                               verbose=verbose, cache=cache, stats=stats, warm_start=warm_start, start_scores=start_scores):
+        trajectory.append(state)
+
+    # return best design even if humanisation fails (we may sometimes reduce total CNN scores in while loop)
+    state = select_design(trajectory, config)
+    if verbose and state is not trajectory[-1]: print(f"Humanisation failed")
+    if verbose: print(f"Humanised sequences:\n\t{state['Humatch_H'].replace('-','')}\n\t{state['Humatch_L'].replace('-','')}")
+
+    return {key: state[key] for key in ["Humatch_H", "Humatch_L", "Edit", "HV", "LV", "CNN_H", "CNN_L", "CNN_P"]}
+
+
+def humanise_iter(heavy_seq, light_seq, cnn_heavy, cnn_light, cnn_paired, config,
+                  pad="----------", verbose=False, cache=None, stats=None, warm_start=None, start_scores=None):
+    '''
+    Generator version of humanise - yields the design after germline matching and after each iteration
+    so callers can stop at any point and keep the best design so far (see select_design)
+    The search stops by itself once the CNN targets are met, all variants are tested, max_edit is exceeded
+    or a compute budget in the config (max_CNN_evals, max_seconds - checked between iterations) runs out
+
+    :param heavy/light_seq: str, heavy/light chain sequence to humanise
+    :param cnn_heavy/light/paired: model e.g. trained CNN for heavy/light/paired chain
+    :param cache: PredictionCache, optional cache of CNN predictions shared across calls
+    :param stats: dict, if given search statistics (e.g. germline prefilter pruning) are added to it
+    :param warm_start: dict, optional library of previously humanised antibodies (see load_warm_start_library)
+        to seed the search from the nearest one
+    :param start_scores: tuple, optional heavy, light and paired CNN scores of the input for the target genes (None
+        where unknown) e.g. from Humatch-classify - reused for chains germline matching does not mutate
+    :yields: dict, design state (Iteration, Humatch_H, Humatch_L, Edit, HV, LV, CNN_H, CNN_L, CNN_P,
+        cumulative # CNN evaluations and seconds, and whether the design failed i.e. no new variant was found)
     '''
+    start_time = time.perf_counter()
+    max_CNN_evals = config.get("max_CNN_evals", None)
+    max_seconds = config.get("max_seconds", None)
     precursor_seq_P = heavy_seq + pad + light_seq
+    stats = {} if stats is None else stats
+    num_CNN_evals = ("target_gene_H" not in config) + ("target_gene_L" not in config)
 
     # get target genes if none provided
     try:
         target_gene_H = config["target_gene_H"]
     except KeyError:
-        target_gene_H = get_target_gene_if_none_provided(heavy_seq, cnn_heavy, "heavy")
+        target_gene_H = get_target_gene_if_none_provided(heavy_seq, cnn_heavy, "heavy", cache=cache)
     try:
         target_gene_L = config["target_gene_L"]
     except KeyError:
-        target_gene_L = get_target_gene_if_none_provided(light_seq, cnn_light, "light")
+        target_gene_L = get_target_gene_if_none_provided(light_seq, cnn_light, "light", cache=cache)
+
+    # optionally seed from the accepted mutations of the nearest previously humanised antibody with the same target genes
+    seed = None
+    if warm_start is not None:
+        seed = get_warm_start_seed(heavy_seq, light_seq, warm_start, config, max_distance=config.get("warm_start_max_distance", None),
+                                   target_genes=(target_gene_H, target_gene_L))
+        add_to_stats(stats, warm_start_antibodies=1, warm_start_neighbours=int(seed is not None))
     try:
         germline_likeness_lookup_arrays_dir = config["germline_likeness_lookup_arrays_dir"]
     except KeyError:
@@ -76,74 +138,963 @@ def humanise(heavy_seq, light_seq, cnn_heavy, cnn_light, cnn_paired, config,
     best_seq_P = best_seq_H + pad + best_seq_L
     edit = get_edit_distance(precursor_seq_P, best_seq_P)
 
-    # get predictions after germline likeness mutations
-    max_pred_H = get_predictions_for_target_class([best_seq_H], cnn_heavy, target_gene_H, "heavy", num_cpus=config["num_cpus"])[0]
-    max_pred_L = get_predictions_for_target_class([best_seq_L], cnn_light, target_gene_L, "light", num_cpus=config["num_cpus"])[0]
-    max_pred_P = get_predictions_for_target_class([best_seq_P], cnn_paired, "true", "paired", num_cpus=config["num_cpus"])[0]
+    # get predictions after germline likeness mutations (reusing known scores of the input for unmutated chains)
+    start_H, start_L, start_P = (None, None, None) if start_scores is None else start_scores
+    reuse_H = (start_H is not None) and (best_seq_H == heavy_seq)
+    reuse_L = (start_L is not None) and (best_seq_L == light_seq)
+    reuse_P = (start_P is not None) and (best_seq_P == precursor_seq_P)
+    max_pred_H = np.float32(start_H) if reuse_H else \
+        get_predictions_for_target_class([best_seq_H], cnn_heavy, target_gene_H, "heavy", num_cpus=config["num_cpus"], cache=cache)[0]
+    max_pred_L = np.float32(start_L) if reuse_L else \
+        get_predictions_for_target_class([best_seq_L], cnn_light, target_gene_L, "light", num_cpus=config["num_cpus"], cache=cache)[0]
+    max_pred_P = np.float32(start_P) if reuse_P else \
+        get_predictions_for_target_class([best_seq_P], cnn_paired, "true", "paired", num_cpus=config["num_cpus"], cache=cache)[0]
+    num_CNN_evals += 3 - reuse_H - reuse_L - reuse_P
+    if start_scores is not None: add_to_stats(stats, start_scores_reused=reuse_H + reuse_L + reuse_P)
+
+    # verify the warm start seed (plus any germline matching it still needs) and continue from it if it scores higher
+    if seed is not None:
+        seed_H = mutate_seq_to_match_germline_likeness(seed[0], target_gene_H, config["GL_target_score_H"],
+                                                       allow_CDR_mutations=config["GL_allow_CDR_mutations_H"],
+                                                       fixed_imgt_positions=config["GL_fixed_imgt_positions_H"],
+                                                       germline_likeness_lookup_arrays_dir=germline_likeness_lookup_arrays_dir)
+        seed_L = mutate_seq_to_match_germline_likeness(seed[1], target_gene_L, config["GL_target_score_L"],
+                                                       allow_CDR_mutations=config["GL_allow_CDR_mutations_L"],
+                                                       fixed_imgt_positions=config["GL_fixed_imgt_positions_L"],
+                                                       germline_likeness_lookup_arrays_dir=germline_likeness_lookup_arrays_dir)
+        seed_edit = get_edit_distance(precursor_seq_P, seed_H + pad + seed_L)
+        seed_preds = (get_predictions_for_target_class([seed_H], cnn_heavy, target_gene_H, "heavy", num_cpus=config["num_cpus"], cache=cache)[0],
+                      get_predictions_for_target_class([seed_L], cnn_light, target_gene_L, "light", num_cpus=config["num_cpus"], cache=cache)[0],
+                      get_predictions_for_target_class([seed_H + pad + seed_L], cnn_paired, "true", "paired", num_cpus=config["num_cpus"], cache=cache)[0])
+        num_CNN_evals += 3
+        if (sum(seed_preds) > max_pred_H + max_pred_L + max_pred_P) and (seed_edit <= config["max_edit"]):
+            add_to_stats(stats, warm_start_hits=1, warm_start_mutations=max(0, seed_edit - edit))
+            if verbose: print(f"Warm start from nearest humanised antibody accepted ({seed_edit} edits)")
+            best_seq_H, best_seq_L, best_seq_P, edit = seed_H, seed_L, seed_H + pad + seed_L, seed_edit
+            max_pred_H, max_pred_L, max_pred_P = seed_preds
+
+    # optional germline-frequency prefilter of variants before CNN scoring
+    GL_prefilter_min_freq = config.get("GL_prefilter_min_freq", 0.0)
+    GL_prefilter_top_m = config.get("GL_prefilter_top_m", None)
+    use_GL_prefilter = (GL_prefilter_min_freq > 0) or (GL_prefilter_top_m is not None)
+    # optional gradient-saliency proposals - only the top candidates are scored exactly
+    saliency_budget = config.get("saliency_candidates", None)
+    use_saliency = saliency_budget is not None
+    # optionally also score all variants to count how often each pruning step changes the selected variant
+    GL_prefilter_diagnostic = use_GL_prefilter and config.get("GL_prefilter_diagnostic", False)
+    saliency_diagnostic = use_saliency and config.get("saliency_diagnostic", False)
+    if use_GL_prefilter:
+        GL_arr_H = load_observed_position_AA_freqs(target_gene_H, germline_likeness_lookup_arrays_dir)
+        GL_arr_L = load_observed_position_AA_freqs(target_gene_L, germline_likeness_lookup_arrays_dir)
+
+    # optional surrogate-guided multi-mutation jumps between full variant scans
+    use_surrogate = config.get("surrogate_jumps", False)
+    surrogate_max_jump = config.get("surrogate_max_jump", 5)
+    target_preds = np.array([config["CNN_target_score_H"], config["CNN_target_score_L"], config["CNN_target_score_P"]], dtype=np.float32)
+    surrogate = None
 
     # while predictions are not above threshold, keep humanising
     all_designed_seqs = [(best_seq_H, best_seq_L)]
-    all_cnn_preds = [(max_pred_H, max_pred_L, max_pred_P)]
-    all_total_preds = [max_pred_H + max_pred_L + max_pred_P]
     humanisation_failed = False
     i = 0
+    yield {"Iteration": i, "Humatch_H": best_seq_H, "Humatch_L": best_seq_L, "Edit": edit, "HV": target_gene_H, "LV": target_gene_L,
+           "CNN_H": max_pred_H, "CNN_L": max_pred_L, "CNN_P": max_pred_P, "CNN_evals": num_CNN_evals,
+           "Seconds": time.perf_counter() - start_time, "Failed": False}
     if verbose: print(f"Designing and scoring single-point variants")
     while (max_pred_H < config["CNN_target_score_H"]) or (max_pred_L < config["CNN_target_score_L"]) or (max_pred_P < config["CNN_target_score_P"]):
+        # stop if the compute budget is spent (the best design so far is selected as if humanisation failed)
+        if (max_CNN_evals is not None) and (num_CNN_evals >= max_CNN_evals):
+            add_to_stats(stats, budget_stops_CNN_evals=1)
+            if verbose: print(f"Budget of {max_CNN_evals} CNN evaluations reached")
+            break
+        if (max_seconds is not None) and (time.perf_counter() - start_time >= max_seconds):
+            add_to_stats(stats, budget_stops_seconds=1)
+            if verbose: print(f"Budget of {max_seconds} seconds reached")
+            break
         i += 1
+        add_to_stats(stats, humanise_iterations=1)
         if verbose: print(f"\tIt. #{i}\tCNN-H: {max_pred_H:.2f},\tCNN-L: {max_pred_L:.2f},\tCNN-P: {max_pred_P:.2f},\tEdit: {edit}")
         
-        # get single point variants
-        variants_H = get_all_single_point_variants(best_seq_H, config["CNN_allow_CDR_mutations_H"], config["CNN_fixed_imgt_positions_H"])
-        variants_L = get_all_single_point_variants(best_seq_L, config["CNN_allow_CDR_mutations_L"], config["CNN_fixed_imgt_positions_L"])
-        variants_P = [H + pad + best_seq_L for H in variants_H] + [best_seq_H + pad + L for L in variants_L]
-
-        # get predictions for all variants
-        preds_H = get_predictions_for_target_class(variants_H, cnn_heavy, target_gene_H, "heavy", num_cpus=config["num_cpus"])
-        preds_L = get_predictions_for_target_class(variants_L, cnn_light, target_gene_L, "light", num_cpus=config["num_cpus"])
-        preds_P = get_predictions_for_target_class(variants_P, cnn_paired, "true", "paired", num_cpus=config["num_cpus"])
-
-        # scale/weight predictions
-        preds_H_scaled, preds_L_scaled, preds_P_scaled = scale_predictions(best_seq_H, best_seq_L, variants_H, variants_L,
-                                                                          preds_H, preds_L, preds_P, max_pred_H, max_pred_L, max_pred_P,
-                                                                          germline_likeness_lookup_arrays_dir, target_gene_H, target_gene_L,
-                                                                          config["CNN_target_score_H"], config["CNN_target_score_L"],
-                                                                          config["CNN_target_score_P"])
-
-        # get total scaled predictions for each variant - each variant affects two predictions (heavy|light and paired)
-        preds_H_then_L_scaled = np.concatenate([preds_H_scaled, preds_L_scaled], axis=0)
-        preds_total_scaled = preds_H_then_L_scaled + preds_P_scaled
-
-        # get best variant based on total scaled predictions
-        best_seq_H, best_seq_L, max_pred_H, max_pred_L, max_pred_P, humanisation_failed = \
-            get_best_variant_based_on_total_scaled_predictions(best_seq_H, best_seq_L, variants_H, variants_L,
-                                                               preds_H, preds_L, preds_P, max_pred_H, max_pred_L, max_pred_P,
-                                                               all_designed_seqs, preds_total_scaled)
+        # optionally jump several surrogate proposed mutations at once - verified by the CNNs before acceptance
+        new_design, old_preds = None, np.array([max_pred_H, max_pred_L, max_pred_P], dtype=np.float32)
+        if surrogate is not None:
+            jump = propose_surrogate_jump(surrogate, best_seq_H, best_seq_L, old_preds, target_preds,
+                                          max_mutations=min(surrogate_max_jump, config["max_edit"] - edit))
+            if jump is not None:
+                jump_seq_H, jump_seq_L, predicted_preds = jump
+                verified_preds = np.array([
+                    get_predictions_for_target_class([jump_seq_H], cnn_heavy, target_gene_H, "heavy", num_cpus=config["num_cpus"], cache=cache)[0],
+                    get_predictions_for_target_class([jump_seq_L], cnn_light, target_gene_L, "light", num_cpus=config["num_cpus"], cache=cache)[0],
+                    get_predictions_for_target_class([jump_seq_H + pad + jump_seq_L], cnn_paired, "true", "paired", num_cpus=config["num_cpus"], cache=cache)[0]])
+                num_CNN_evals += 3
+                if (np.sum(verified_preds) > np.sum(old_preds)) and ((jump_seq_H, jump_seq_L) not in all_designed_seqs):
+                    num_mutations = get_edit_distance(best_seq_H + best_seq_L, jump_seq_H + jump_seq_L)
+                    add_to_stats(stats, surrogate_jumps_accepted=1, surrogate_jump_mutations=num_mutations)
+                    if verbose: print(f"\t\tSurrogate jump of {num_mutations} mutations accepted")
+                    new_design = (jump_seq_H, jump_seq_L, *verified_preds, False)
+                else:
+                    add_to_stats(stats, surrogate_jumps_rejected=1)
+            # refit from a fresh scan if the surrogate no longer proposes improving jumps
+            if new_design is None:
+                surrogate = None
+
+        if new_design is None:
+            # get single point variants - predictions are NaN until scored
+            variants_H, variants_L, variants_P = get_single_point_variants_of_design(best_seq_H, best_seq_L, config, pad=pad)
+            preds_H = np.full(len(variants_H), np.nan, dtype=np.float32)
+            preds_L = np.full(len(variants_L), np.nan, dtype=np.float32)
+            preds_P = np.full(len(variants_P), np.nan, dtype=np.float32)
+            all_candidates = np.ones(len(variants_P), dtype=bool)
+
+            # optionally only score variants introducing residues common in germline at that position first
+            candidates = all_candidates
+            if use_GL_prefilter:
+                candidates = np.concatenate([get_germline_prefilter_mask(best_seq_H, variants_H, GL_arr_H, GL_prefilter_min_freq, GL_prefilter_top_m),
+                                             get_germline_prefilter_mask(best_seq_L, variants_L, GL_arr_L, GL_prefilter_min_freq, GL_prefilter_top_m)])
+                add_to_stats(stats, GL_prefilter_iterations=1, GL_prefilter_variants=len(candidates),
+                             GL_prefilter_pruned=int(np.sum(~candidates)))
+
+            # optionally only score the variants with the largest first order (input gradient) gains first
+            if use_saliency:
+                saliency_mask = get_saliency_mask(best_seq_H, best_seq_L, variants_H, variants_L, cnn_heavy, cnn_light, cnn_paired,
+                                                  target_gene_H, target_gene_L, old_preds < target_preds, saliency_budget, pad=pad)
+                num_CNN_evals += 3
+                add_to_stats(stats, saliency_iterations=1, saliency_variants=len(candidates),
+                             saliency_pruned=int(np.sum(candidates & ~saliency_mask)))
+                candidates = candidates & saliency_mask
+
+            # score candidates and get best variant based on total scaled predictions
+            new_design, num_evals = score_and_select_variant(best_seq_H, best_seq_L, variants_H, variants_L, candidates, preds_H, preds_L, preds_P,
+                                                             max_pred_H, max_pred_L, max_pred_P, all_designed_seqs, cnn_heavy, cnn_light, cnn_paired,
+                                                             target_gene_H, target_gene_L, config, germline_likeness_lookup_arrays_dir,
+                                                             pad=pad, cache=cache, stats=stats)
+            num_CNN_evals += num_evals
+
+            # fall back to all variants if no pruned variant improves the CNN scores
+            if use_GL_prefilter or use_saliency:
+                improved = (new_design is not None) and (not new_design[5]) and (sum(new_design[2:5]) > max_pred_H + max_pred_L + max_pred_P)
+                if (not improved) or GL_prefilter_diagnostic or saliency_diagnostic:
+                    full_design, num_evals = score_and_select_variant(best_seq_H, best_seq_L, variants_H, variants_L, all_candidates, preds_H, preds_L, preds_P,
+                                                                      max_pred_H, max_pred_L, max_pred_P, all_designed_seqs, cnn_heavy, cnn_light, cnn_paired,
+                                                                      target_gene_H, target_gene_L, config, germline_likeness_lookup_arrays_dir,
+                                                                      pad=pad, cache=cache, stats=stats)
+                    num_CNN_evals += num_evals
+                    if not improved:
+                        add_to_stats(stats, GL_prefilter_fallbacks=int(use_GL_prefilter), saliency_fallbacks=int(use_saliency))
+                        new_design = full_design
+                    elif full_design[:2] != new_design[:2]:
+                        add_to_stats(stats, GL_prefilter_changed_choices=int(GL_prefilter_diagnostic), saliency_changed_choices=int(saliency_diagnostic))
+            if use_surrogate:
+                surrogate = fit_surrogate(best_seq_H, best_seq_L, variants_H, variants_L, preds_H, preds_L, preds_P,
+                                          max_pred_H, max_pred_L, max_pred_P)
+                add_to_stats(stats, surrogate_scans=1)
+            predicted_preds = np.array(new_design[2:5], dtype=np.float32)
+        if surrogate is not None and not new_design[5]:
+            refine_surrogate(surrogate, best_seq_H, best_seq_L, new_design[0], new_design[1], old_preds,
+                             predicted_preds, np.array(new_design[2:5], dtype=np.float32))
+        best_seq_H, best_seq_L, max_pred_H, max_pred_L, max_pred_P, humanisation_failed = new_design
         best_seq_P = best_seq_H + pad + best_seq_L
         all_designed_seqs.append((best_seq_H, best_seq_L))
-        all_cnn_preds.append((max_pred_H, max_pred_L, max_pred_P))
-        all_total_preds.append(max_pred_H + max_pred_L + max_pred_P)
 
         # break if max edit distance reached/all variants tested
         edit = get_edit_distance(precursor_seq_P, best_seq_P)
+        yield {"Iteration": i, "Humatch_H": best_seq_H, "Humatch_L": best_seq_L, "Edit": edit, "HV": target_gene_H, "LV": target_gene_L,
+               "CNN_H": max_pred_H, "CNN_L": max_pred_L, "CNN_P": max_pred_P, "CNN_evals": num_CNN_evals,
+               "Seconds": time.perf_counter() - start_time, "Failed": humanisation_failed}
         if edit > config["max_edit"]:
             humanisation_failed = True
         if humanisation_failed:
             break
 
-    # return best design even if humanisation fails (we may sometimes reduce total CNN scores in while loop)
-    if humanisation_failed:
-        best_idx = np.argmax(all_total_preds)
-        best_seq_H, best_seq_L = all_designed_seqs[best_idx]
-        max_pred_H, max_pred_L, max_pred_P = all_cnn_preds[best_idx]
-        best_seq_P = best_seq_H + pad + best_seq_L
-        edit = get_edit_distance(precursor_seq_P, best_seq_P)
-        if verbose: print(f"Humanisation failed")
 
-    if verbose: print(f"Humanised sequences:\n\t{best_seq_H.replace('-','')}\n\t{best_seq_L.replace('-','')}")
+def select_design(states, config):
+    '''
+    Select the design humanise returns from the states yielded by humanise_iter so far - the last design if it
+    meets the CNN targets within max_edit, otherwise (humanisation failed, a budget ran out or the caller stopped
+    early) the design with the highest total CNN score
+
+    :param states: list of dicts, states yielded by humanise_iter
+    :param config: dict, humanisation config (CNN targets and max_edit)
+    :returns: dict, selected state
+    '''
+    last_state = states[-1]
+    targets_met = (last_state["CNN_H"] >= config["CNN_target_score_H"]) and (last_state["CNN_L"] >= config["CNN_target_score_L"]) and \
+                  (last_state["CNN_P"] >= config["CNN_target_score_P"])
+    if targets_met and (not last_state["Failed"]) and (last_state["Iteration"] == 0 or last_state["Edit"] <= config["max_edit"]):
+        return last_state
+    best_idx = np.argmax([state["CNN_H"] + state["CNN_L"] + state["CNN_P"] for state in states])
+    return states[best_idx]
+
+
+def humanise_sweep(heavy_seq, light_seq, cnn_heavy, cnn_light, cnn_paired, config, CNN_target_scores,
+                   max_edits=None, pad="----------", verbose=False, cache=None):
+    '''
+    Humanise towards several CNN target scores and max edits in a single run
+    max_edit does not affect which variant is picked, so each CNN target is run once (up to the largest
+    max edit) and the results for all max edits are read from its trajectory. Runs for different CNN
+    targets share every CNN prediction through a prediction cache, so target gene detection, the
+    germline-matched starting point and any iterations where their trajectories coincide are only
+    scored once. Results are identical to separate humanise runs.
+    Surrogate jumps are capped by the remaining edit budget, so with surrogate_jumps on max_edit does
+    affect the search and each max edit is run separately (still sharing the prediction cache)
+    Note - trajectories for different CNN targets are not simply prefixes of each other, as
+    scale_predictions weights variants by their distance from the targets
+
+    :param heavy/light_seq: str, heavy/light chain sequence to humanise
+    :param cnn_heavy/light/paired: model e.g. trained CNN for heavy/light/paired chain
+    :param config: dict, humanisation config (GL settings etc. are shared by all sweep settings)
+    :param CNN_target_scores: list of float (same target for heavy, light and paired) or (H, L, P) tuples
+    :param max_edits: list of int max edit distances, defaults to [config["max_edit"]]
+    :param cache: PredictionCache, optional cache of CNN predictions shared across calls
+    :returns: list of result dicts (one per CNN target and max edit), dict of # CNN evaluations
+        for the sweep vs separate runs - both count unique predictions (as with a fresh prediction cache
+        per run), so repeats within a run are not counted as sweep savings
+    '''
+    CNN_target_scores = [tuple(t) if isinstance(t, (list, tuple)) else (t, t, t) for t in CNN_target_scores]
+    max_edits = [config["max_edit"]] if max_edits is None else max_edits
+    # a private cache (backed by any shared cache) so only CNN evaluations this sweep needs are counted
+    sweep_cache = PredictionCache(parent=cache)
+
+    # (run max edit, max edits read from its trajectory)
+    runs = [(max_edit, [max_edit]) for max_edit in max_edits] if config.get("surrogate_jumps", False) else [(max(max_edits), max_edits)]
+
+    results, separate_CNN_evals = [], 0
+    for target in CNN_target_scores:
+        for run_max_edit, run_max_edits in runs:
+            target_config = dict(config, max_edit=run_max_edit, CNN_target_score_H=target[0],
+                                 CNN_target_score_L=target[1], CNN_target_score_P=target[2])
+            # a fresh cache per run (backed by the sweep cache) counts the unique predictions a separate run needs
+            run_cache, trajectory, run_CNN_evals = PredictionCache(parent=sweep_cache), [], []
+            for state in humanise_iter(heavy_seq, light_seq, cnn_heavy, cnn_light, cnn_paired, target_config,
+                                       pad=pad, verbose=verbose, cache=run_cache):
+                trajectory.append(state)
+                run_CNN_evals.append(run_cache.evaluations)
+            for max_edit in run_max_edits:
+                state, end_idx = get_result_from_trajectory(trajectory, target, max_edit)
+                separate_CNN_evals += run_CNN_evals[end_idx]
+                results.append({"Humatch_H": state["Humatch_H"], "Humatch_L": state["Humatch_L"], "Edit": state["Edit"],
+                                "HV": state["HV"], "LV": state["LV"],
+                                "CNN_H": state["CNN_H"], "CNN_L": state["CNN_L"], "CNN_P": state["CNN_P"],
+                                "CNN_target_H": target[0], "CNN_target_L": target[1], "CNN_target_P": target[2],
+                                "max_edit": max_edit})
+    stats = {"sweep_CNN_evals": sweep_cache.evaluations, "separate_CNN_evals": separate_CNN_evals}
+    return results, stats
 
-    return {"Humatch_H": best_seq_H, "Humatch_L": best_seq_L, "Edit": edit,
-            "HV": target_gene_H, "LV": target_gene_L,
-            "CNN_H": max_pred_H, "CNN_L": max_pred_L, "CNN_P": max_pred_P}
+
+def get_result_from_trajectory(trajectory, CNN_target_scores, max_edit):
+    '''
+    Get the design humanise would return for a max edit from a trajectory recorded with a larger max edit
+
+    :param trajectory: list of dicts, designs recorded by humanise
+    :param CNN_target_scores: tuple of float, heavy/light/paired target scores
+    :param max_edit: int, max edit distance
+    :returns: dict, selected design and int, index of the design at which humanise would have stopped
+    '''
+    for idx, state in enumerate(trajectory):
+        # the edit check only applies to designs made in the CNN loop (not to germline matching)
+        if idx > 0 and (state["Edit"] > max_edit or state["Failed"]):
+            break
+        if (state["CNN_H"] >= CNN_target_scores[0]) and (state["CNN_L"] >= CNN_target_scores[1]) and (state["CNN_P"] >= CNN_target_scores[2]):
+            return state, idx
+    # humanisation failed - return best total CNN score up to and including the stopping design
+    candidates = trajectory[:idx+1]
+    best_idx = np.argmax([state["CNN_H"] + state["CNN_L"] + state["CNN_P"] for state in candidates])
+    return candidates[best_idx], idx
+
+
+def humanise_multi_gene(heavy_seq, light_seq, cnn_heavy, cnn_light, cnn_paired, config, top_k_H=2, top_k_L=2,
+                        pad="----------", verbose=False, cache=None):
+    '''
+    Jointly humanise heavy and light chain sequences towards every combination of the top-k heavy and
+    light target V-genes at once (target_gene_H/L in the config restrict the candidates to that gene)
+    All designs are humanised in lockstep with the same greedy steps as humanise. Each iteration the
+    variants of every design are scored in one shared batch per CNN - predictions cover all genes so
+    only the target column differs between designs, and variants shared by designs are scored once
+
+    :param heavy/light_seq: str, heavy/light chain sequence to humanise
+    :param cnn_heavy/light/paired: model e.g. trained CNN for heavy/light/paired chain
+    :param top_k_H/L: int, number of top scoring heavy/light V-genes to humanise towards
+    :param cache: PredictionCache, optional cache of CNN predictions shared across calls
+    :returns: list of result dicts (as humanise plus "Failed"), ranked by humanisation success, edit
+        distance and total CNN score
+    '''
+    precursor_seq_P = heavy_seq + pad + light_seq
+    germline_likeness_lookup_arrays_dir = config.get("germline_likeness_lookup_arrays_dir", GL_DIR)
+
+    def predict_unique(seqs, model):
+        # full prediction vectors for each unique sequence
+        unique_seqs = list(dict.fromkeys(seqs))
+        preds = predict_from_list_of_seq_strs(unique_seqs, model, num_cpus=config["num_cpus"], cache=cache)
+        return dict(zip(unique_seqs, preds))
+
+    # candidate target genes - highest scoring human genes unless a target gene is provided
+    if "target_gene_H" in config:
+        genes_H = [config["target_gene_H"]]
+    else:
+        preds_H = predict_unique([heavy_seq], cnn_heavy)[heavy_seq]
+        genes_H = [HEAVY_V_GENE_CLASSES[i] for i in np.argsort(-preds_H[1:])[:top_k_H] + 1]
+    if "target_gene_L" in config:
+        genes_L = [config["target_gene_L"]]
+    else:
+        preds_L = predict_unique([light_seq], cnn_light)[light_seq]
+        genes_L = [LIGHT_V_GENE_CLASSES[i] for i in np.argsort(-preds_L[1:])[:top_k_L] + 1]
+
+    # make top germline mutations to match germline likeness (once per gene)
+    if verbose: print(f"Matching germline likeness for {genes_H} and {genes_L}")
+    GL_seqs_H = {gene: mutate_seq_to_match_germline_likeness(heavy_seq, gene, config["GL_target_score_H"],
+                                                             allow_CDR_mutations=config["GL_allow_CDR_mutations_H"],
+                                                             fixed_imgt_positions=config["GL_fixed_imgt_positions_H"],
+                                                             germline_likeness_lookup_arrays_dir=germline_likeness_lookup_arrays_dir)
+                 for gene in genes_H}
+    GL_seqs_L = {gene: mutate_seq_to_match_germline_likeness(light_seq, gene, config["GL_target_score_L"],
+                                                             allow_CDR_mutations=config["GL_allow_CDR_mutations_L"],
+                                                             fixed_imgt_positions=config["GL_fixed_imgt_positions_L"],
+                                                             germline_likeness_lookup_arrays_dir=germline_likeness_lookup_arrays_dir)
+                 for gene in genes_L}
+
+    # get predictions after germline likeness mutations
+    designs = [{"HV": gene_H, "LV": gene_L, "Humatch_H": GL_seqs_H[gene_H], "Humatch_L": GL_seqs_L[gene_L],
+                "H_idx": HEAVY_V_GENE_CLASSES.index(gene_H), "L_idx": LIGHT_V_GENE_CLASSES.index(gene_L),
+                "all_designed_seqs": [], "all_cnn_preds": [], "Failed": False, "done": False}
+               for gene_H in genes_H for gene_L in genes_L]
+    preds_H = predict_unique([d["Humatch_H"] for d in designs], cnn_heavy)
+    preds_L = predict_unique([d["Humatch_L"] for d in designs], cnn_light)
+    preds_P = predict_unique([d["Humatch_H"] + pad + d["Humatch_L"] for d in designs], cnn_paired)
+    for d in designs:
+        d["CNN_H"] = preds_H[d["Humatch_H"]][d["H_idx"]]
+        d["CNN_L"] = preds_L[d["Humatch_L"]][d["L_idx"]]
+        d["CNN_P"] = preds_P[d["Humatch_H"] + pad + d["Humatch_L"]][PAIRED_TRUE_IDX]
+        d["all_designed_seqs"].append((d["Humatch_H"], d["Humatch_L"]))
+        d["all_cnn_preds"].append((d["CNN_H"], d["CNN_L"], d["CNN_P"]))
+
+    # while predictions are not above threshold, keep humanising all designs in lockstep
+    i = 0
+    if verbose: print(f"Designing and scoring single-point variants for {len(designs)} gene combinations")
+    while True:
+        for d in designs:
+            if (d["CNN_H"] >= config["CNN_target_score_H"]) and (d["CNN_L"] >= config["CNN_target_score_L"]) and (d["CNN_P"] >= config["CNN_target_score_P"]):
+                d["done"] = True
+        active = [d for d in designs if not d["done"]]
+        if len(active) == 0:
+            break
+        i += 1
+        if verbose: print(f"\tIt. #{i}\t{len(active)} active designs")
+
+        # get single point variants of all active designs and score them in shared batches
+        for d in active:
+            d["variants"] = get_single_point_variants_of_design(d["Humatch_H"], d["Humatch_L"], config, pad=pad)
+        preds_H = predict_unique([v for d in active for v in d["variants"][0]], cnn_heavy)
+        preds_L = predict_unique([v for d in active for v in d["variants"][1]], cnn_light)
+        preds_P = predict_unique([v for d in active for v in d["variants"][2]], cnn_paired)
+
+        # take one greedy step for each design using its own target genes
+        for d in active:
+            variants_H, variants_L, variants_P = d.pop("variants")
+            d_preds_H = np.array([preds_H[v][d["H_idx"]] for v in variants_H])
+            d_preds_L = np.array([preds_L[v][d["L_idx"]] for v in variants_L])
+            d_preds_P = np.array([preds_P[v][PAIRED_TRUE_IDX] for v in variants_P])
+            d["Humatch_H"], d["Humatch_L"], d["CNN_H"], d["CNN_L"], d["CNN_P"], d["Failed"] = \
+                select_best_variant(d["Humatch_H"], d["Humatch_L"], variants_H, variants_L, d_preds_H, d_preds_L, d_preds_P,
+                                    d["CNN_H"], d["CNN_L"], d["CNN_P"], d["all_designed_seqs"], d["HV"], d["LV"],
+                                    config, germline_likeness_lookup_arrays_dir)
+            d["all_designed_seqs"].append((d["Humatch_H"], d["Humatch_L"]))
+            d["all_cnn_preds"].append((d["CNN_H"], d["CNN_L"], d["CNN_P"]))
+            if get_edit_distance(precursor_seq_P, d["Humatch_H"] + pad + d["Humatch_L"]) > config["max_edit"]:
+                d["Failed"] = True
+            if d["Failed"]:
+                d["done"] = True
+
+    # return best design even if humanisation fails (as in humanise)
+    results = []
+    for d in designs:
+        if d["Failed"]:
+            best_idx = np.argmax([sum(preds) for preds in d["all_cnn_preds"]])
+            d["Humatch_H"], d["Humatch_L"] = d["all_designed_seqs"][best_idx]
+            d["CNN_H"], d["CNN_L"], d["CNN_P"] = d["all_cnn_preds"][best_idx]
+        results.append({"Humatch_H": d["Humatch_H"], "Humatch_L": d["Humatch_L"],
+                        "Edit": get_edit_distance(precursor_seq_P, d["Humatch_H"] + pad + d["Humatch_L"]),
+                        "HV": d["HV"], "LV": d["LV"], "CNN_H": d["CNN_H"], "CNN_L": d["CNN_L"], "CNN_P": d["CNN_P"],
+                        "Failed": d["Failed"]})
+    return sorted(results, key=lambda r: (r["Failed"], r["Edit"], -(r["CNN_H"] + r["CNN_L"] + r["CNN_P"])))
+
+
+def humanise_diverse(heavy_seq, light_seq, cnn_heavy, cnn_light, cnn_paired, config, num_designs=3, min_distance=3,
+                     pad="----------", verbose=False, cache=None):
+    '''
+    Return several diverse humanised designs from a single (beam) search
+    A beam of up to num_designs branches is humanised in lockstep. Each iteration every branch ranks its
+    single point variants with the same scaled scores as humanise, and the new beam is filled with the
+    greedy step of each branch first, then their next best alternatives (branching off the shared trajectory).
+    The first branch follows exactly the humanise trajectory. Other branches never revisit a design seen by
+    any branch, so they do not converge. Branches meeting the CNN targets are kept if at least min_distance
+    (Hamming distance over heavy + light) from the designs kept so far, until num_designs are found.
+    Variants are scored once per unique sequence, so designs shared by branches are not rescored
+
+    :param heavy/light_seq: str, heavy/light chain sequence to humanise
+    :param cnn_heavy/light/paired: model e.g. trained CNN for heavy/light/paired chain
+    :param num_designs: int, number of designs to return (beam width)
+    :param min_distance: int, min Hamming distance between returned designs
+    :param cache: PredictionCache, optional cache of CNN predictions shared across calls
+    :returns: list of result dicts (as humanise plus "Failed"), ranked by humanisation success, edit and total CNN
+        score, and dict of # CNN evaluations for the search vs num_designs separate runs (estimated from the first branch)
+    '''
+    precursor_seq_P = heavy_seq + pad + light_seq
+    germline_likeness_lookup_arrays_dir = config.get("germline_likeness_lookup_arrays_dir", GL_DIR)
+    num_CNN_evals = ("target_gene_H" not in config) + ("target_gene_L" not in config)
+    target_gene_H = config["target_gene_H"] if "target_gene_H" in config else get_target_gene_if_none_provided(heavy_seq, cnn_heavy, "heavy", cache=cache)
+    target_gene_L = config["target_gene_L"] if "target_gene_L" in config else get_target_gene_if_none_provided(light_seq, cnn_light, "light", cache=cache)
+    scores = {"heavy": {}, "light": {}, "paired": {}}
+
+    def predict_unique(seqs, model, target_class, classifier_type):
+        # target class predictions, scoring each sequence once over the whole search
+        new_seqs = [seq for seq in dict.fromkeys(seqs) if seq not in scores[classifier_type]]
+        if len(new_seqs) > 0:
+            scores[classifier_type].update(zip(new_seqs, get_predictions_for_target_class(new_seqs, model, target_class, classifier_type,
+                                                                                          num_cpus=config["num_cpus"], cache=cache)))
+        return np.array([scores[classifier_type][seq] for seq in seqs], dtype=np.float32), len(new_seqs)
+
+    def get_distance(design, other):
+        return get_edit_distance(design["Humatch_H"] + design["Humatch_L"], other["Humatch_H"] + other["Humatch_L"])
+
+    # make top germline mutations to match germline likeness
+    if verbose: print(f"Matching germline likeness for {target_gene_H} and {target_gene_L}")
+    seq_H = mutate_seq_to_match_germline_likeness(heavy_seq, target_gene_H, config["GL_target_score_H"],
+                                                  allow_CDR_mutations=config["GL_allow_CDR_mutations_H"],
+                                                  fixed_imgt_positions=config["GL_fixed_imgt_positions_H"],
+                                                  germline_likeness_lookup_arrays_dir=germline_likeness_lookup_arrays_dir)
+    seq_L = mutate_seq_to_match_germline_likeness(light_seq, target_gene_L, config["GL_target_score_L"],
+                                                  allow_CDR_mutations=config["GL_allow_CDR_mutations_L"],
+                                                  fixed_imgt_positions=config["GL_fixed_imgt_positions_L"],
+                                                  germline_likeness_lookup_arrays_dir=germline_likeness_lookup_arrays_dir)
+    start_H, evals_H = predict_unique([seq_H], cnn_heavy, target_gene_H, "heavy")
+    start_L, evals_L = predict_unique([seq_L], cnn_light, target_gene_L, "light")
+    start_P, evals_P = predict_unique([seq_H + pad + seq_L], cnn_paired, "true", "paired")
+    num_CNN_evals += evals_H + evals_L + evals_P
+    start = {"Humatch_H": seq_H, "Humatch_L": seq_L, "CNN_H": start_H[0], "CNN_L": start_L[0], "CNN_P": start_P[0]}
+    start["lineage"], start["primary"] = [start.copy()], True
+    beam, found, failed = [start], [], []
+    visited = {(seq_H, seq_L)}
+    primary_CNN_evals = num_CNN_evals
+
+    i = 0
+    if verbose: print(f"Designing and scoring single-point variants for up to {num_designs} branches")
+    while len(beam) > 0:
+        # keep branches meeting the CNN targets if they are diverse enough
+        active = []
+        for d in beam:
+            if (d["CNN_H"] >= config["CNN_target_score_H"]) and (d["CNN_L"] >= config["CNN_target_score_L"]) and (d["CNN_P"] >= config["CNN_target_score_P"]):
+                if all(get_distance(d, other) >= min_distance for other in found):
+                    found.append(d)
+            else:
+                active.append(d)
+        if len(found) >= num_designs or len(active) == 0:
+            break
+        i += 1
+        if verbose: print(f"\tIt. #{i}\t{len(active)} active branches, {len(found)} designs found")
+
+        # score the variants of all branches in shared batches
+        for d in active:
+            variants_H, variants_L, variants_P = get_single_point_variants_of_design(d["Humatch_H"], d["Humatch_L"], config, pad=pad)
+            preds_H, evals_H = predict_unique(variants_H, cnn_heavy, target_gene_H, "heavy")
+            preds_L, evals_L = predict_unique(variants_L, cnn_light, target_gene_L, "light")
+            preds_P, evals_P = predict_unique(variants_P, cnn_paired, "true", "paired")
+            num_CNN_evals += evals_H + evals_L + evals_P
+            if d.get("primary", False):
+                primary_CNN_evals += len(variants_H) + len(variants_L) + len(variants_P)
+
+            # rank variants as humanise would (best total scaled prediction first)
+            preds_H_scaled, preds_L_scaled, preds_P_scaled = scale_predictions(
+                d["Humatch_H"], d["Humatch_L"], variants_H, variants_L, preds_H, preds_L, preds_P, d["CNN_H"], d["CNN_L"], d["CNN_P"],
+                germline_likeness_lookup_arrays_dir, target_gene_H, target_gene_L, config["CNN_target_score_H"],
+                config["CNN_target_score_L"], config["CNN_target_score_P"])
+            ranking = np.argsort(-(np.concatenate([preds_H_scaled, preds_L_scaled]) + preds_P_scaled), kind="stable")
+            d["children"] = ({"Humatch_H": variants_H[idx], "Humatch_L": d["Humatch_L"], "CNN_H": preds_H[idx], "CNN_L": d["CNN_L"],
+                              "CNN_P": preds_P[idx]} if idx < len(variants_H) else
+                             {"Humatch_H": d["Humatch_H"], "Humatch_L": variants_L[idx - len(variants_H)], "CNN_H": d["CNN_H"],
+                              "CNN_L": preds_L[idx - len(variants_H)], "CNN_P": preds_P[idx]} for idx in ranking)
+
+        # fill the new beam with the greedy step of each branch, then their next best alternatives
+        new_beam, width = [], num_designs - len(found)
+        lineage_seqs = {id(d): {(state["Humatch_H"], state["Humatch_L"]) for state in d["lineage"]} for d in active}
+        stepped = set()
+        for rank in range(width):
+            for d in active:
+                if len(new_beam) >= width:
+                    break
+                # the first branch only avoids its own lineage (as humanise), others avoid every design seen
+                child = next((c for c in d["children"] if (c["Humatch_H"], c["Humatch_L"]) not in
+                              (lineage_seqs[id(d)] if d.get("primary", False) and rank == 0 else visited)), None)
+                if child is None:
+                    if id(d) not in stepped:
+                        failed.append(d)
+                        stepped.add(id(d))
+                    continue
+                child["lineage"], child["primary"] = d["lineage"] + [dict(child)], d.get("primary", False) and rank == 0
+                visited.add((child["Humatch_H"], child["Humatch_L"]))
+                stepped.add(id(d))
+                if get_edit_distance(precursor_seq_P, child["Humatch_H"] + pad + child["Humatch_L"]) > config["max_edit"]:
+                    failed.append(child)
+                else:
+                    new_beam.append(child)
+        beam = new_beam
+
+    # fill any remaining places with the best design of failed branches (as humanise returns when failing)
+    results = [dict(d, Failed=False) for d in found[:num_designs]]
+    best_failed = [max(d["lineage"], key=lambda state: state["CNN_H"] + state["CNN_L"] + state["CNN_P"])
+                   for d in failed + [d for d in beam if all(d is not other for other in found)]]
+    for best in sorted(best_failed, key=lambda state: -(state["CNN_H"] + state["CNN_L"] + state["CNN_P"])):
+        if len(results) < num_designs and all(get_distance(best, other) >= min_distance for other in results):
+            results.append(dict(best, Failed=True))
+    results = [{"Humatch_H": d["Humatch_H"], "Humatch_L": d["Humatch_L"], "Edit": get_edit_distance(precursor_seq_P, d["Humatch_H"] + pad + d["Humatch_L"]),
+                "HV": target_gene_H, "LV": target_gene_L, "CNN_H": d["CNN_H"], "CNN_L": d["CNN_L"], "CNN_P": d["CNN_P"], "Failed": d["Failed"]}
+               for d in results]
+    stats = {"diverse_CNN_evals": num_CNN_evals, "separate_CNN_evals": num_designs * primary_CNN_evals}
+    return sorted(results, key=lambda r: (r["Failed"], r["Edit"], -(r["CNN_H"] + r["CNN_L"] + r["CNN_P"]))), stats
+
+
+def get_single_point_variants_of_design(best_seq_H, best_seq_L, config, pad="----------"):
+    '''
+    Get all heavy, light and paired single point variants of a design allowed by the config
+
+    :param best_seq_H/L: str, current heavy/light chain design
+    :param config: dict, humanisation config
+    :returns: three lists of str, heavy variants, light variants and paired variants (heavy then light)
+    '''
+    variants_H = get_all_single_point_variants(best_seq_H, config["CNN_allow_CDR_mutations_H"], config["CNN_fixed_imgt_positions_H"])
+    variants_L = get_all_single_point_variants(best_seq_L, config["CNN_allow_CDR_mutations_L"], config["CNN_fixed_imgt_positions_L"])
+    variants_P = [H + pad + best_seq_L for H in variants_H] + [best_seq_H + pad + L for L in variants_L]
+    return variants_H, variants_L, variants_P
+
+
+def select_best_variant(best_seq_H, best_seq_L, variants_H, variants_L, preds_H, preds_L, preds_P,
+                        max_pred_H, max_pred_L, max_pred_P, all_designed_seqs, target_gene_H, target_gene_L,
+                        config, germline_likeness_lookup_arrays_dir=GL_DIR):
+    '''
+    Scale variant predictions and select the next design (one greedy humanisation step)
+
+    :param best_seq_H/L: str, current heavy/light chain design
+    :param variants_H/L: list of str, variants for heavy/light chain
+    :param preds_H/L/P: ndarray of target class predictions for heavy/light/paired variants
+    :param max_pred_H/L/P: float, target class prediction of the current design
+    :param all_designed_seqs: list of tuples of str, all designed sequences
+    :param target_gene_H/L: str, target gene for heavy/light chain
+    :param config: dict, humanisation config
+    :returns: str, str, float, float, float, bool, see get_best_variant_based_on_total_scaled_predictions
+    '''
+    # scale/weight predictions
+    preds_H_scaled, preds_L_scaled, preds_P_scaled = scale_predictions(best_seq_H, best_seq_L, variants_H, variants_L,
+                                                                      preds_H, preds_L, preds_P, max_pred_H, max_pred_L, max_pred_P,
+                                                                      germline_likeness_lookup_arrays_dir, target_gene_H, target_gene_L,
+                                                                      config["CNN_target_score_H"], config["CNN_target_score_L"],
+                                                                      config["CNN_target_score_P"])
+
+    # get total scaled predictions for each variant - each variant affects two predictions (heavy|light and paired)
+    preds_H_then_L_scaled = np.concatenate([preds_H_scaled, preds_L_scaled], axis=0)
+    preds_total_scaled = preds_H_then_L_scaled + preds_P_scaled
+
+    # get best variant based on total scaled predictions
+    return get_best_variant_based_on_total_scaled_predictions(best_seq_H, best_seq_L, variants_H, variants_L,
+                                                              preds_H, preds_L, preds_P, max_pred_H, max_pred_L, max_pred_P,
+                                                              all_designed_seqs, preds_total_scaled)
+
+
+def score_and_select_variant(best_seq_H, best_seq_L, variants_H, variants_L, candidates, preds_H, preds_L, preds_P,
+                             max_pred_H, max_pred_L, max_pred_P, all_designed_seqs, cnn_heavy, cnn_light, cnn_paired,
+                             target_gene_H, target_gene_L, config, germline_likeness_lookup_arrays_dir=GL_DIR,
+                             pad="----------", cache=None, stats=None):
+    '''
+    Score candidate variants of a design with the CNNs and select the next design
+    Predictions are written into preds_H/L/P in place and variants already scored (not NaN) are not
+    re-scored, so this can be called again with more candidates without repeating CNN evaluations.
+    If config["paired_shortlist_size"] (K) is set, candidates are first ranked on the heavy/light CNN and
+    germline terms and only the top-K shortlist is scored with the paired CNN (the most expensive model)
+
+    :param best_seq_H/L: str, current heavy/light chain design
+    :param variants_H/L: list of str, all variants for heavy/light chain
+    :param candidates: ndarray of bool (# heavy + # light variants), variants that may be selected
+    :param preds_H/L/P: ndarray of target class predictions for all variants (NaN = not scored yet)
+    :param max_pred_H/L/P: float, target class prediction of the current design
+    :param all_designed_seqs: list of tuples of str, all designed sequences
+    :param cnn_heavy/light/paired: model e.g. trained CNN for heavy/light/paired chain
+    :param target_gene_H/L: str, target gene for heavy/light chain
+    :param config: dict, humanisation config
+    :param stats: dict, optional search statistics to add to
+    :returns: new design as get_best_variant_based_on_total_scaled_predictions (None if no candidates)
+        and int # CNN evaluations made
+    '''
+    stats = {} if stats is None else stats
+    num_H = len(variants_H)
+    variants_P = [H + pad + best_seq_L for H in variants_H] + [best_seq_H + pad + L for L in variants_L]
+    if not candidates.any():
+        return None, 0
+
+    def score_missing(preds, variants, mask, model, target_class, classifier_type):
+        idxs = np.where(mask & np.isnan(preds))[0]
+        if len(idxs) > 0:
+            preds[idxs] = get_predictions_for_target_class([variants[i] for i in idxs], model, target_class, classifier_type,
+                                                           num_cpus=config["num_cpus"], cache=cache)
+        return len(idxs)
+
+    def select(mask):
+        mask_H, mask_L = mask[:num_H], mask[num_H:]
+        return select_best_variant(best_seq_H, best_seq_L, subset_variants(variants_H, mask_H), subset_variants(variants_L, mask_L),
+                                   preds_H[mask_H], preds_L[mask_L], preds_P[mask], max_pred_H, max_pred_L, max_pred_P,
+                                   all_designed_seqs, target_gene_H, target_gene_L, config, germline_likeness_lookup_arrays_dir)
+
+    # heavy and light CNN scores
+    num_CNN_evals = score_missing(preds_H, variants_H, candidates[:num_H], cnn_heavy, target_gene_H, "heavy")
+    num_CNN_evals += score_missing(preds_L, variants_L, candidates[num_H:], cnn_light, target_gene_L, "light")
+
+    # optionally shortlist the best variants on the heavy/light CNN and germline terms for the paired CNN
+    shortlist = candidates
+    shortlist_size = config.get("paired_shortlist_size", None)
+    if shortlist_size is not None and candidates.sum() > shortlist_size:
+        candidate_idxs = np.where(candidates)[0]
+        candidates_H, candidates_L = candidates[:num_H], candidates[num_H:]
+        # paired predictions equal to the current design's contribute the same to every variant
+        preds_H_scaled, preds_L_scaled, _ = scale_predictions(best_seq_H, best_seq_L, subset_variants(variants_H, candidates_H),
+                                                              subset_variants(variants_L, candidates_L), preds_H[candidates_H],
+                                                              preds_L[candidates_L], np.full(len(candidate_idxs), max_pred_P),
+                                                              max_pred_H, max_pred_L, max_pred_P, germline_likeness_lookup_arrays_dir,
+                                                              target_gene_H, target_gene_L, config["CNN_target_score_H"],
+                                                              config["CNN_target_score_L"], config["CNN_target_score_P"])
+        ranking_scores = np.concatenate([preds_H_scaled, preds_L_scaled])
+        shortlist = np.zeros(len(candidates), dtype=bool)
+        shortlist[candidate_idxs[np.argsort(-ranking_scores, kind="stable")[:shortlist_size]]] = True
+        add_to_stats(stats, paired_shortlist_iterations=1, paired_shortlist_skipped=int(candidates.sum() - shortlist.sum()))
+
+    # paired CNN scores and selection
+    num_CNN_evals += score_missing(preds_P, variants_P, shortlist, cnn_paired, "true", "paired")
+    new_design = select(shortlist)
+
+    # score all candidates with the paired CNN if every shortlisted variant was designed before
+    if shortlist is not candidates and (new_design[5] or config.get("paired_shortlist_diagnostic", False)):
+        num_CNN_evals += score_missing(preds_P, variants_P, candidates, cnn_paired, "true", "paired")
+        exhaustive_design = select(candidates)
+        if new_design[5]:
+            add_to_stats(stats, paired_shortlist_fallbacks=1)
+            new_design = exhaustive_design
+        else:
+            add_to_stats(stats, paired_shortlist_diagnostic_iterations=1,
+                         paired_shortlist_changed_choices=int(exhaustive_design[:2] != new_design[:2]))
+    return new_design, num_CNN_evals
+
+
+def subset_variants(variants, mask):
+    '''
+    Get the variants where mask is True
+    :param variants: list of str variants
+    :param mask: ndarray of bool, same length as variants
+    :returns: list of str variants
+    '''
+    return [variant for variant, keep in zip(variants, mask) if keep]
+
+
+def get_variant_position_and_AA_idxs(seq, variants):
+    '''
+    Vectorised get_position_idx_and_AA_idx_diff for many single point variants of a sequence
+    :param seq: str, sequence
+    :param variants: list of str single point variants of seq
+    :returns: two ndarrays of int, mutated position index and new AA index of each variant
+    '''
+    if len(variants) == 0:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+    AA_codes = get_ordered_AA_one_letter_codes()
+    seq_tokens = seq_strs_to_token_array([seq], AA_codes)[0]
+    variant_tokens = seq_strs_to_token_array(variants, AA_codes)
+    pos_idxs = np.argmax(variant_tokens != seq_tokens, axis=1)
+    return pos_idxs, variant_tokens[np.arange(len(variants)), pos_idxs].astype(int)
+
+
+def get_germline_prefilter_mask(seq, variants, germline_likeness_lookup_arr, min_freq=0.0, top_m=None):
+    '''
+    Flag variants whose new residue is common in germline at the mutated position
+    Variants introducing residues rarely (or never) observed for the target gene are almost never
+    selected once predictions are scaled by observed frequency, so they can be deferred
+
+    :param seq: str, sequence
+    :param variants: list of str single point variants of seq
+    :param germline_likeness_lookup_arr: np.array, observed position AA frequencies, shape (200, 20)
+    :param min_freq: float, min observed frequency of the new residue at the mutated position
+    :param top_m: int, only keep the top_m most observed residues at each position (None = no limit)
+    :returns: ndarray of bool, True for variants to score, False for deferred variants
+    '''
+    pos_idxs, AA_idxs = get_variant_position_and_AA_idxs(seq, variants)
+    keep = germline_likeness_lookup_arr[pos_idxs, AA_idxs] >= min_freq
+    if top_m is not None:
+        # rank of each AA at each position, 0 = most observed
+        AA_ranks = np.argsort(np.argsort(-germline_likeness_lookup_arr, axis=1), axis=1)
+        keep &= AA_ranks[pos_idxs, AA_idxs] < top_m
+    return keep
+
+
+def add_to_stats(stats, **counts):
+    '''
+    Add counts to a dict of search statistics
+    '''
+    for key, count in counts.items():
+        stats[key] = stats.get(key, 0) + count
+
+
+def get_empty_warm_start_library(seq_len=200):
+    '''
+    Get an empty library of previously humanised antibodies to warm start humanisation from
+    :returns: dict of parent token array (# antibodies, 2 * seq_len), parent and humanised sequence pairs
+        and target gene pairs
+    '''
+    return {"parent_tokens": np.zeros((0, 2 * seq_len), dtype=np.uint8), "parents": [], "humanised": [], "genes": []}
+
+
+def add_to_warm_start_library(library, parents_H, parents_L, humanised_H, humanised_L, genes_H, genes_L):
+    '''
+    Add humanised antibodies (and the aligned parents they came from) to a warm start library in place
+    '''
+    if len(parents_H) == 0:
+        return
+    tokens = seq_strs_to_token_array([H + L for H, L in zip(parents_H, parents_L)], get_ordered_AA_one_letter_codes())
+    library["parent_tokens"] = np.concatenate([library["parent_tokens"], tokens])
+    library["parents"].extend(zip(parents_H, parents_L))
+    library["humanised"].extend(zip(humanised_H, humanised_L))
+    library["genes"].extend(zip(genes_H, genes_L))
+
+
+def load_warm_start_library(path):
+    '''
+    Load previously humanised antibodies to warm start from e.g. Humatch-humanise output saved with --include_input
+    :param path: str, path to csv with aligned parent (VH, VL) and humanised (Humatch_H, Humatch_L) sequences and
+        target genes (HV, LV)
+    :returns: dict, warm start library
+    '''
+    df = pd.read_csv(path)
+    missing_cols = [col for col in ["VH", "VL", "Humatch_H", "Humatch_L", "HV", "LV"] if col not in df.columns]
+    if len(missing_cols) > 0:
+        raise ValueError(f"Warm start library {path} is missing columns {missing_cols}")
+    if any(len(seq) != len(CANONICAL_NUMBERING) for seq in df["VH"].tolist() + df["VL"].tolist()):
+        raise ValueError(f"Warm start library {path} parents (VH, VL) must be aligned - see Humatch-align")
+    library = get_empty_warm_start_library()
+    add_to_warm_start_library(library, df["VH"].tolist(), df["VL"].tolist(), df["Humatch_H"].tolist(), df["Humatch_L"].tolist(),
+                              df["HV"].tolist(), df["LV"].tolist())
+    return library
+
+
+def load_classified(path, vh_col="VH", vl_col="VL"):
+    '''
+    Load Humatch-classify output to humanise without realigning or re-predicting target genes - the aligned VH/VL
+    are reused with the top scoring genes (hv/lv columns of summarised output, otherwise the highest scoring gene
+    columns) and their CNN scores (CNN_H, CNN_L, CNN_P) as the starting scores. Missing values (e.g. rows a cascade
+    screen decided early) are returned as None and recomputed during humanisation
+
+    :param path: str, path to csv output of Humatch-classify with both VH and VL
+    :returns: lists of aligned VH, aligned VL, heavy and light target genes, start score tuples (see humanise_iter)
+        and Fv ids (None if the output has no ID column)
+    '''
+    df = pd.read_csv(path)
+    if vh_col not in df.columns or vl_col not in df.columns:
+        raise ValueError(f"Classification output {path} must have both VH and VL columns ('{vh_col}' and '{vl_col}')")
+    if any(len(seq) != len(CANONICAL_NUMBERING) for seq in df[vh_col].tolist() + df[vl_col].tolist()):
+        raise ValueError(f"Classification output {path} sequences must be aligned - see Humatch-classify")
+    genes, scores = {}, {}
+    for chain, gene_classes in [("H", HEAVY_V_GENE_CLASSES[1:]), ("L", LIGHT_V_GENE_CLASSES[1:])]:
+        gene_col, score_col = f"{chain.lower()}v", f"CNN_{chain}"
+        if gene_col in df.columns:
+            genes[chain] = df[gene_col].tolist()
+            scores[chain] = df[score_col].tolist() if score_col in df.columns else [None] * len(df)
+        elif all(gene in df.columns for gene in gene_classes):
+            gene_scores = df[gene_classes].to_numpy()
+            genes[chain] = np.array(gene_classes)[np.argmax(gene_scores, axis=1)].tolist()
+            scores[chain] = np.max(gene_scores, axis=1).tolist()
+        else:
+            genes[chain], scores[chain] = [None] * len(df), [None] * len(df)
+    scores["P"] = df["CNN_P"].tolist() if "CNN_P" in df.columns else [None] * len(df)
+    # no score without its gene
+    for chain in ["H", "L"]:
+        genes[chain] = [gene if isinstance(gene, str) else None for gene in genes[chain]]
+        scores[chain] = [score if gene is not None else None for gene, score in zip(genes[chain], scores[chain])]
+    start_scores = [tuple(None if score is None or np.isnan(score) else score for score in row_scores)
+                    for row_scores in zip(scores["H"], scores["L"], scores["P"])]
+    ids = df["ID"].tolist() if "ID" in df.columns else None
+    return df[vh_col].tolist(), df[vl_col].tolist(), genes["H"], genes["L"], start_scores, ids
+
+
+def get_warm_start_seed(heavy_seq, light_seq, library, config, max_distance=None, target_genes=None):
+    '''
+    Seed a design from the nearest previously humanised antibody (Hamming distance between the aligned heavy and
+    light parents) - its accepted framework mutations are applied wherever this antibody has the same starting
+    residue as the neighbour's parent (and the position is not fixed in config)
+
+    :param heavy/light_seq: str, aligned heavy/light chain sequence to humanise
+    :param library: dict, warm start library (see load_warm_start_library)
+    :param config: dict, humanisation config (for fixed IMGT positions)
+    :param max_distance: int, max Hamming distance to the nearest parent (None = no limit)
+    :param target_genes: tuple of str, if given only antibodies humanised towards these heavy and light genes are used
+    :returns: seeded heavy and light sequences and the neighbour's heavy and light target genes
+        (None if there is no neighbour within max_distance)
+    '''
+    if len(library["parents"]) == 0:
+        return None
+    tokens = seq_strs_to_token_array([heavy_seq + light_seq], get_ordered_AA_one_letter_codes())
+    distances = np.sum(library["parent_tokens"] != tokens, axis=1).astype(float)
+    if target_genes is not None:
+        distances[[tuple(genes) != tuple(target_genes) for genes in library["genes"]]] = np.inf
+    nearest = int(np.argmin(distances))
+    if np.isinf(distances[nearest]) or (max_distance is not None and distances[nearest] > max_distance):
+        return None
+    seeded_seqs = []
+    for seq, parent, humanised, chain in zip([heavy_seq, light_seq], library["parents"][nearest], library["humanised"][nearest], ["H", "L"]):
+        fixed_idxs = set(get_CDR_loop_indices()) | set(get_indices_of_selected_imgt_positions_in_canonical_numbering(
+            config.get(f"CNN_fixed_imgt_positions_{chain}", []) + config.get(f"GL_fixed_imgt_positions_{chain}", [])))
+        seeded_seq = seq
+        for idx, (AA, parent_AA, humanised_AA) in enumerate(zip(seq, parent, humanised)):
+            if (AA == parent_AA != humanised_AA) and (humanised_AA != "-") and (idx not in fixed_idxs):
+                seeded_seq = point_mutate_seq(seeded_seq, idx, humanised_AA)
+        seeded_seqs.append(seeded_seq)
+    return (*seeded_seqs, *library["genes"][nearest])
+
+
+def get_input_gradient(model, seq, class_idx):
+    '''
+    Gradient of a CNN class score with respect to the Kidera encoding of the input sequence
+    :param model: model e.g. trained CNN, or BucketedPredictor
+    :param seq: str, aligned (heavy, light or paired) sequence
+    :param class_idx: int, index of the class score to differentiate
+    :returns: ndarray (seq len, 10) of d(score)/d(Kidera factors)
+    '''
+    keras_model = model.model if isinstance(model, BucketedPredictor) else model
+    X = tf.convert_to_tensor(seq_strs_to_kidera_array([seq]))
+    with tf.GradientTape() as tape:
+        tape.watch(X)
+        score = keras_model(X, training=False)[0, class_idx]
+    return tape.gradient(score, X).numpy()[0]
+
+
+def get_first_order_score_changes(seq, gradient):
+    '''
+    First order (saliency) estimate of the change in a CNN score for every substitution of a sequence - the
+    input gradient projected onto the change in Kidera factors from the current to the new amino acid
+
+    :param seq: str, aligned sequence
+    :param gradient: ndarray (seq len, 10), see get_input_gradient
+    :returns: ndarray (seq len, 20) of estimated score changes (ordered as get_ordered_AA_one_letter_codes)
+    '''
+    AA_kideras = KIDERA_ARRAY[[KIDERA_AA_CODES.index(AA) for AA in get_ordered_AA_one_letter_codes()[:20]]]
+    seq_kideras = seq_strs_to_kidera_array([seq])[0]
+    return gradient @ AA_kideras.T - np.sum(gradient * seq_kideras, axis=1, keepdims=True)
+
+
+def get_saliency_mask(best_seq_H, best_seq_L, variants_H, variants_L, cnn_heavy, cnn_light, cnn_paired,
+                      target_gene_H, target_gene_L, unmet, budget, pad="----------"):
+    '''
+    Rank all heavy and light single point variants by the first order estimate of their gain in the (unmet)
+    CNN scores, from one input gradient of each CNN, and keep only the top candidates for exact scoring
+
+    :param best_seq_H/L: str, current heavy/light design
+    :param variants_H/L: list of str, single point variants of best_seq_H/L
+    :param cnn_heavy/light/paired: model e.g. trained CNN for heavy/light/paired chain
+    :param target_gene_H/L: str, target genes
+    :param unmet: ndarray of 3 bools, which of CNN_H, CNN_L and CNN_P are still below their targets
+    :param budget: int, number of variants to keep
+    :returns: ndarray of bools, True for the top candidates (heavy then light variants)
+    '''
+    changes_H = get_first_order_score_changes(best_seq_H, get_input_gradient(cnn_heavy, best_seq_H, HEAVY_V_GENE_CLASSES.index(target_gene_H)))
+    changes_L = get_first_order_score_changes(best_seq_L, get_input_gradient(cnn_light, best_seq_L, LIGHT_V_GENE_CLASSES.index(target_gene_L)))
+    best_seq_P = best_seq_H + pad + best_seq_L
+    changes_P = get_first_order_score_changes(best_seq_P, get_input_gradient(cnn_paired, best_seq_P, PAIRED_TRUE_IDX))
+    gains = []
+    for seq, variants, changes, changes_P_chain, chain_idx in [(best_seq_H, variants_H, changes_H, changes_P[:len(best_seq_H)], 0),
+                                                               (best_seq_L, variants_L, changes_L, changes_P[len(best_seq_H) + len(pad):], 1)]:
+        pos_idxs, AA_idxs = get_variant_position_and_AA_idxs(seq, variants)
+        gains.append(unmet[chain_idx] * changes[pos_idxs, AA_idxs] + unmet[2] * changes_P_chain[pos_idxs, AA_idxs])
+    gains = np.concatenate(gains)
+    mask = np.zeros(len(gains), dtype=bool)
+    mask[np.argsort(-gains, kind="stable")[:budget]] = True
+    return mask
+
+
+def fit_surrogate(best_seq_H, best_seq_L, variants_H, variants_L, preds_H, preds_L, preds_P, max_pred_H, max_pred_L, max_pred_P):
+    '''
+    Fit an additive per-position surrogate of the CNN scores from a single point variant scan i.e. the
+    change in each score for every substitution, assumed independent of any other substitution
+
+    :param best_seq_H/L: str, current heavy/light design the variants were made from
+    :param variants_H/L: list of str, single point variants of best_seq_H/L
+    :param preds_H/L/P: ndarray of CNN scores of the variants (NaN if not scored)
+    :param max_pred_H/L/P: float, CNN scores of the current design
+    :returns: dict of chain ("H"/"L") to ndarray (seq len, 20, 3) of predicted change in CNN_H, CNN_L and
+        CNN_P for each substitution (NaN if the variant was not scored by its chain CNN)
+    '''
+    base_preds = np.array([max_pred_H, max_pred_L, max_pred_P], dtype=np.float32)
+    surrogate = {}
+    for chain, seq, variants, preds, chain_preds_P in [("H", best_seq_H, variants_H, preds_H, preds_P[:len(variants_H)]),
+                                                       ("L", best_seq_L, variants_L, preds_L, preds_P[len(variants_H):])]:
+        chain_idx = 0 if chain == "H" else 1
+        deltas = np.zeros((len(variants), 3), dtype=np.float32)
+        deltas[:, chain_idx] = preds - base_preds[chain_idx]
+        # variants not scored by the paired CNN (e.g. outside the paired shortlist) are assumed not to change it
+        deltas[:, 2] = np.nan_to_num(chain_preds_P - base_preds[2], nan=0.0)
+        deltas[np.isnan(preds)] = np.nan
+        surrogate[chain] = np.full((len(seq), 20, 3), np.nan, dtype=np.float32)
+        pos_idxs, AA_idxs = get_variant_position_and_AA_idxs(seq, variants)
+        surrogate[chain][pos_idxs, AA_idxs] = deltas
+    return surrogate
+
+
+def propose_surrogate_jump(surrogate, best_seq_H, best_seq_L, base_preds, target_preds, max_mutations):
+    '''
+    Use the surrogate to propose several mutations at once - substitutions are taken best first (by predicted
+    gain in the scores still below target, at most one per position) until all scores are predicted to reach
+    their targets, skipping any predicted to push a score that meets its target below it
+
+    :param surrogate: dict, see fit_surrogate
+    :param best_seq_H/L: str, current heavy/light design
+    :param base_preds: ndarray, current CNN_H, CNN_L and CNN_P scores
+    :param target_preds: ndarray, target CNN_H, CNN_L and CNN_P scores
+    :param max_mutations: int, max number of mutations in the jump
+    :returns: heavy and light sequences after the jump, and their predicted scores (None if nothing to propose)
+    '''
+    unmet = (base_preds < target_preds).astype(np.float32)
+    AA_codes = get_ordered_AA_one_letter_codes()
+    proposals = []
+    for chain in ["H", "L"]:
+        gains = np.where(np.isnan(surrogate[chain][:, :, 0]), -np.inf, np.nansum(surrogate[chain] * unmet, axis=2))
+        best_AA_idxs = np.argmax(gains, axis=1)
+        best_gains = gains[np.arange(len(gains)), best_AA_idxs]
+        proposals += [(best_gains[pos], chain, pos, best_AA_idxs[pos]) for pos in np.flatnonzero(best_gains > 0)]
+
+    seqs = {"H": best_seq_H, "L": best_seq_L}
+    predicted_preds, num_mutations = base_preds.copy(), 0
+    for _, chain, pos, AA_idx in sorted(proposals, key=lambda x: -x[0]):
+        if num_mutations >= max_mutations or np.all(predicted_preds >= target_preds):
+            break
+        new_preds = predicted_preds + surrogate[chain][pos, AA_idx]
+        if np.any((predicted_preds >= target_preds) & (new_preds < target_preds)):
+            continue
+        seqs[chain] = point_mutate_seq(seqs[chain], pos, AA_codes[AA_idx])
+        predicted_preds, num_mutations = new_preds, num_mutations + 1
+    if num_mutations == 0:
+        return None
+    return seqs["H"], seqs["L"], predicted_preds
+
+
+def refine_surrogate(surrogate, old_seq_H, old_seq_L, new_seq_H, new_seq_L, old_preds, predicted_preds, verified_preds):
+    '''
+    Refine the surrogate (in place) with a CNN verified design - mutated positions are dropped (their changes were
+    relative to the old residue), and where the surrogate over-estimated a score's gain the remaining positive
+    changes in that score are shrunk by the same factor
+
+    :param surrogate: dict, see fit_surrogate
+    :param old_seq_H/L, new_seq_H/L: str, heavy/light designs before and after the verified step
+    :param old_preds/predicted_preds/verified_preds: ndarray, CNN_H, CNN_L and CNN_P scores before the step,
+        predicted by the surrogate and verified by the CNNs
+    '''
+    for chain, old_seq, new_seq in [("H", old_seq_H, new_seq_H), ("L", old_seq_L, new_seq_L)]:
+        mutated_idxs = [i for i, (old_AA, new_AA) in enumerate(zip(old_seq, new_seq)) if old_AA != new_AA]
+        surrogate[chain][mutated_idxs] = np.nan
+    predicted_gain, verified_gain = predicted_preds - old_preds, verified_preds - old_preds
+    for score_idx in np.flatnonzero(predicted_gain > 0):
+        shrink = np.clip(verified_gain[score_idx] / predicted_gain[score_idx], 0, 1)
+        for chain in ["H", "L"]:
+            deltas = surrogate[chain][:, :, score_idx]
+            surrogate[chain][:, :, score_idx] = np.where(deltas > 0, deltas * shrink, deltas)
 
 
 def scale_predictions(best_seq_H, best_seq_L, variants_H, variants_L,
@@ -182,7 +1133,7 @@ def scale_predictions(best_seq_H, best_seq_L, variants_H, variants_L,
     preds_P_net_GL_scaled = scale_predictions_by_observed_frequency(preds_P_net, scaling_factors_P)
 
     # make all predictions positive by adding the minimum prediction (equalises importance of all CNNs before scaling again)
-    min_overall = min(min(preds_H_net_GL_scaled), min(preds_L_net_GL_scaled), min(preds_P_net_GL_scaled))
+    min_overall = np.min(np.concatenate([preds_H_net_GL_scaled, preds_L_net_GL_scaled, preds_P_net_GL_scaled]))
     preds_H_net_GL_scaled_pos = preds_H_net_GL_scaled - min_overall
     preds_L_net_GL_scaled_pos = preds_L_net_GL_scaled - min_overall
     preds_P_net_GL_scaled_pos = preds_P_net_GL_scaled - min_overall
@@ -245,15 +1196,16 @@ def get_best_variant_based_on_total_scaled_predictions(best_seq_H, best_seq_L, v
     return new_best_seq_H, new_best_seq_L, new_max_pred_H, new_max_pred_L, new_max_pred_P, humanisation_failed
 
 
-def get_target_gene_if_none_provided(seq, model, chain_type):
+def get_target_gene_if_none_provided(seq, model, chain_type, cache=None):
     '''
     Use the highest scoring human gene as the target gene if none provided
     :param seq: str, sequence
     :param model: model e.g. trained CNN
     :param chain_type: str, heavy | light | paired
+    :param cache: PredictionCache, optional cache of CNN predictions
     :returns: str, target gene
     '''
-    preds = predict_from_list_of_seq_strs([seq], model)
+    preds = predict_from_list_of_seq_strs([seq], model, cache=cache)
     target_gene, _ = get_class_and_score_of_max_predictions_only(preds, chain_type)[0]
     return target_gene
 
@@ -381,11 +1333,23 @@ def command_line_interface():
     parser = argparse.ArgumentParser(prog="Humatch-humanise", description=description, formatter_class=argparse.RawDescriptionHelpFormatter)
     parser.add_argument("-H", "--VH", help="Heavy chain amino acid sequence", default=None)
     parser.add_argument("-L", "--VL", help="Light chain amino acid sequence", default=None)
-    parser.add_argument("-i", "--input", help="Path to csv with antibody sequences", default=None)
-    parser.add_argument("--vh_col", help="Column name for VH sequences in input file", default="VH")
-    parser.add_argument("--vl_col", help="Column name for VL sequences in input file", default="VL")
+    parser.add_argument("-i", "--input", help="Path to csv, tsv or FASTA with antibody sequences (optionally .gz or .zst compressed)", default=None)
+    parser.add_argument("--input_L", help="FASTA of light chains paired with the -i FASTA of heavy chains by id", default=None)
+    parser.add_argument("--vh_col", help="Column name for VH sequences in input file (id suffix of VH records in FASTA e.g. ab1_VH)", default="VH")
+    parser.add_argument("--vl_col", help="Column name for VL sequences in input file (id suffix of VL records in FASTA e.g. ab1_VL)", default="VL")
     parser.add_argument("--config", help="Path to config file", default=None)
     parser.add_argument("-a", "--aligned", help="Input sequences are prealigned to 200 KASearch positions", default=False, action="store_true")
+    parser.add_argument("--from_classified", help="Input is Humatch-classify output - its aligned VH/VL, top genes and CNN scores are reused "
+                        "so alignment and target gene prediction are skipped", default=False, action="store_true")
+    parser.add_argument("--num_cpus", help="Number of CPUs to use - overrides config num_cpus", default=None, type=int)
+    parser.add_argument("--warm_start", help="Path to csv of previously humanised antibodies (VH, VL, Humatch_H, Humatch_L, HV, LV) to warm start from - overrides config warm_start_library", default=None)
+    parser.add_argument("--include_input", help="Also output the aligned input VH and VL (e.g. to reuse the output as a warm start library)", default=False, action="store_true")
+    parser.add_argument("--sweep_CNN_targets", help="Sweep mode - CNN target scores (heavy, light and paired) to return designs for", nargs="+", type=float, default=None)
+    parser.add_argument("--top_k_genes", help="Humanise towards the top-k heavy and light V-genes at once and return all designs ranked", type=int, default=None)
+    parser.add_argument("--diverse_designs", help="Return this many diverse designs per antibody from a single beam search", type=int, default=None)
+    parser.add_argument("--min_distance", help="Diverse designs - min Hamming distance between returned designs", type=int, default=3)
+    parser.add_argument("--sweep_max_edits", help="Sweep mode - max edit distances to return designs for (defaults to config max_edit)", nargs="+", type=int, default=None)
+    parser.add_argument("--shard", help="Only process shard i of N of the input e.g. 0/8 (merge outputs with Humatch-merge)", default=None)
     parser.add_argument("-o", "--output", help="Output save path - defaults to the same dir as input", default=None)
     parser.add_argument("-v", "--verbose", help="Verbose output flag", default=False, action="store_true")
     args = parser.parse_args()
@@ -403,7 +1367,19 @@ def command_line_interface():
             raise ValueError("Cannot provide input file if VH or VL is given")
     if (args.VH is None and args.VL is not None) or (args.VH is not None and args.VL is None):
         raise ValueError("Humatch humanisation requires both VH and VL sequences")
-    if args.input is not None and (args.vh_col not in pd.read_csv(args.input).columns or args.vl_col not in pd.read_csv(args.input).columns):
+    if args.shard is not None and args.input is None:
+        raise ValueError("--shard requires an input file")
+    if args.input_L is not None and args.input is None:
+        raise ValueError("--input_L requires a FASTA input file of heavy chains")
+    if args.from_classified and (args.input is None or args.input_L is not None):
+        raise ValueError("--from_classified requires a single csv input file output by Humatch-classify")
+    if args.top_k_genes is not None and args.sweep_CNN_targets is not None:
+        raise ValueError("Cannot combine --top_k_genes with sweep mode")
+    if args.diverse_designs is not None and (args.top_k_genes is not None or args.sweep_CNN_targets is not None):
+        raise ValueError("Cannot combine --diverse_designs with --top_k_genes or sweep mode")
+    # check columns from the header only (FASTA records are always paired)
+    input_cols = get_input_columns(args.input) if args.input is not None and get_input_format(args.input) != "fasta" else None
+    if input_cols is not None and (args.vh_col not in input_cols or args.vl_col not in input_cols):
         raise ValueError(f"Humatch humanisation requires both VH and VL sequences. Could not find columns '{args.vh_col}' and '{args.vl_col}' in input file. Column names can be changed with --vh_col and --vl_col")
         
     # load default config if not given
@@ -417,20 +1393,41 @@ def command_line_interface():
     # get sequences
     H_seqs, L_seqs = [args.VH] if args.VH else [], [args.VL] if args.VL else []
     vh_col, vl_col = args.vh_col, args.vl_col
-    if args.input: df = pd.read_csv(args.input); H_seqs.extend(df[vh_col].tolist() if vh_col in df.columns else []); L_seqs.extend(df[vl_col].tolist() if vl_col in df.columns else [])
+    read_stats, ids, classified = {}, None, None
+    if args.from_classified:
+        H_seqs, L_seqs, *classified, ids = load_classified(args.input, vh_col, vl_col)
+        if args.verbose: print(f"Reusing alignment, target genes and CNN scores of {len(H_seqs)} classified Fvs")
+    elif args.input:
+        ids, H_seqs, L_seqs = read_input(args.input, vh_col, vl_col, paired_path=args.input_L, stats=read_stats)
+        if args.verbose: print(format_read_stats(read_stats))
+    # FASTA ids are saved with the output (csv/tsv rows are identified by order), as are the ids of classified FASTA input
+    save_ids = args.input is not None and (get_input_format(args.input) == "fasta" or (args.from_classified and ids is not None))
+
+    # keep only this shard's Fvs (balanced by predicted work)
+    input_rows, num_input_rows = list(range(max(len(H_seqs), len(L_seqs)))), max(len(H_seqs), len(L_seqs))
+    if args.shard is not None:
+        H_seqs, L_seqs, input_rows, shard_idx, num_shards = select_shard(H_seqs, L_seqs, args.shard, aligned=args.aligned, humanise=True)
+        if args.verbose: print(f"Shard {shard_idx}/{num_shards}: {len(input_rows)}/{num_input_rows} Fvs")
+
+    # split the CPU budget between alignment, sequence encoding and TF - config num_cpus
+    # is the total budget, encoding during humanisation then uses its share of it
+    cpu_budget = configure_cpus(args.num_cpus if args.num_cpus is not None else config.get("num_cpus", None), verbose=args.verbose)
+    config["num_cpus"] = cpu_budget["encode_workers"]
 
     # align
-    if not args.aligned:
+    if not args.aligned and not args.from_classified:
         if args.verbose:
             num_seq_info = "" if args.input is None else f" ({len(H_seqs)} VH, {len(L_seqs)} VL)"
             print(f"\nAligning sequences{num_seq_info}")
-        H_seqs = [get_padded_seq(strip_padding_from_seq(seq)) for seq in H_seqs]
-        L_seqs = [get_padded_seq(strip_padding_from_seq(seq)) for seq in L_seqs]
+        aligned_seqs = align_seqs(H_seqs + L_seqs, num_cpus=cpu_budget["align_workers"])
+        H_seqs, L_seqs = aligned_seqs[:len(H_seqs)], aligned_seqs[len(H_seqs):]
     
     # check if ANARCI failed on any sequences and remove them
     failed_H_idxs = [i for i, seq in enumerate(H_seqs) if seq == "-"*len(CANONICAL_NUMBERING)]
     failed_L_idxs = [i for i, seq in enumerate(L_seqs) if seq == "-"*len(CANONICAL_NUMBERING)]
     all_failed_idxs = list(set(failed_H_idxs + failed_L_idxs))
+    failed_rows = [input_rows[i] for i in sorted(all_failed_idxs)]
+    input_rows = [row for i, row in enumerate(input_rows) if i not in all_failed_idxs]
     H_seqs = [seq for i, seq in enumerate(H_seqs) if i not in all_failed_idxs]
     L_seqs = [seq for i, seq in enumerate(L_seqs) if i not in all_failed_idxs]
     if len(failed_H_idxs) > 0 or len(failed_L_idxs) > 0:
@@ -438,33 +1435,145 @@ def command_line_interface():
 
     # load CNNs
     if args.verbose: print("Loading CNNs")
-    cnn_heavy = load_cnn(HEAVY_WEIGHTS, "heavy")
-    cnn_light = load_cnn(LIGHT_WEIGHTS, "light")
-    cnn_paired = load_cnn(PAIRED_WEIGHTS, "paired")
+    cnn_heavy = compile_cnn(load_cnn(get_weights_path("heavy", config.get("CNN_compressed_rank")), "heavy"), config)
+    cnn_light = compile_cnn(load_cnn(get_weights_path("light", config.get("CNN_compressed_rank")), "light"), config)
+    cnn_paired = compile_cnn(load_cnn(get_weights_path("paired", config.get("CNN_compressed_rank")), "paired"), config)
+
+    # optional cache of CNN predictions shared across all antibodies (and runs if a path is given)
+    cache = None
+    if config.get("prediction_cache_size", 0) > 0:
+        cache = PredictionCache(max_size=config["prediction_cache_size"], path=config.get("prediction_cache_path", None))
+        if args.verbose: print(f"Loaded prediction cache with {len(cache)} entries")
+
+    # optional library of previously humanised antibodies to warm start from (grows with each antibody humanised here)
+    warm_start = None
+    warm_start_path = args.warm_start if args.warm_start is not None else config.get("warm_start_library", None)
+    if warm_start_path is not None or config.get("warm_start", False):
+        if args.top_k_genes is not None or args.sweep_CNN_targets is not None or args.diverse_designs is not None:
+            raise ValueError("Warm start cannot be combined with --top_k_genes, sweep mode or --diverse_designs")
+        warm_start = load_warm_start_library(warm_start_path) if warm_start_path is not None else get_empty_warm_start_library()
+        if args.verbose: print(f"Loaded warm start library with {len(warm_start['parents'])} antibodies")
 
     # humanising sequences
-    results = []
+    results, result_rows = [], []
+    sweep_stats = {"sweep_CNN_evals": 0, "separate_CNN_evals": 0}
+    search_stats = {}
     if args.verbose: print(f"Humanising {len(H_seqs)} sequences")
     for i, (H_seq, L_seq) in enumerate(zip(H_seqs, L_seqs)):
         if args.verbose: print(f"\nHumanising sequence {i+1}/{len(H_seqs)}")
-        results.append(humanise(H_seq, L_seq, cnn_heavy, cnn_light, cnn_paired, config, verbose=args.verbose))
+        # classified top genes are the target genes (unless set in the config) and their scores the starting scores
+        Fv_config, start_scores = config, None
+        if classified is not None and args.top_k_genes is None:
+            genes_H, genes_L, classified_scores = classified
+            gene_H, gene_L, (score_H, score_L, score_P) = genes_H[input_rows[i]], genes_L[input_rows[i]], classified_scores[input_rows[i]]
+            Fv_config = dict(config, **{key: gene for key, gene in [("target_gene_H", gene_H), ("target_gene_L", gene_L)]
+                                        if gene is not None and key not in config})
+            start_scores = (score_H if gene_H is not None and Fv_config.get("target_gene_H") == gene_H else None,
+                            score_L if gene_L is not None and Fv_config.get("target_gene_L") == gene_L else None, score_P)
+            add_to_stats(search_stats, classified_Fvs=1, classified_target_genes=int("target_gene_H" not in config and gene_H is not None) +
+                         int("target_gene_L" not in config and gene_L is not None))
+        if args.top_k_genes is not None:
+            new_results = [dict({"Input_idx": input_rows[i], "Rank": rank+1}, **result) for rank, result in
+                           enumerate(humanise_multi_gene(H_seq, L_seq, cnn_heavy, cnn_light, cnn_paired, config, top_k_H=args.top_k_genes,
+                                                         top_k_L=args.top_k_genes, verbose=args.verbose, cache=cache))]
+        elif args.sweep_CNN_targets is not None:
+            sweep_results, stats = humanise_sweep(H_seq, L_seq, cnn_heavy, cnn_light, cnn_paired, Fv_config, args.sweep_CNN_targets,
+                                                  max_edits=args.sweep_max_edits, verbose=args.verbose, cache=cache)
+            new_results = [dict({"Input_idx": input_rows[i]}, **result) for result in sweep_results]
+            sweep_stats = {key: val + stats[key] for key, val in sweep_stats.items()}
+        elif args.diverse_designs is not None:
+            diverse_results, stats = humanise_diverse(H_seq, L_seq, cnn_heavy, cnn_light, cnn_paired, Fv_config, num_designs=args.diverse_designs,
+                                                      min_distance=args.min_distance, verbose=args.verbose, cache=cache)
+            new_results = [dict({"Input_idx": input_rows[i], "Rank": rank+1}, **result) for rank, result in enumerate(diverse_results)]
+            add_to_stats(search_stats, **stats)
+            if len(new_results) < args.diverse_designs:
+                print(f"Warning: only {len(new_results)}/{args.diverse_designs} designs at least {args.min_distance} apart found for input row {input_rows[i]}")
+        else:
+            new_results = [humanise(H_seq, L_seq, cnn_heavy, cnn_light, cnn_paired, Fv_config, verbose=args.verbose, cache=cache, stats=search_stats,
+                                    warm_start=warm_start, start_scores=start_scores)]
+            if warm_start is not None:
+                add_to_warm_start_library(warm_start, [H_seq], [L_seq], [new_results[0]["Humatch_H"]], [new_results[0]["Humatch_L"]],
+                                          [new_results[0]["HV"]], [new_results[0]["LV"]])
+        if args.include_input:
+            new_results = [dict({"VH": H_seq, "VL": L_seq}, **result) for result in new_results]
+        results.extend(new_results)
+        result_rows.extend([input_rows[i]] * len(new_results))
         if args.verbose:
-            for key, val in results[-1].items():
-                if key in ["Humatch_H", "Humatch_L"]: continue
-                val = f"{val:.3f}" if isinstance(val, np.float32) else val
-                print(f"\t{key}:\t{val}")
+            for result in new_results:
+                for key, val in result.items():
+                    if key in ["Humatch_H", "Humatch_L"]: continue
+                    val = f"{val:.3f}" if isinstance(val, np.float32) else val
+                    print(f"\t{key}:\t{val}")
+
+    if search_stats.get("classified_Fvs", 0) > 0:
+        print(f"Reused classification of {search_stats['classified_Fvs']} Fvs - skipped alignment and "
+              f"{search_stats.get('classified_target_genes', 0)} target gene predictions, and reused "
+              f"{search_stats.get('start_scores_reused', 0)} starting CNN scores")
+    if search_stats.get("GL_prefilter_iterations", 0) > 0:
+        print(f"Germline prefilter pruned {search_stats['GL_prefilter_pruned'] / search_stats['GL_prefilter_variants']:.1%} of variants "
+              f"on average and fell back to all variants in {search_stats.get('GL_prefilter_fallbacks', 0)}/"
+              f"{search_stats['GL_prefilter_iterations']} iterations")
+        if config.get("GL_prefilter_diagnostic", False):
+            print(f"Germline prefilter changed the selected variant in {search_stats.get('GL_prefilter_changed_choices', 0)} iterations")
+    if search_stats.get("paired_shortlist_iterations", 0) > 0:
+        print(f"Paired CNN shortlist skipped {search_stats['paired_shortlist_skipped']} paired evaluations over "
+              f"{search_stats['paired_shortlist_iterations']} iterations ({search_stats.get('paired_shortlist_fallbacks', 0)} fallbacks)")
+        if search_stats.get("paired_shortlist_diagnostic_iterations", 0) > 0:
+            print(f"Paired CNN shortlist changed the selected variant in {search_stats['paired_shortlist_changed_choices']}/"
+                  f"{search_stats['paired_shortlist_diagnostic_iterations']} iterations vs exhaustive scoring")
+    num_budget_stops = search_stats.get("budget_stops_CNN_evals", 0) + search_stats.get("budget_stops_seconds", 0)
+    if num_budget_stops > 0:
+        print(f"Compute budget stopped {num_budget_stops} antibodies early ({search_stats.get('budget_stops_CNN_evals', 0)} max_CNN_evals, "
+              f"{search_stats.get('budget_stops_seconds', 0)} max_seconds) - best designs so far returned")
+    if search_stats.get("warm_start_antibodies", 0) > 0:
+        print(f"Warm start found a neighbour (same target genes) for {search_stats.get('warm_start_neighbours', 0)}/{search_stats['warm_start_antibodies']} antibodies "
+              f"and seeded {search_stats.get('warm_start_hits', 0)} ({search_stats.get('warm_start_mutations', 0)} mutations inherited) - "
+              f"{search_stats.get('humanise_iterations', 0)} iterations run")
+    if search_stats.get("saliency_iterations", 0) > 0:
+        print(f"Saliency proposals pruned {search_stats['saliency_pruned'] / search_stats['saliency_variants']:.1%} of variants "
+              f"on average and fell back to all variants in {search_stats.get('saliency_fallbacks', 0)}/"
+              f"{search_stats['saliency_iterations']} iterations")
+        if config.get("saliency_diagnostic", False):
+            print(f"Saliency proposals changed the selected variant in {search_stats.get('saliency_changed_choices', 0)} iterations")
+    if search_stats.get("surrogate_scans", 0) > 0:
+        print(f"Surrogate jumps accepted {search_stats.get('surrogate_jumps_accepted', 0)}/{search_stats.get('surrogate_jumps_accepted', 0) + search_stats.get('surrogate_jumps_rejected', 0)}, "
+              f"adding {search_stats.get('surrogate_jump_mutations', 0)} mutations - {search_stats['surrogate_scans']} full variant scans instead of "
+              f"~{search_stats['surrogate_scans'] + search_stats.get('surrogate_jump_mutations', 0)} for one scan per mutation")
+    if args.diverse_designs is not None:
+        relative_cost = search_stats.get("diverse_CNN_evals", 0) / max(1, search_stats.get("separate_CNN_evals", 0))
+        print(f"Diverse designs used {search_stats.get('diverse_CNN_evals', 0)} CNN evaluations vs ~{search_stats.get('separate_CNN_evals', 0)} "
+              f"for {args.diverse_designs} separate runs ({relative_cost:.1%} of the cost)")
+    if args.sweep_CNN_targets is not None:
+        saved = 1 - sweep_stats["sweep_CNN_evals"] / max(1, sweep_stats["separate_CNN_evals"])
+        print(f"Sweep used {sweep_stats['sweep_CNN_evals']} CNN evaluations vs {sweep_stats['separate_CNN_evals']} "
+              f"for separate runs ({saved:.1%} saved)")
+
+    if args.verbose and config.get("compile_CNNs", False):
+        for cnn_type, cnn in zip(["heavy", "light", "paired"], [cnn_heavy, cnn_light, cnn_paired]):
+            print(f"Compiled {cnn_type} CNN stats: {cnn.get_stats()}")
+    if cache is not None:
+        if args.verbose: print(f"Prediction cache stats: {cache.get_stats()}")
+        if cache.path is not None:
+            cache.save()
 
     # save if output or input provided
-    out_path = args.output if args.output is not None else args.input.replace(".csv", "_Humatch_humanised.csv") if args.input is not None else None
+    out_path = args.output if args.output is not None else get_default_output_path(args.input, "_Humatch_humanised.csv") if args.input is not None else None
     if out_path is not None:
         if args.verbose: print(f"Saving to {out_path}")
         df_out = pd.DataFrame(results)
-        df_out.to_csv(out_path, index=False)
+        if save_ids:
+            df_out.insert(0, "ID", [ids[row] for row in result_rows])
+        if args.shard is not None:
+            df_out.insert(0, ROW_COL, result_rows)
+            save_shard(df_out, out_path, shard_idx, num_shards, input_rows + failed_rows, num_input_rows, failed_rows)
+        else:
+            df_out.to_csv(out_path, index=False)
     # print output for single Fv if out path not provided (if it has not been printed earlier)
     else:
         if not args.verbose and len(results) > 0:
-            print(f"Humanised sequences:\n\t{results[0]['Humatch_H'].replace('-','')}\n\t{results[0]['Humatch_L'].replace('-','')}")
-            for key, val in results[0].items():
-                if key in ["Humatch_H", "Humatch_L"]: continue
-                val = f"{val:.3f}" if isinstance(val, np.float32) else val
-                print(f"\t{key}:\t{val}")
+            for result in (results if args.sweep_CNN_targets is not None or args.top_k_genes is not None or args.diverse_designs is not None else results[:1]):
+                print(f"Humanised sequences:\n\t{result['Humatch_H'].replace('-','')}\n\t{result['Humatch_L'].replace('-','')}")
+                for key, val in result.items():
+                    if key in ["Humatch_H", "Humatch_L"]: continue
+                    val = f"{val:.3f}" if isinstance(val, np.float32) else val
+                    print(f"\t{key}:\t{val}")
@@ -0,0 +1,279 @@
+import time
+import numpy as np
+import tensorflow as tf
+from Humatch.utils import seq_strs_to_kidera_array, seq_strs_to_token_array, KIDERA_AA_CODES, KIDERA_ARRAY
+
+# padded batch sizes - keeps the number of traced graphs small and fixed
+DEFAULT_BUCKETS = [1, 8, 32, 128, 512, 2048]
+
+
+class BucketedPredictor:
+    '''
+    Low-latency, retrace-free prediction path for a Humatch CNN
+    Batches are zero-padded up to one of a small set of batch-size buckets so the compiled forward
+    pass is traced at most once per bucket, however the number of variants changes between calls.
+    The traced graph for each bucket is kept and called directly, skipping tf.function dispatch and
+    the model.predict machinery, so tiny batches (e.g. a single sequence) cost little more than the
+    arithmetic. Sequences are encoded in-process with a vectorised lookup rather than a multiprocessing pool
+
+    :param model: keras model e.g. output of load_cnn
+    :param buckets: list of int, padded batch sizes. Inputs larger than the biggest bucket are split
+    :param jit_compile: bool, compile the forward pass with XLA
+    '''
+    def __init__(self, model, buckets=DEFAULT_BUCKETS, jit_compile=False):
+        self.model = model
+        self.humatch_id = getattr(model, "humatch_id", None) or model.name
+        self.buckets = sorted(buckets)
+        self.jit_compile = jit_compile
+        self.num_traces = 0
+        self.num_calls = 0
+        self.num_padded_rows = 0
+        self._forward = tf.function(self._forward_fn, jit_compile=jit_compile, reduce_retracing=False)
+        self._bucket_fns = {}
+
+    def _forward_fn(self, X):
+        '''
+        Forward pass - python side effects only run while tracing so this also counts (re)traces
+        '''
+        self.num_traces += 1
+        return self.model(X, training=False)
+
+    def get_bucket_size(self, num_seqs):
+        '''
+        Get the smallest bucket that fits num_seqs (num_seqs must not exceed the largest bucket)
+        '''
+        return next(bucket for bucket in self.buckets if bucket >= num_seqs)
+
+    def get_bucket_fn(self, bucket_size):
+        '''
+        Get the traced forward pass for a bucket, tracing it on first use
+        '''
+        if bucket_size not in self._bucket_fns:
+            input_spec = tf.TensorSpec((bucket_size,) + tuple(self.model.input_shape[1:]), tf.float32)
+            self._bucket_fns[bucket_size] = self._forward.get_concrete_function(input_spec)
+        return self._bucket_fns[bucket_size]
+
+    def predict(self, X):
+        '''
+        Predict from Kidera encoded ndarray, X
+
+        :param X: ndarray of Kidera encoded (# seqs, seq len, 10)
+        :returns: ndarray of predictions (# seqs, # classes)
+        '''
+        self.num_calls += 1
+        X = np.asarray(X, dtype=np.float32)
+        predictions = []
+        for low_idx in range(0, len(X), self.buckets[-1]):
+            X_chunk = X[low_idx:low_idx+self.buckets[-1]]
+            num_seqs = len(X_chunk)
+            bucket_size = self.get_bucket_size(num_seqs)
+            if bucket_size > num_seqs:
+                X_chunk = np.concatenate([X_chunk, np.zeros((bucket_size - num_seqs,) + X_chunk.shape[1:], dtype=np.float32)])
+                self.num_padded_rows += bucket_size - num_seqs
+            predictions.append(self.get_bucket_fn(bucket_size)(tf.constant(X_chunk)).numpy()[:num_seqs])
+        return np.concatenate(predictions, axis=0)
+
+    def predict_seqs(self, seq_strs):
+        '''
+        Predict from a list of aligned sequence strings
+
+        :param seq_strs: list of str sequences
+        :returns: ndarray of predictions (# seqs, # classes)
+        '''
+        if len(seq_strs) == 0:
+            return np.zeros((0, self.model.output_shape[-1]), dtype=np.float32)
+        return self.predict(seq_strs_to_kidera_array(seq_strs))
+
+    def get_stats(self):
+        '''
+        Get call and retrace counters
+        :returns: dict of counters
+        '''
+        return {"traces": self.num_traces, "calls": self.num_calls, "padded_rows": self.num_padded_rows}
+
+
+def get_first_layer_lookup_tables(model):
+    '''
+    Precompute the first Conv1D layer of a Humatch CNN as (kernel offset, amino acid) -> filter lookup tables
+    Inputs are fixed Kidera embeddings, so the contribution of amino acid a at kernel offset k to every filter is
+    embedding[a] @ kernel[k], and the layer output is the bias plus a sum of one table row per offset.
+    Codes sharing an embedding (e.g. "-", "*" and "X" are all zero) share a table row
+
+    :param model: keras model e.g. output of load_cnn
+    :returns: ndarray of tables (kernel size, # unique embeddings, # filters), ndarray of bias (# filters,), int
+        number of positions padded before the sequence ('same' padding) and ndarray mapping tokens (see
+        seq_strs_to_token_array) to table rows
+    '''
+    conv = model.layers[0]
+    if not isinstance(conv, tf.keras.layers.Conv1D) or conv.strides[0] != 1 or conv.dilation_rate[0] != 1:
+        raise ValueError("First layer must be a stride 1, undilated Conv1D")
+    kernel, bias = conv.get_weights()
+    embeddings, token_map = np.unique(KIDERA_ARRAY, axis=0, return_inverse=True)
+    tables = np.einsum("ae,kef->kaf", embeddings, kernel).astype(np.float32)
+    left_pad = (kernel.shape[0] - 1) // 2 if conv.padding == "same" else 0
+    return tables, bias.astype(np.float32), left_pad, token_map.ravel().astype(np.int32)
+
+
+def group_lookup_tables(tables, offsets_per_gather=3):
+    '''
+    Merge the lookup tables of consecutive kernel offsets so one gather covers several offsets - row
+    a_1 * A^(g-1) + ... + a_g of a merged table holds the summed rows of amino acids a_1 ... a_g
+
+    :param tables: ndarray (kernel size, A, # filters), see get_first_layer_lookup_tables
+    :param offsets_per_gather: int, offsets per merged table (tables grow as A^offsets_per_gather)
+    :returns: list of ndarray (A^# offsets, # filters), one per group of consecutive offsets
+    '''
+    num_offsets, num_AAs, num_filters = tables.shape
+    grouped_tables = []
+    for low_idx in range(0, num_offsets, offsets_per_gather):
+        group = tables[low_idx:low_idx+offsets_per_gather]
+        merged = np.zeros((num_AAs,) * len(group) + (num_filters,), dtype=np.float32)
+        for i, table in enumerate(group):
+            merged += table.reshape((1,) * i + (num_AAs,) + (1,) * (len(group) - i - 1) + (num_filters,))
+        grouped_tables.append(merged.reshape(-1, num_filters))
+    return grouped_tables
+
+
+class LookupConvPredictor(BucketedPredictor):
+    '''
+    BucketedPredictor that evaluates the first Conv1D layer from precomputed lookup tables
+    (see get_first_layer_lookup_tables) as gathers and adds on uint8 token inputs - no float input tensor
+    is built. The remaining layers are run as in the keras model. Works for heavy, light and paired CNNs
+
+    :param model: keras model e.g. output of load_cnn
+    :param buckets: list of int, padded batch sizes. Inputs larger than the biggest bucket are split
+    :param jit_compile: bool, compile the forward pass with XLA
+    :param offsets_per_gather: int, kernel offsets merged into each lookup table (fewer, larger gathers)
+    '''
+    def __init__(self, model, buckets=DEFAULT_BUCKETS, jit_compile=False, offsets_per_gather=3):
+        super().__init__(model, buckets=buckets, jit_compile=jit_compile)
+        tables, bias, left_pad, token_map = get_first_layer_lookup_tables(model)
+        self.kernel_size, self.num_AAs = tables.shape[0], tables.shape[1]
+        self.offsets_per_gather = offsets_per_gather
+        self.tables = [tf.constant(table) for table in group_lookup_tables(tables, offsets_per_gather)]
+        self.bias = tf.constant(bias)
+        self.left_pad = left_pad
+        self.right_pad = self.kernel_size - 1 - left_pad if model.layers[0].padding == "same" else 0
+        self.token_map = tf.constant(token_map)
+        self.pad_token = KIDERA_AA_CODES.index("-")
+        self.activation = model.layers[0].activation
+
+    def first_layer(self, tokens):
+        '''
+        First layer output from tokens (# seqs, seq len) - the sum over kernel offsets of gathered table rows
+        Positions outside the sequence are padded with "-" which has an all zero Kidera encoding
+        '''
+        tokens = tf.gather(self.token_map, tf.cast(tokens, tf.int32))
+        tokens = tf.pad(tokens, [[0, 0], [self.left_pad, self.right_pad]], constant_values=int(self.token_map[self.pad_token]))
+        seq_len = tokens.shape[1] - self.kernel_size + 1
+        X = self.bias
+        for i, table in enumerate(self.tables):
+            # row of the merged table for the amino acids at this group's offsets
+            idxs = 0
+            for offset in range(i * self.offsets_per_gather, min((i + 1) * self.offsets_per_gather, self.kernel_size)):
+                idxs = idxs * self.num_AAs + tokens[:, offset:offset+seq_len]
+            X = X + tf.gather(table, idxs)
+        return self.activation(X)
+
+    def _forward_fn(self, tokens):
+        self.num_traces += 1
+        X = self.first_layer(tokens)
+        for layer in self.model.layers[1:]:
+            X = layer(X, training=False)
+        return X
+
+    def get_bucket_fn(self, bucket_size):
+        '''
+        Get the traced forward pass for a bucket of uint8 tokens, tracing it on first use
+        '''
+        if bucket_size not in self._bucket_fns:
+            input_spec = tf.TensorSpec((bucket_size, self.model.input_shape[1]), tf.uint8)
+            self._bucket_fns[bucket_size] = self._forward.get_concrete_function(input_spec)
+        return self._bucket_fns[bucket_size]
+
+    def predict(self, tokens):
+        '''
+        Predict from tokens (see seq_strs_to_token_array)
+
+        :param tokens: ndarray of uint8 (# seqs, seq len)
+        :returns: ndarray of predictions (# seqs, # classes)
+        '''
+        self.num_calls += 1
+        tokens = np.asarray(tokens, dtype=np.uint8)
+        predictions = []
+        for low_idx in range(0, len(tokens), self.buckets[-1]):
+            tokens_chunk = tokens[low_idx:low_idx+self.buckets[-1]]
+            num_seqs = len(tokens_chunk)
+            bucket_size = self.get_bucket_size(num_seqs)
+            if bucket_size > num_seqs:
+                tokens_chunk = np.concatenate([tokens_chunk, np.full((bucket_size - num_seqs, tokens_chunk.shape[1]), self.pad_token, dtype=np.uint8)])
+                self.num_padded_rows += bucket_size - num_seqs
+            predictions.append(self.get_bucket_fn(bucket_size)(tf.constant(tokens_chunk)).numpy()[:num_seqs])
+        return np.concatenate(predictions, axis=0)
+
+    def predict_seqs(self, seq_strs):
+        '''
+        Predict from a list of aligned sequence strings
+
+        :param seq_strs: list of str sequences
+        :returns: ndarray of predictions (# seqs, # classes)
+        '''
+        if len(seq_strs) == 0:
+            return np.zeros((0, self.model.output_shape[-1]), dtype=np.float32)
+        return self.predict(seq_strs_to_token_array(seq_strs))
+
+
+def benchmark_lookup_first_layer(model, seq_strs, batch_size=512, num_repeats=3, offsets_per_gather=3):
+    '''
+    Compare the lookup table first layer with the keras Conv1D (first layer alone and the full forward pass,
+    both including encoding) on the same sequences
+
+    :param model: keras model e.g. output of load_cnn
+    :param seq_strs: list of str, aligned sequences of the model's input length
+    :param batch_size: int, sequences per call
+    :param num_repeats: int, timed repeats (best is reported, after one untimed warm up)
+    :param offsets_per_gather: int, see LookupConvPredictor
+    :returns: dict of seqs / second for each path and the max absolute difference of their outputs
+    '''
+    conv = model.layers[0]
+    keras_predictor = BucketedPredictor(model, buckets=[batch_size])
+    lookup_predictor = LookupConvPredictor(model, buckets=[batch_size], offsets_per_gather=offsets_per_gather)
+    keras_first_layer = tf.function(lambda X: conv(X), reduce_retracing=True)
+    lookup_first_layer = tf.function(lookup_predictor.first_layer, reduce_retracing=True)
+    batches = [seq_strs[low_idx:low_idx+batch_size] for low_idx in range(0, len(seq_strs), batch_size)]
+
+    def best_throughput(fn):
+        [fn(batch) for batch in batches]
+        times = []
+        for _ in range(num_repeats):
+            start = time.perf_counter()
+            [fn(batch) for batch in batches]
+            times.append(time.perf_counter() - start)
+        return len(seq_strs) / min(times)
+
+    report = {"keras_first_layer": best_throughput(lambda batch: keras_first_layer(seq_strs_to_kidera_array(batch)).numpy()),
+              "lookup_first_layer": best_throughput(lambda batch: lookup_first_layer(seq_strs_to_token_array(batch)).numpy()),
+              "keras_forward": best_throughput(keras_predictor.predict_seqs),
+              "lookup_forward": best_throughput(lookup_predictor.predict_seqs)}
+    report["first_layer_max_abs_diff"] = float(np.max(np.abs(keras_first_layer(seq_strs_to_kidera_array(batches[0])).numpy() -
+                                                              lookup_first_layer(seq_strs_to_token_array(batches[0])).numpy())))
+    report["forward_max_abs_diff"] = float(np.max(np.abs(keras_predictor.predict_seqs(batches[0]) - lookup_predictor.predict_seqs(batches[0]))))
+    return report
+
+
+def compile_cnn(model, config):
+    '''
+    Wrap a CNN in a BucketedPredictor if requested in the config
+
+    :param model: keras model e.g. output of load_cnn
+    :param config: dict, config with optional keys compile_CNNs, XLA_compile, CNN_batch_buckets, CNN_lookup_first_layer
+    :returns: BucketedPredictor (LookupConvPredictor if CNN_lookup_first_layer is also set) if compile_CNNs is set,
+        otherwise the unchanged model
+    '''
+    if not config.get("compile_CNNs", False):
+        return model
+    if config.get("CNN_lookup_first_layer", False):
+        return LookupConvPredictor(model, buckets=config.get("CNN_batch_buckets", DEFAULT_BUCKETS), jit_compile=config.get("XLA_compile", False),
+                                   offsets_per_gather=config.get("CNN_lookup_offsets_per_gather", 3))
+    return BucketedPredictor(model, buckets=config.get("CNN_batch_buckets", DEFAULT_BUCKETS),
+                             jit_compile=config.get("XLA_compile", False))
@@ -1,4 +1,6 @@
 import os
+import re
+import hashlib
 import requests
 from tensorflow import keras
 from Humatch.utils import HEAVY_V_GENE_CLASSES, LIGHT_V_GENE_CLASSES, PAIRED_CLASSES
@@ -25,6 +27,8 @@ PARAMS = [['CONV', 40, 10, 1],
           ['POOL', 2, 1],
           ['FLAT'],
           ['DENSE', 300]]
+# low-rank compressed weights (see Humatch/compress.py) e.g. paired.rank32.weights.h5
+COMPRESSED_WEIGHTS_REGEX = r"\.rank(\d+)\.weights\.h5$"
 ENCODING_DIM = 10   # kidera
 SEQ_LEN = 200       # kasearch positions
 PAD_LEN = 10        # padding between H and L chains
@@ -44,6 +48,8 @@ def create_cnn(units_per_layer, input_shape,
         Dropout information: [DROP, dropout rate]
         Flatten: [FLAT]
         Dense layer: [DENSE, number nodes]
+        Low-rank dense layer: [DENSE_LR, number nodes, rank] - a linear
+            projection to rank dims followed by the dense layer
 
     input_shape: a tuple defining the input shape of the data
 
@@ -77,6 +83,14 @@ def create_cnn(units_per_layer, input_shape,
                                          activation=activation,
                                          kernel_regularizer=regularizer,
                                          bias_regularizer=regularizer))
+        elif units[0] == 'DENSE_LR':
+            model.add(keras.layers.Dense(units=units[2],
+                                         use_bias=False,
+                                         kernel_regularizer=regularizer))
+            model.add(keras.layers.Dense(units=units[1],
+                                         activation=activation,
+                                         kernel_regularizer=regularizer,
+                                         bias_regularizer=regularizer))
         elif units[0] == 'DROP':
             model.add(keras.layers.Dropout(rate=units[1]))
         elif units[0] == 'FLAT':
@@ -92,15 +106,43 @@ def create_cnn(units_per_layer, input_shape,
     return model
 
 
+def get_weights_path(cnn_type, rank=None):
+    '''
+    Path to the weights of a CNN - the trained weights, or low-rank compressed weights if rank is given
+    e.g. trained_models/paired.rank32.weights.h5 (see Humatch-compress)
+
+    :param cnn_type: str, type of CNN model heavy | light | paired
+    :param rank: int, optional rank of compressed weights
+    :return: str, path to weights file
+    '''
+    if rank is None:
+        return os.path.join(CNN_WEIGHTS_DIR, f"{cnn_type}.weights.h5")
+    return os.path.join(CNN_WEIGHTS_DIR, f"{cnn_type}.rank{rank}.weights.h5")
+
+
+def get_low_rank_params(rank, params=PARAMS):
+    '''
+    Params with the first DENSE layer replaced by a DENSE_LR layer of the given rank
+    '''
+    dense_idx = [units[0] for units in params].index('DENSE')
+    return params[:dense_idx] + [['DENSE_LR', params[dense_idx][1], rank]] + params[dense_idx+1:]
+
+
 def load_cnn(weights, cnn_type, params=PARAMS):
     '''
     We save the checkpoint weights so need to load the relevant params too
     If retrained and full weights saved, use tf.keras.models.load_model(weights)
+    Low-rank compressed weights (*.rank{r}.weights.h5, see Humatch-compress) are loaded with DENSE_LR params
 
     :param weights: str, path to weights file
     :param cnn_type: str, type of CNN model heavy | light | paired
     :return: keras model
     '''
+    rank_match = re.search(COMPRESSED_WEIGHTS_REGEX, weights)
+    if rank_match is not None:
+        if not os.path.exists(weights):
+            raise FileNotFoundError(f"Compressed weights {weights} not found - create them with Humatch-compress")
+        params = get_low_rank_params(int(rank_match.group(1)), params)
     if cnn_type == "heavy":
         seq_len, out_dim = SEQ_LEN, len(HEAVY_V_GENE_CLASSES)
         # check if weights file exists and download if not
@@ -128,4 +170,7 @@ def load_cnn(weights, cnn_type, params=PARAMS):
     
     CNN = create_cnn(params, (seq_len, ENCODING_DIM), 'relu', None, out_dim=out_dim)
     CNN.load_weights(weights)
+    # stable id (e.g. for caching predictions across runs) - changes if the weights change
+    with open(weights, 'rb') as f:
+        CNN.humatch_id = f"{cnn_type}-{hashlib.sha1(f.read()).hexdigest()[:12]}"
     return CNN
@@ -0,0 +1,212 @@
+import io
+import os
+import csv
+import gzip
+import time
+import itertools
+import numpy as np
+
+FASTA_EXTS = [".fa", ".fasta", ".fas", ".faa"]
+TSV_EXTS = [".tsv", ".tab"]
+COMPRESSION_EXTS = [".gz", ".zst", ".zstd"]
+# values read as missing (as with pd.read_csv)
+MISSING_VALUES = {"", "NA", "N/A", "NaN", "nan", "null", "None"}
+# separators between a FASTA record id and its chain suffix e.g. ab1_VH, ab1|VL
+CHAIN_SEPARATORS = ["_", "|"]
+
+
+def split_input_path(path):
+    '''
+    Split an input path into its root, format extension and compression extension
+    e.g. data/rep.fasta.gz --> ("data/rep", ".fasta", ".gz")
+    '''
+    root, compression_ext = os.path.splitext(path)
+    if compression_ext.lower() not in COMPRESSION_EXTS:
+        root, compression_ext = path, ""
+    root, format_ext = os.path.splitext(root)
+    return root, format_ext.lower(), compression_ext.lower()
+
+
+def get_input_format(path):
+    '''
+    Input format from the file extension (ignoring compression) - "fasta", "tsv" or "csv" (default)
+    '''
+    format_ext = split_input_path(path)[1]
+    return "fasta" if format_ext in FASTA_EXTS else "tsv" if format_ext in TSV_EXTS else "csv"
+
+
+def get_default_output_path(input_path, suffix):
+    '''
+    Default output path next to the input e.g. data/rep.fasta.gz --> data/rep_Humatch_aligned.csv
+    :param suffix: str, e.g. "_Humatch_aligned.csv"
+    '''
+    return split_input_path(input_path)[0] + suffix
+
+
+def open_input(path):
+    '''
+    Open a (plain, gzip or zstd compressed) input file for reading text
+    zstd requires the optional zstandard package (pip install zstandard)
+    '''
+    compression_ext = split_input_path(path)[2]
+    if compression_ext == ".gz":
+        return gzip.open(path, "rt", newline="")
+    if compression_ext in [".zst", ".zstd"]:
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError(f"Reading {path} requires the zstandard package - install with 'pip install zstandard'")
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), closefd=True), newline="")
+    return open(path, newline="")
+
+
+def iter_fasta(f):
+    '''
+    Stream (id, sequence) records from an open FASTA file - the id is the first word of the header
+    and sequences may be wrapped over several lines
+    '''
+    record_id, seq_lines = None, []
+    for line in f:
+        if line.startswith(">"):
+            if record_id is not None:
+                yield record_id, "".join(seq_lines)
+            header = line[1:].split()
+            record_id, seq_lines = header[0] if len(header) > 0 else "", []
+        elif record_id is not None:
+            seq_lines.append(line.strip())
+    if record_id is not None:
+        yield record_id, "".join(seq_lines)
+
+
+def split_chain_suffix(record_id, vh_suffix="VH", vl_suffix="VL"):
+    '''
+    Split a FASTA record id into the Fv id and chain e.g. ab1_VH --> ("ab1", "H"), ab1|VL --> ("ab1", "L")
+    :returns: tuple of str, Fv id and chain ("H", "L" or None if no chain suffix)
+    '''
+    for chain, suffix in [("H", vh_suffix), ("L", vl_suffix)]:
+        for separator in CHAIN_SEPARATORS:
+            if record_id.endswith(separator + suffix):
+                return record_id[:-len(separator + suffix)], chain
+    return record_id, None
+
+
+def iter_paired_fasta_records(path, paired_path=None, vh_suffix="VH", vl_suffix="VL"):
+    '''
+    Stream (id, VH, VL) Fvs from FASTA, pairing heavy and light records by id. Records are either all in one
+    file with chain suffixes (e.g. ab1_VH, ab1_VL) or in separate heavy (path) and light (paired_path) files
+    whose ids match (after removing any chain suffix). Only unpaired records are held in memory, so files with
+    partners close together (e.g. in the same order) stream with bounded memory. Unpaired records are skipped
+
+    :param path: str, FASTA path (heavy chains if paired_path is given)
+    :param paired_path: str, optional FASTA path of light chains
+    :param vh_suffix/vl_suffix: str, id suffixes marking heavy/light records
+    :returns: generator of (Fv id, VH, VL)
+    '''
+    with open_input(path) as f_H, (open_input(paired_path) if paired_path is not None else io.StringIO()) as f_L:
+        if paired_path is None:
+            records = ((split_chain_suffix(record_id, vh_suffix, vl_suffix), seq) for record_id, seq in iter_fasta(f_H))
+        else:
+            # alternate between files so ordered inputs pair immediately
+            records = (((split_chain_suffix(record[0], vh_suffix, vl_suffix)[0], chain), record[1])
+                       for pair in itertools.zip_longest(iter_fasta(f_H), iter_fasta(f_L))
+                       for chain, record in zip(["H", "L"], pair) if record is not None)
+        unpaired = {}
+        for (Fv_id, chain), seq in records:
+            if chain is None:
+                raise ValueError(f"FASTA record '{Fv_id}' in {path} has no chain suffix - ids must end in e.g. _{vh_suffix} or "
+                                 f"_{vl_suffix}, or give heavy and light chains as separate files")
+            partner = unpaired.pop((Fv_id, "L" if chain == "H" else "H"), None)
+            if partner is None:
+                if (Fv_id, chain) in unpaired:
+                    raise ValueError(f"Duplicate V{chain} FASTA record '{Fv_id}'")
+                unpaired[(Fv_id, chain)] = seq
+            else:
+                yield (Fv_id, seq, partner) if chain == "H" else (Fv_id, partner, seq)
+    if len(unpaired) > 0:
+        print(f"Warning: {len(unpaired)} FASTA records had no partner chain and were skipped e.g. {sorted(unpaired)[:5]}")
+
+
+def get_input_columns(path):
+    '''
+    Column names of a (compressed) csv/tsv input, read from its header only
+    '''
+    with open_input(path) as f:
+        return next(csv.reader(f, delimiter="\t" if get_input_format(path) == "tsv" else ","), [])
+
+
+def iter_delimited_records(path, vh_col="VH", vl_col="VL", block_size=1 << 22):
+    '''
+    Stream (row idx, VH, VL) from a (compressed) csv/tsv. Lines are read in blocks of ~block_size characters and
+    split directly unless the block contains quotes (then parsed with the csv module), so records must not span lines.
+    Missing values are returned as NaN, as with pd.read_csv, and chains whose column is absent as None
+
+    :returns: generator of (row idx, VH, VL)
+    '''
+    delimiter = "\t" if get_input_format(path) == "tsv" else ","
+    with open_input(path) as f:
+        header = next(csv.reader([f.readline()], delimiter=delimiter), [])
+        col_idxs = [header.index(col) if col in header else None for col in [vh_col, vl_col]]
+        row_idx = 0
+        for lines in iter(lambda: f.readlines(block_size), []):
+            rows = csv.reader(lines, delimiter=delimiter) if any('"' in line for line in lines) else \
+                   (line.rstrip("\r\n").split(delimiter) for line in lines)
+            rows = [row for row in rows if len(row) > 1 or (len(row) == 1 and row[0] != "")]
+            H_seqs, L_seqs = [[None] * len(rows) if col_idx is None else
+                              [row[col_idx] if col_idx < len(row) and row[col_idx] not in MISSING_VALUES else np.nan for row in rows]
+                              for col_idx in col_idxs]
+            yield from zip(range(row_idx, row_idx + len(rows)), H_seqs, L_seqs)
+            row_idx += len(rows)
+
+
+def iter_input_chunks(path, vh_col="VH", vl_col="VL", chunk_size=10000, paired_path=None, stats=None):
+    '''
+    Stream Fvs from a plain, gzip (.gz) or zstd (.zst) compressed csv, tsv or FASTA file in chunks, without pandas
+    FASTA heavy and light records are paired by id (see iter_paired_fasta_records) and csv/tsv rows are read
+    from the vh_col and vl_col columns
+
+    :param path: str, input path - the format is taken from the extension e.g. rep.fasta.gz, rep.tsv, rep.csv
+    :param vh_col/vl_col: str, csv/tsv column names, or FASTA id suffixes, of heavy/light chains
+    :param chunk_size: int, max number of Fvs per chunk
+    :param paired_path: str, optional FASTA of light chains (path then holds heavy chains)
+    :param stats: dict, optional - updated with Fvs read, bytes (input file size) and seconds spent reading
+    :returns: generator of (list of ids, list of VH, list of VL) - ids are FASTA ids or csv/tsv row indices,
+        and the list of a chain is empty if its column is absent
+    '''
+    if paired_path is not None and get_input_format(path) != "fasta":
+        raise ValueError("A separate light chain file can only be given with a FASTA input")
+    records = iter_paired_fasta_records(path, paired_path, vh_col, vl_col) if get_input_format(path) == "fasta" else \
+              iter_delimited_records(path, vh_col, vl_col)
+    stats = {} if stats is None else stats
+    for key in ["Fvs", "bytes", "seconds"]:
+        stats.setdefault(key, 0)
+    stats["bytes"] += sum(os.path.getsize(p) for p in [path, paired_path] if p is not None)
+    while True:
+        # only time spent reading is counted, not processing between chunks
+        start = time.time()
+        chunk = list(itertools.islice(records, chunk_size))
+        stats["seconds"] += time.time() - start
+        if len(chunk) == 0:
+            return
+        stats["Fvs"] += len(chunk)
+        ids, H_seqs, L_seqs = [list(col) for col in zip(*chunk)]
+        yield ids, H_seqs if H_seqs[0] is not None else [], L_seqs if L_seqs[0] is not None else []
+
+
+def read_input(path, vh_col="VH", vl_col="VL", paired_path=None, stats=None):
+    '''
+    Read all Fvs of an input file - see iter_input_chunks
+    :returns: list of ids, list of VH, list of VL
+    '''
+    ids, H_seqs, L_seqs = [], [], []
+    for chunk_ids, H_chunk, L_chunk in iter_input_chunks(path, vh_col, vl_col, paired_path=paired_path, stats=stats):
+        ids.extend(chunk_ids); H_seqs.extend(H_chunk); L_seqs.extend(L_chunk)
+    return ids, H_seqs, L_seqs
+
+
+def format_read_stats(stats):
+    '''
+    Read throughput summary e.g. "Read 1000000 Fvs (52.1 MB) in 4.2s - 238095 Fvs/s, 12.4 MB/s"
+    '''
+    seconds = max(stats["seconds"], 1e-9)
+    return f"Read {stats['Fvs']} Fvs ({stats['bytes'] / 1e6:.1f} MB) in {stats['seconds']:.1f}s - " \
+           f"{stats['Fvs'] / seconds:.0f} Fvs/s, {stats['bytes'] / 1e6 / seconds:.1f} MB/s"
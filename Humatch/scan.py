@@ -0,0 +1,239 @@
+import os
+import sys
+# supress warnings about having no GPU
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+import numpy as np
+import pandas as pd
+import argparse
+
+from Humatch.classify import predict_from_list_of_seq_strs
+from Humatch.germline_likeness import load_observed_position_AA_freqs, GL_DIR
+from Humatch.humanise import get_all_single_point_variants, get_variant_position_and_AA_idxs
+from Humatch.utils import (
+    get_ordered_AA_one_letter_codes,
+    HEAVY_V_GENE_CLASSES,
+    LIGHT_V_GENE_CLASSES,
+    PAIRED_CLASSES,
+    CANONICAL_NUMBERING,
+    configure_cpus
+)
+from Humatch.align import align_seqs
+from Humatch.model import load_cnn, get_weights_path
+from Humatch.inference import compile_cnn
+from Humatch.readers import read_input, get_input_format, get_input_columns, get_default_output_path, format_read_stats
+
+PAD = "----------"
+# channels of the scan array - heavy CNN (heavy mutations), light CNN (light mutations),
+# paired CNN (heavy mutations) and paired CNN (light mutations)
+SCAN_CHANNELS = ["CNN_H", "CNN_L", "CNN_P_H", "CNN_P_L"]
+
+
+def get_delta_score_matrix(seq, variants, variant_preds, wildtype_pred):
+    '''
+    Arrange single point variant scores as a position x amino acid matrix of changes in score
+
+    :param seq: str, aligned sequence (padded with "-" for missing positions)
+    :param variants: list of str, single point variants of seq
+    :param variant_preds: ndarray of predictions for each variant
+    :param wildtype_pred: float, prediction for seq
+    :returns: ndarray (seq len, 20) of variant - wildtype scores, 0 for the wildtype residue and
+        NaN at padded (unscanned) positions
+    '''
+    AA_codes = get_ordered_AA_one_letter_codes()
+    deltas = np.full((len(seq), 20), np.nan, dtype=np.float32)
+    for pos_idx, AA in enumerate(seq):
+        if AA != "-":
+            deltas[pos_idx, AA_codes.index(AA)] = 0
+    pos_idxs, AA_idxs = get_variant_position_and_AA_idxs(seq, variants)
+    deltas[pos_idxs, AA_idxs] = np.asarray(variant_preds) - wildtype_pred
+    return deltas
+
+
+def scan_Fvs(H_seqs, L_seqs, cnn_heavy, cnn_light, cnn_paired, target_genes_H=None, target_genes_L=None,
+             out_path=None, batch_Fvs=8, allow_CDR_mutations=True, num_cpus=None, verbose=False):
+    '''
+    Deep mutational scan of many Fvs - score every single point variant of each chain with the heavy,
+    light and paired CNNs. Variants of batch_Fvs antibodies are scored together in one batch per CNN
+    and each batch of results is written straight to the (memory mapped) output array
+
+    :param H_seqs/L_seqs: list of str, aligned heavy/light chain sequences
+    :param cnn_heavy/light/paired: model e.g. trained CNN for heavy/light/paired chain
+    :param target_genes_H/L: list of str target genes per Fv (None = top scoring human gene)
+    :param out_path: str, .npy path to stream the scan array to (None = keep in memory)
+    :param batch_Fvs: int, number of Fvs scored per batch
+    :param allow_CDR_mutations: bool, scan CDR positions too
+    :param num_cpus: int number of cpus to use when encoding sequences
+    :returns: ndarray (# Fvs, 4, 200, 20) of delta scores (channels as SCAN_CHANNELS) and DataFrame of
+        target genes and wildtype CNN scores per Fv
+    '''
+    num_Fvs, seq_len = len(H_seqs), len(CANONICAL_NUMBERING)
+    shape = (num_Fvs, len(SCAN_CHANNELS), seq_len, 20)
+    if out_path is not None:
+        scan_arr = np.lib.format.open_memmap(out_path, mode="w+", dtype=np.float32, shape=shape)
+    else:
+        scan_arr = np.zeros(shape, dtype=np.float32)
+    paired_true_idx = PAIRED_CLASSES.index("true")
+
+    summary = []
+    for low_idx in range(0, num_Fvs, batch_Fvs):
+        if verbose: print(f"Scanning Fvs {low_idx+1}-{min(low_idx+batch_Fvs, num_Fvs)}/{num_Fvs}")
+        batch_H, batch_L = H_seqs[low_idx:low_idx+batch_Fvs], L_seqs[low_idx:low_idx+batch_Fvs]
+        variants_H = [get_all_single_point_variants(H, allow_CDR_mutations) for H in batch_H]
+        variants_L = [get_all_single_point_variants(L, allow_CDR_mutations) for L in batch_L]
+        variants_P_H = [[H_var + PAD + L for H_var in H_vars] for H_vars, L in zip(variants_H, batch_L)]
+        variants_P_L = [[H + PAD + L_var for L_var in L_vars] for H, L_vars in zip(batch_H, variants_L)]
+
+        # one CNN call per chain type for the wildtypes and variants of all Fvs in the batch
+        preds_H = predict_from_list_of_seq_strs(batch_H + sum(variants_H, []), cnn_heavy, num_cpus=num_cpus)
+        preds_L = predict_from_list_of_seq_strs(batch_L + sum(variants_L, []), cnn_light, num_cpus=num_cpus)
+        batch_P = [H + PAD + L for H, L in zip(batch_H, batch_L)]
+        preds_P = predict_from_list_of_seq_strs(batch_P + sum(variants_P_H, []) + sum(variants_P_L, []), cnn_paired,
+                                                num_cpus=num_cpus)[:, paired_true_idx]
+
+        # split predictions back out per Fv
+        offset_H, offset_L, offset_P = len(batch_H), len(batch_L), len(batch_P)
+        offset_P_L = offset_P + sum(len(v) for v in variants_P_H)
+        for i, (H, L) in enumerate(zip(batch_H, batch_L)):
+            Fv_idx = low_idx + i
+            target_gene_H = target_genes_H[Fv_idx] if target_genes_H is not None else HEAVY_V_GENE_CLASSES[np.argmax(preds_H[i, 1:]) + 1]
+            target_gene_L = target_genes_L[Fv_idx] if target_genes_L is not None else LIGHT_V_GENE_CLASSES[np.argmax(preds_L[i, 1:]) + 1]
+            H_idx, L_idx = HEAVY_V_GENE_CLASSES.index(target_gene_H), LIGHT_V_GENE_CLASSES.index(target_gene_L)
+            num_H, num_L = len(variants_H[i]), len(variants_L[i])
+
+            scan_arr[Fv_idx, 0] = get_delta_score_matrix(H, variants_H[i], preds_H[offset_H:offset_H+num_H, H_idx], preds_H[i, H_idx])
+            scan_arr[Fv_idx, 1] = get_delta_score_matrix(L, variants_L[i], preds_L[offset_L:offset_L+num_L, L_idx], preds_L[i, L_idx])
+            scan_arr[Fv_idx, 2] = get_delta_score_matrix(H, variants_H[i], preds_P[offset_P:offset_P+num_H], preds_P[i])
+            scan_arr[Fv_idx, 3] = get_delta_score_matrix(L, variants_L[i], preds_P[offset_P_L:offset_P_L+num_L], preds_P[i])
+            offset_H, offset_L, offset_P, offset_P_L = offset_H + num_H, offset_L + num_L, offset_P + num_H, offset_P_L + num_L
+
+            summary.append({"VH": H, "VL": L, "HV": target_gene_H, "LV": target_gene_L,
+                            "CNN_H": preds_H[i, H_idx], "CNN_L": preds_L[i, L_idx], "CNN_P": preds_P[i]})
+        if out_path is not None:
+            scan_arr.flush()
+
+    return scan_arr, pd.DataFrame(summary)
+
+
+def get_germline_overlay(target_genes_H, target_genes_L, germline_likeness_lookup_arrays_dir=GL_DIR):
+    '''
+    Stack the observed position AA frequencies of each Fv's heavy and light target genes
+    :param target_genes_H/L: list of str target genes per Fv
+    :returns: ndarray (# Fvs, 2, 200, 20) of observed frequencies (heavy then light)
+    '''
+    GL_arrs = {gene: load_observed_position_AA_freqs(gene, germline_likeness_lookup_arrays_dir)
+               for gene in set(target_genes_H) | set(target_genes_L)}
+    return np.stack([np.stack([GL_arrs[gene_H][:, :20], GL_arrs[gene_L][:, :20]]) for gene_H, gene_L in zip(target_genes_H, target_genes_L)]).astype(np.float32)
+
+
+def command_line_interface():
+    description="""
+    Humatch - Scan
+                                                           @
+    Author: Lewis Chinery               )  __QQ    ???    /||\\
+    Supervisor: Charlotte M. Deane     (__(_)_">           /\\
+    Contact: opig@stats.ox.ac.uk
+    """
+    parser = argparse.ArgumentParser(prog="Humatch-scan", description=description, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-H", "--VH", help="Heavy chain amino acid sequence", default=None)
+    parser.add_argument("-L", "--VL", help="Light chain amino acid sequence", default=None)
+    parser.add_argument("-i", "--input", help="Path to csv, tsv or FASTA (optionally .gz/.zst compressed) with antibody sequences", default=None)
+    parser.add_argument("--input_L", help="FASTA of light chains paired with the -i FASTA of heavy chains by id", default=None)
+    parser.add_argument("--vh_col", help="Column name for VH sequences in input file", default="VH")
+    parser.add_argument("--vl_col", help="Column name for VL sequences in input file", default="VL")
+    parser.add_argument("-a", "--aligned", help="Input sequences are prealigned to 200 KASearch positions", default=False, action="store_true")
+    parser.add_argument("--target_gene_H", help="Heavy target gene for all Fvs e.g. hv3 - defaults to the top scoring gene of each Fv", default=None)
+    parser.add_argument("--target_gene_L", help="Light target gene for all Fvs e.g. kv1 - defaults to the top scoring gene of each Fv", default=None)
+    parser.add_argument("--framework_only", help="Do not scan CDR positions", default=False, action="store_true")
+    parser.add_argument("--GL_overlay", help="Also save the target genes' germline frequencies (*_GL.npy)", default=False, action="store_true")
+    parser.add_argument("--batch_Fvs", help="Number of Fvs scanned per CNN batch", default=8, type=int)
+    parser.add_argument("--num_cpus", help="Number of CPUs to use (defaults to all available)", default=None, type=int)
+    parser.add_argument("--compiled", help="Use the compiled, shape-bucketed prediction path", default=False, action="store_true")
+    parser.add_argument("--compressed_rank", help="Use low-rank compressed CNNs of this rank (see Humatch-compress)", default=None, type=int)
+    parser.add_argument("--lookup_first_layer", help="Run the first conv layer as table lookups on tokens (implies --compiled)", default=False, action="store_true")
+    parser.add_argument("-o", "--output", help="Output .npy save path - defaults to the same dir as input", default=None)
+    parser.add_argument("-v", "--verbose", help="Verbose output flag", default=False, action="store_true")
+    args = parser.parse_args()
+
+    # show help menu if no options given
+    if len(sys.argv) <= 1:
+        parser.print_help()
+        sys.exit(0)
+
+    # check input provided is OK
+    if args.VH is None and args.VL is None and args.input is None:
+        raise ValueError("Must provide either VH and VL, or input file")
+    if args.VH is not None or args.VL is not None:
+        if args.input is not None:
+            raise ValueError("Cannot provide input file if VH or VL is given")
+    if (args.VH is None and args.VL is not None) or (args.VH is not None and args.VL is None):
+        raise ValueError("Humatch scanning requires both VH and VL sequences")
+    if args.input_L is not None and args.input is None:
+        raise ValueError("--input_L requires a FASTA input file of heavy chains")
+    # check columns from the header only (FASTA records are always paired)
+    input_cols = get_input_columns(args.input) if args.input is not None and get_input_format(args.input) != "fasta" else None
+    if input_cols is not None and (args.vh_col not in input_cols or args.vl_col not in input_cols):
+        raise ValueError(f"Humatch scanning requires both VH and VL sequences. Could not find columns '{args.vh_col}' and '{args.vl_col}' in input file")
+
+    # get sequences
+    H_seqs, L_seqs = [args.VH] if args.VH else [], [args.VL] if args.VL else []
+    vh_col, vl_col = args.vh_col, args.vl_col
+    read_stats, ids = {}, None
+    if args.input:
+        ids, H_seqs, L_seqs = read_input(args.input, vh_col, vl_col, paired_path=args.input_L, stats=read_stats)
+        if args.verbose: print(format_read_stats(read_stats))
+    # FASTA ids are saved with the summary (csv/tsv rows are identified by order)
+    save_ids = args.input is not None and get_input_format(args.input) == "fasta"
+
+    # align
+    cpu_budget = configure_cpus(args.num_cpus, verbose=args.verbose)
+    if not args.aligned:
+        if args.verbose: print(f"Aligning sequences ({len(H_seqs)} VH, {len(L_seqs)} VL)")
+        aligned_seqs = align_seqs(H_seqs + L_seqs, num_cpus=cpu_budget["align_workers"])
+        H_seqs, L_seqs = aligned_seqs[:len(H_seqs)], aligned_seqs[len(H_seqs):]
+
+    # check if ANARCI failed on any sequences and remove them
+    failed_idxs = [i for i, (H, L) in enumerate(zip(H_seqs, L_seqs)) if "-"*len(CANONICAL_NUMBERING) in [H, L]]
+    if len(failed_idxs) > 0:
+        print(f"Warning: {len(failed_idxs)} Fvs could not be numbered by ANARCI and will not be scanned")
+        H_seqs = [seq for i, seq in enumerate(H_seqs) if i not in failed_idxs]
+        L_seqs = [seq for i, seq in enumerate(L_seqs) if i not in failed_idxs]
+        if ids is not None:
+            ids = [Fv_id for i, Fv_id in enumerate(ids) if i not in failed_idxs]
+
+    # load CNNs
+    if args.verbose: print("Loading CNNs")
+    cnn_config = {"compile_CNNs": args.compiled or args.lookup_first_layer, "CNN_lookup_first_layer": args.lookup_first_layer}
+    cnn_heavy = compile_cnn(load_cnn(get_weights_path("heavy", args.compressed_rank), "heavy"), cnn_config)
+    cnn_light = compile_cnn(load_cnn(get_weights_path("light", args.compressed_rank), "light"), cnn_config)
+    cnn_paired = compile_cnn(load_cnn(get_weights_path("paired", args.compressed_rank), "paired"), cnn_config)
+
+    # scan
+    out_path = args.output if args.output is not None else get_default_output_path(args.input, "_Humatch_scan.npy") if args.input is not None else None
+    target_genes_H = [args.target_gene_H] * len(H_seqs) if args.target_gene_H is not None else None
+    target_genes_L = [args.target_gene_L] * len(L_seqs) if args.target_gene_L is not None else None
+    scan_arr, df_summary = scan_Fvs(H_seqs, L_seqs, cnn_heavy, cnn_light, cnn_paired, target_genes_H=target_genes_H,
+                                    target_genes_L=target_genes_L, out_path=out_path, batch_Fvs=args.batch_Fvs,
+                                    allow_CDR_mutations=not args.framework_only, num_cpus=cpu_budget["encode_workers"], verbose=args.verbose)
+
+    # save if output or input provided
+    if out_path is not None:
+        if args.verbose: print(f"Saved scan array {scan_arr.shape} (Fvs, {', '.join(SCAN_CHANNELS)}, positions, AAs) to {out_path}")
+        if save_ids:
+            df_summary.insert(0, "ID", ids)
+        df_summary.to_csv(out_path.replace(".npy", "") + "_summary.csv", index=False)
+        if args.GL_overlay:
+            np.save(out_path.replace(".npy", "") + "_GL.npy", get_germline_overlay(df_summary["HV"], df_summary["LV"]))
+    # print the top single point mutations for a single Fv if out path not provided
+    else:
+        AAs = get_ordered_AA_one_letter_codes()[:20]
+        for col, val in df_summary.iloc[0].items():
+            if col in ["VH", "VL"]: continue
+            val = f"{val:.3f}" if isinstance(val, np.float32) else val
+            print(f"{col}: \t{val}")
+        for channel_idx, channel in enumerate(SCAN_CHANNELS):
+            deltas = np.nan_to_num(scan_arr[0, channel_idx], nan=-np.inf)
+            top_idxs = np.argsort(-deltas, axis=None)[:5]
+            chain = "H" if channel_idx in [0, 2] else "L"
+            top_mutations = [f"{chain}{CANONICAL_NUMBERING[pos].strip()}{AAs[AA]} ({deltas[pos, AA]:+.3f})"
+                             for pos, AA in zip(*np.unravel_index(top_idxs, deltas.shape))]
+            print(f"Top {channel}:\t{', '.join(top_mutations)}")
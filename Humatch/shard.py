@@ -0,0 +1,230 @@
+import os
+import re
+import sys
+import glob
+import json
+import heapq
+import numpy as np
+import pandas as pd
+import argparse
+
+from Humatch.germline_likeness import load_observed_position_AA_freqs, get_most_common_germline_seq, GL_DIR, vgenes
+from Humatch.utils import get_ordered_AA_one_letter_codes, seq_strs_to_token_array
+
+ROW_COL = "Humatch_row"
+
+
+def parse_shard(shard_str):
+    '''
+    Parse a shard specification e.g. "3/8" (0-based shard index, as with sbatch --array=0-7)
+    :param shard_str: str, "i/N"
+    :returns: tuple of int, shard index and number of shards
+    '''
+    match = re.fullmatch(r"\s*(\d+)\s*/\s*(\d+)\s*", shard_str)
+    if match is None:
+        raise ValueError(f"Could not parse shard '{shard_str}' - expected 'i/N' e.g. '0/8'")
+    shard_idx, num_shards = int(match.group(1)), int(match.group(2))
+    if num_shards < 1 or not 0 <= shard_idx < num_shards:
+        raise ValueError(f"Shard index must be in [0, {num_shards}) - got '{shard_str}'")
+    return shard_idx, num_shards
+
+
+def get_num_residues(seqs):
+    '''
+    Number of residues in each sequence (ignoring padding and missing values)
+    '''
+    return np.array([len(str(seq).replace("-", "")) if isinstance(seq, str) else 0 for seq in seqs])
+
+
+def get_expected_num_edits(aligned_seqs, genes, germline_likeness_lookup_arrays_dir=GL_DIR):
+    '''
+    Cheap proxy for the number of humanising edits each sequence needs - the number of residues
+    that differ from the closest most common germline sequence of the given genes
+
+    :param aligned_seqs: list of str, aligned sequences (all the same length)
+    :param genes: list of str, candidate genes e.g. ["hv1", ..., "hv7"]
+    :returns: ndarray of int, expected number of edits per sequence
+    '''
+    AA_codes = get_ordered_AA_one_letter_codes()
+    germline_tokens = seq_strs_to_token_array([get_most_common_germline_seq(load_observed_position_AA_freqs(
+        gene, germline_likeness_lookup_arrays_dir)) for gene in genes], AA_codes)
+    seq_tokens = seq_strs_to_token_array(aligned_seqs, AA_codes)
+    is_residue = seq_tokens != AA_codes.index("-")
+    mismatches = (seq_tokens[:, None, :] != germline_tokens[None, :, :]) & is_residue[:, None, :]
+    return mismatches.sum(axis=2).min(axis=1)
+
+
+def get_work_weights(H_seqs, L_seqs, aligned=False, humanise=False):
+    '''
+    Predicted relative cost of each Fv, used to balance shards
+    Alignment and classification scale with the number of residues. Humanisation also scales with
+    the number of edits (one variant scan per edit), estimated from aligned sequences only
+
+    :param H_seqs/L_seqs: list of str, heavy/light sequences (either may be empty)
+    :param aligned: bool, sequences are aligned (enables the expected edit estimate)
+    :param humanise: bool, weight by expected number of humanising edits
+    :returns: ndarray of float, weight per Fv
+    '''
+    num_rows = max(len(H_seqs), len(L_seqs))
+    weights = np.zeros(num_rows)
+    for seqs in [H_seqs, L_seqs]:
+        if len(seqs) > 0:
+            weights += get_num_residues(seqs)
+    if humanise and aligned:
+        expected_edits = get_expected_num_edits(H_seqs, [gene for gene in vgenes if gene.startswith("hv")]) + \
+                         get_expected_num_edits(L_seqs, [gene for gene in vgenes if not gene.startswith("hv")])
+        weights *= 1 + expected_edits
+    return weights
+
+
+def get_shard_rows(weights, shard_idx, num_shards):
+    '''
+    Deterministically split rows into num_shards with balanced total weight - rows are taken
+    heaviest first (ties by row) and each given to the lightest shard so far (ties by shard)
+
+    :param weights: array of float, weight per row
+    :param shard_idx: int, shard to return
+    :param num_shards: int, total number of shards
+    :returns: list of int, sorted row indices of the shard
+    '''
+    order = sorted(range(len(weights)), key=lambda i: (-weights[i], i))
+    shard_loads = [(0.0, i) for i in range(num_shards)]
+    shard_rows = [[] for _ in range(num_shards)]
+    for row in order:
+        load, i = heapq.heappop(shard_loads)
+        shard_rows[i].append(row)
+        heapq.heappush(shard_loads, (load + weights[row], i))
+    return sorted(shard_rows[shard_idx])
+
+
+def select_shard(H_seqs, L_seqs, shard_str, aligned=False, humanise=False):
+    '''
+    Keep only the Fvs assigned to one shard
+
+    :param H_seqs/L_seqs: list of str, heavy/light sequences of all input rows (either may be empty)
+    :param shard_str: str, "i/N" shard specification
+    :param aligned/humanise: bool, see get_work_weights
+    :returns: H_seqs and L_seqs of the shard, their input row indices, shard index and number of shards
+    '''
+    shard_idx, num_shards = parse_shard(shard_str)
+    rows = get_shard_rows(get_work_weights(H_seqs, L_seqs, aligned, humanise), shard_idx, num_shards)
+    H_seqs = [H_seqs[i] for i in rows] if len(H_seqs) > 0 else []
+    L_seqs = [L_seqs[i] for i in rows] if len(L_seqs) > 0 else []
+    return H_seqs, L_seqs, rows, shard_idx, num_shards
+
+
+def get_shard_path(out_path, shard_idx, num_shards):
+    '''
+    Output path of a shard e.g. x_Humatch_humanised.csv --> x_Humatch_humanised_shard3of8.csv
+    '''
+    root, ext = os.path.splitext(out_path)
+    return f"{root}_shard{shard_idx}of{num_shards}{ext}"
+
+
+def save_shard(df_out, out_path, shard_idx, num_shards, rows, num_input_rows, failed_rows=None):
+    '''
+    Save the output of a shard along with a manifest used by Humatch-merge to check completeness
+    The manifest is written last so its presence marks a finished shard
+
+    :param df_out: DataFrame, shard output with a Humatch_row column of input row indices
+    :param out_path: str, output path of the (merged) run - the shard path is derived from this
+    :param shard_idx/num_shards: int, shard index and total number of shards
+    :param rows: list of int, input rows assigned to this shard
+    :param num_input_rows: int, total number of input rows across all shards
+    :param failed_rows: list of int, optional assigned rows intentionally missing from the output
+    :returns: str, path the shard output was saved to
+    '''
+    shard_path = get_shard_path(out_path, shard_idx, num_shards)
+    df_out.to_csv(shard_path, index=False)
+    save_shard_manifest(out_path, shard_idx, num_shards, rows, num_input_rows, failed_rows=failed_rows)
+    return shard_path
+
+
+def save_shard_manifest(out_path, shard_idx, num_shards, rows, num_input_rows, failed_rows=None):
+    '''
+    Save the manifest of a shard whose output has already been written to its shard path (e.g. streamed in chunks)
+    See save_shard for params
+    '''
+    shard_path = get_shard_path(out_path, shard_idx, num_shards)
+    failed_rows = [] if failed_rows is None else failed_rows
+    manifest = {"shard": shard_idx, "num_shards": num_shards, "num_input_rows": int(num_input_rows),
+                "output": os.path.basename(shard_path), "rows": [int(row) for row in rows],
+                "failed_rows": [int(row) for row in failed_rows]}
+    with open(os.path.splitext(shard_path)[0] + ".json", "w") as f:
+        json.dump(manifest, f)
+
+
+def merge_shards(out_path):
+    '''
+    Check all shards of a run are complete and merge them into one output ordered by input row
+
+    :param out_path: str, output path of the (merged) run i.e. without the _shard{i}of{N} suffix
+    :returns: DataFrame of merged output and list of failed rows
+    '''
+    root, ext = os.path.splitext(out_path)
+    manifests = {}
+    for manifest_path in glob.glob(f"{glob.escape(root)}_shard*of*.json"):
+        if re.fullmatch(r"_shard\d+of\d+\.json", manifest_path[len(root):]) is None:
+            continue
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        manifests[(manifest["shard"], manifest["num_shards"])] = (manifest_path, manifest)
+    if len(manifests) == 0:
+        raise ValueError(f"No finished shards found for {out_path}")
+
+    # all shards must come from the same run and all must have finished
+    num_shards = {num_shards for _, num_shards in manifests}
+    num_input_rows = {manifest["num_input_rows"] for _, manifest in manifests.values()}
+    if len(num_shards) > 1 or len(num_input_rows) > 1:
+        raise ValueError(f"Found shards from different runs for {out_path}: {sorted(manifests)}")
+    num_shards, num_input_rows = num_shards.pop(), num_input_rows.pop()
+    missing_shards = [i for i in range(num_shards) if (i, num_shards) not in manifests]
+    if len(missing_shards) > 0:
+        raise ValueError(f"Missing {len(missing_shards)}/{num_shards} shards (unfinished or not run): {missing_shards}")
+
+    # shards must partition the input rows and contain each of their rows (unless it failed)
+    dfs, failed_rows, assigned_rows = [], [], []
+    for i in range(num_shards):
+        manifest_path, manifest = manifests[(i, num_shards)]
+        df = pd.read_csv(os.path.join(os.path.dirname(manifest_path), manifest["output"]))
+        expected_rows = set(manifest["rows"]) - set(manifest["failed_rows"])
+        if set(df[ROW_COL]) != expected_rows:
+            raise ValueError(f"Shard {i}/{num_shards} output does not match its manifest - rerun this shard")
+        dfs.append(df)
+        assigned_rows.extend(manifest["rows"])
+        failed_rows.extend(manifest["failed_rows"])
+    if sorted(assigned_rows) != list(range(num_input_rows)):
+        raise ValueError(f"Shards do not cover the {num_input_rows} input rows exactly once")
+
+    df_merged = pd.concat(dfs, ignore_index=True).sort_values(ROW_COL, kind="stable").reset_index(drop=True)
+    return df_merged, sorted(failed_rows)
+
+
+def command_line_interface():
+    description="""
+    Humatch - Merge
+                                      _shard0of4 \\
+    Author: Lewis Chinery             _shard1of4 --> merged
+    Supervisor: Charlotte M. Deane    _shard2of4 /
+    Contact: opig@stats.ox.ac.uk
+    """
+    parser = argparse.ArgumentParser(prog="Humatch-merge", description=description, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-i", "--input", help="Output path of the sharded run, without the _shard{i}of{N} suffix e.g. data/example_Humatch_humanised.csv", default=None)
+    parser.add_argument("-o", "--output", help="Merged output save path - defaults to the input path", default=None)
+    parser.add_argument("-v", "--verbose", help="Verbose output flag", default=False, action="store_true")
+    args = parser.parse_args()
+
+    # show help menu if no options given
+    if len(sys.argv) <= 1:
+        parser.print_help()
+        sys.exit(0)
+    if args.input is None:
+        raise ValueError("Must provide the output path of the sharded run")
+
+    df_merged, failed_rows = merge_shards(args.input)
+    if len(failed_rows) > 0:
+        print(f"Warning: {len(failed_rows)} input rows failed and are missing from the merged output: {failed_rows}")
+
+    out_path = args.output if args.output is not None else args.input
+    if args.verbose: print(f"Saving {len(df_merged)} rows to {out_path}")
+    df_merged.to_csv(out_path, index=False)
@@ -1,4 +1,5 @@
 import os
+import numpy as np
 import tensorflow as tf
 import multiprocessing as mp
 
@@ -82,6 +83,10 @@ KIDERA_DICT = \
  'X': [0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0]}
 
 
+KIDERA_AA_CODES = list(KIDERA_DICT.keys())
+KIDERA_ARRAY = np.array(list(KIDERA_DICT.values()), dtype=np.float32)
+
+
 HEAVY_V_GENE_CLASSES = ["neg"] + [f"hv{i}" for i in range(1, 8)]
 LIGHT_V_GENE_CLASSES = ["neg"] + [f"lv{i}" for i in range(1, 11)] + [f"kv{i}" for i in range(1, 8)]
 PAIRED_CLASSES = ["fake", "true"]
@@ -101,6 +106,44 @@ def seq_to_2D_kidera(seq):
     return kidera_seq
 
 
+def seq_strs_to_token_array(seq_strs, AA_codes=KIDERA_AA_CODES):
+    '''
+    Convert a list of equal length sequences to an array of integer tokens in a single vectorised lookup
+
+    :param seq_strs: list of str sequences (all the same length e.g. aligned and padded)
+    :param AA_codes: list of str, one letter codes - the token of an AA is its index in this list
+    :returns: ndarray of uint8 tokens (# seqs, seq len)
+    '''
+    if len(seq_strs) == 0:
+        return np.zeros((0, 0), dtype=np.uint8)
+    lookup = np.full(256, 255, dtype=np.uint8)
+    for i, AA in enumerate(AA_codes):
+        lookup[ord(AA)] = i
+    bad_idxs = [i for i, seq in enumerate(seq_strs) if len(seq) != len(seq_strs[0])]
+    if len(bad_idxs) > 0:
+        raise ValueError(f"All sequences must be the same length (aligned and padded) - {len(bad_idxs)} sequences differ "
+                         f"in length from the first ({len(seq_strs[0])}) e.g. at idxs {bad_idxs[:5]}")
+    chars = np.frombuffer("".join(seq_strs).encode("latin-1"), dtype=np.uint8)
+    tokens = lookup[chars.reshape(len(seq_strs), -1)]
+    if (tokens == 255).any():
+        unknown = sorted(set(chr(c) for c in chars[tokens.ravel() == 255]))
+        raise KeyError(f"Unknown amino acid(s) {unknown} - expected one of {AA_codes}")
+    return tokens
+
+
+def seq_strs_to_kidera_array(seq_strs):
+    '''
+    Vectorised equivalent of seq_to_2D_kidera for a list of equal length sequences
+    Avoids a multiprocessing pool, so is much faster for small numbers of sequences
+
+    :param seq_strs: list of str sequences (all the same length e.g. aligned and padded)
+    :returns: ndarray of Kidera encoded (# seqs, seq len, 10)
+    '''
+    if len(seq_strs) == 0:
+        return np.zeros((0, 0, KIDERA_ARRAY.shape[1]), dtype=np.float32)
+    return KIDERA_ARRAY[seq_strs_to_token_array(seq_strs)]
+
+
 def get_ordered_AA_one_letter_codes(extra_chars=["-"]):
     '''
     Get list of amino acid one letter codes in alphabetical order
@@ -164,15 +207,96 @@ def get_edit_distance(original_seq, mutated_seq):
     return edit_distance
 
 
-def set_num_cpus(num_cpus=None):
+def set_num_cpus(num_cpus=None, num_inter_op_threads=None):
     '''
     Set environment variables to limit the number of CPUs
     Note - speed is not directly proportional to number of CPUs
-    :param num_cpus: int, number of CPUs
+    :param num_cpus: int, number of CPUs (TF intra-op threads)
+    :param num_inter_op_threads: int, number of TF inter-op threads (defaults to num_cpus)
     '''
     num_cpus = mp.cpu_count() if num_cpus is None else num_cpus
+    num_inter_op_threads = num_cpus if num_inter_op_threads is None else num_inter_op_threads
     os.environ["OMP_NUM_THREADS"] = str(num_cpus)
     os.environ["TF_NUM_INTRAOP_THREADS"] = str(num_cpus)
-    os.environ["TF_NUM_INTEROP_THREADS"] = str(num_cpus)
-    tf.config.threading.set_intra_op_parallelism_threads(num_cpus)
-    tf.config.threading.set_inter_op_parallelism_threads(num_cpus)
+    os.environ["TF_NUM_INTEROP_THREADS"] = str(num_inter_op_threads)
+    try:
+        tf.config.threading.set_intra_op_parallelism_threads(num_cpus)
+        tf.config.threading.set_inter_op_parallelism_threads(num_inter_op_threads)
+    except RuntimeError:
+        # TF thread pools are fixed once the runtime has been initialised
+        print("Warning: TensorFlow is already initialised - could not change its number of threads")
+
+
+def get_cgroup_cpu_limit():
+    '''
+    Get the CPU quota of this process' cgroup (e.g. a container or slurm job limit)
+    :returns: float, number of CPUs allowed by the quota, or None if unlimited / not found
+    '''
+    # cgroup v2 - "<quota> <period>" or "max <period>"
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()[:2]
+        return None if quota == "max" else int(quota) / int(period)
+    except (OSError, ValueError):
+        pass
+    # cgroup v1 - quota of -1 means unlimited
+    try:
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:
+            quota = int(f.read())
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+            period = int(f.read())
+        return None if quota <= 0 else quota / period
+    except (OSError, ValueError):
+        return None
+
+
+def get_available_cpus():
+    '''
+    Get the number of CPUs this process can actually use, respecting CPU affinity
+    (e.g. taskset, slurm) and cgroup quotas rather than the number of cores on the node
+    :returns: int, number of usable CPUs
+    '''
+    try:
+        num_cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        num_cpus = mp.cpu_count()
+    cgroup_limit = get_cgroup_cpu_limit()
+    if cgroup_limit is not None:
+        num_cpus = min(num_cpus, max(1, int(cgroup_limit)))
+    return num_cpus
+
+
+def get_cpu_budget(num_cpus=None):
+    '''
+    Split a CPU budget between sequence encoding workers, TensorFlow threads and alignment workers
+    Encoding overlaps with CNN inference so the two share the budget (~1/4 encoding, the rest TF),
+    whereas alignment (ANARCI) runs beforehand and so gets the whole budget
+
+    :param num_cpus: int, requested number of CPUs (None = all available), capped at those available
+    :returns: dict of the number of CPUs / threads given to each stage
+    '''
+    available = get_available_cpus()
+    total = available if num_cpus is None else max(1, min(num_cpus, available))
+    encode_workers = max(1, total // 4)
+    TF_intra_op_threads = max(1, total - encode_workers)
+    return {"available": available, "total": total, "encode_workers": encode_workers,
+            "TF_intra_op_threads": TF_intra_op_threads, "TF_inter_op_threads": min(2, TF_intra_op_threads),
+            "align_workers": total}
+
+
+def configure_cpus(num_cpus=None, verbose=False):
+    '''
+    Get the CPU budget and apply its TensorFlow thread limits
+    Must be called before any CNNs are loaded for the TF limits to take effect
+
+    :param num_cpus: int, requested number of CPUs (None = all available)
+    :param verbose: bool, print the chosen topology
+    :returns: dict of the number of CPUs / threads given to each stage (see get_cpu_budget)
+    '''
+    budget = get_cpu_budget(num_cpus)
+    set_num_cpus(budget["TF_intra_op_threads"], budget["TF_inter_op_threads"])
+    if verbose:
+        print(f"Using {budget['total']}/{budget['available']} available CPUs: {budget['encode_workers']} encoding workers, "
+              f"{budget['TF_intra_op_threads']} TF intra-op / {budget['TF_inter_op_threads']} inter-op threads, "
+              f"{budget['align_workers']} alignment workers")
+    return budget
@@ -15,6 +15,10 @@ setup(
         'Humatch-align=Humatch.align:command_line_interface',
         'Humatch-classify=Humatch.classify:command_line_interface',
         'Humatch-humanise=Humatch.humanise:command_line_interface',
+        'Humatch-scan=Humatch.scan:command_line_interface',
+        'Humatch-merge=Humatch.shard:command_line_interface',
+        'Humatch-compress=Humatch.compress:command_line_interface',
+        'Humatch-cluster=Humatch.cluster:command_line_interface',
         ]},
     install_requires=[
         'numpy>=1.26.4',
@@ -28,4 +32,7 @@ setup(
         'biopython>=1.84',  # for anarci numbering
         'hmmer==3.4.0.0',   # for anarci numbering
     ],
+    extras_require={
+        'zstd': ['zstandard'],  # for reading .zst inputs
+    },
 )
\ No newline at end of file